@@ -22,6 +22,10 @@ log = Logger()
 
 class BenchmarkCommentFormatter(MarkdownFormatter):
 
+    needed_logs = toolz.merge(MarkdownFormatter.needed_logs, {
+        'success': {'result': {SUCCESS}}
+    })
+
     def _render_table(self, jsonlines):
         """Renders the json content of a result log
 
@@ -45,9 +49,10 @@ class BenchmarkCommentFormatter(MarkdownFormatter):
     async def render_success(self, build, master):
         # extract logs named as `result`
         results = {}
-        for step, log_lines in self.extract_logs(build, logname='result'):
+        logs = self.extract_logs(build, logname='result', master=master)
+        async for step, log_lines in logs:
             if step['results'] == SUCCESS:
-                results[step['stepid']] = (line for _, line in log_lines)
+                results[step['stepid']] = [line async for _, line in log_lines]
 
         try:
             # decode jsonlines objects and render the results as markdown table
@@ -67,6 +72,10 @@ class BenchmarkCommentFormatter(MarkdownFormatter):
 
 class CrossbowCommentFormatter(MarkdownFormatter):
 
+    needed_logs = toolz.merge(MarkdownFormatter.needed_logs, {
+        'success': {'result': {SUCCESS}}
+    })
+
     _markdown_badge = '[![{title}]({badge})]({url})'
 
     badges = {
@@ -143,9 +152,10 @@ class CrossbowCommentFormatter(MarkdownFormatter):
     async def render_success(self, build, master):
         # extract logs named as `result`
         results = {}
-        for step, log_lines in self.extract_logs(build, logname='result'):
+        logs = self.extract_logs(build, logname='result', master=master)
+        async for step, log_lines in logs:
             if step['results'] == SUCCESS:
-                results[step['stepid']] = (line for _, line in log_lines)
+                results[step['stepid']] = [line async for _, line in log_lines]
 
         # render the crossbow repo, becuase it might be passed as a Property
         props = Properties.fromDict(build['properties'])
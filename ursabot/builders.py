@@ -23,7 +23,7 @@ from buildbot.worker.base import AbstractWorker, Worker
 
 from .docker import DockerImage
 from .workers import DockerLatentWorker
-from .utils import Annotable, InstanceOf
+from .utils import Annotable, InstanceOf, startup_timer
 
 __all__ = ['Builder', 'DockerBuilder']
 
@@ -92,6 +92,7 @@ class Builder(Annotable):
         )
 
     @classmethod
+    @startup_timer.timed('builder combination')
     def combine_with(cls, workers, name, **kwargs):
         # instantiate builders by applying Builder.worker_filter and grouping
         # the workers based on architecture or criteria
@@ -185,6 +186,7 @@ class DockerBuilder(Builder):
         return rendered.result
 
     @classmethod
+    @startup_timer.timed('builder combination')
     def combine_with(cls, workers, images, name=None, **kwargs):
         """Instantiates builders based on the available workers
 
@@ -4,16 +4,121 @@
 # Use of this source code is governed by a BSD 2-Clause
 # license that can be found in the LICENSE_BSD file.
 
+import weakref
+import collections
+
 from buildbot import config
 from buildbot.util import NotABranch
 from buildbot.plugins import changes
 from buildbot.changes import filter
 
-__all__ = ['ChangeFilter', 'GitPoller', 'GitHubPullrequestPoller']
+__all__ = [
+    'ChangeFilter',
+    'ChangeRouter',
+    'GitPoller',
+    'GitHubPullrequestPoller'
+]
+
+
+class ChangeRouter:
+    """Inverted index of the ChangeFilters' exact-match checks
+
+    Every scheduler evaluates its change filter on every change. The router
+    indexes the exact values of the registered filters' checks on the
+    `keys` attributes, so the filters which cannot match a change are
+    determined with a couple of lookups. The candidate filters only depend
+    on the change's values of the indexed attributes, so they are cached by
+    those values, because each scheduler receives its own Change instance.
+    Caching by value rather than by the change's number keeps the results
+    correct when the router is shared by multiple masters of the same
+    process, which assign the same numbers to different changes. The
+    candidates only have to evaluate their residual, regex or callable
+    checks.
+
+    Parameters
+    ----------
+    keys: Tuple[str], default ('category', 'repository', 'project',
+                               'prop:command')
+        Change attributes to index, `prop:` prefix refers to properties.
+    cache_size: int, default 256
+        Number of distinct indexed values to cache the candidate filters for.
+    """
+
+    def __init__(self, keys=('category', 'repository', 'project',
+                             'prop:command'), cache_size=256):
+        self.keys = keys
+        self.cache_size = cache_size
+        self._filters = weakref.WeakValueDictionary()
+        self._table = None
+        self._cache = collections.OrderedDict()
+
+    def __contains__(self, change_filter):
+        return self._filters.get(id(change_filter)) is change_filter
+
+    def register(self, change_filter):
+        self._filters[id(change_filter)] = change_filter
+        # the routing table is compiled on the next routed change
+        self._table = None
+        self._cache.clear()
+
+    def _compile(self):
+        exact = {key: collections.defaultdict(set) for key in self.keys}
+        wildcard = {key: set() for key in self.keys}
+        for fid, change_filter in self._filters.items():
+            for key in self.keys:
+                filt_list, _, _ = change_filter.checks.get(key, (None,) * 3)
+                if filt_list is None:
+                    wildcard[key].add(fid)
+                else:
+                    for value in filt_list:
+                        exact[key][value].add(fid)
+        return exact, wildcard
+
+    def _candidates(self, values):
+        if self._table is None:
+            self._table = self._compile()
+        exact, wildcard = self._table
+
+        candidates = set(self._filters.keys())
+        for key, value in zip(self.keys, values):
+            try:
+                matching = exact[key].get(value, set())
+            except TypeError:
+                # unhashable value, fall back to comparing with each value
+                matching = set()
+                for filt_value, fids in exact[key].items():
+                    if filt_value == value:
+                        matching |= fids
+            candidates &= matching | wildcard[key]
+        return candidates
+
+    def route(self, change):
+        """Returns the ids of the filters the change may pass"""
+        values = tuple(ChangeFilter._change_value(change, key)
+                       for key in self.keys)
+        try:
+            hash(values)
+        except TypeError:
+            # unhashable value, e.g. a list property
+            return self._candidates(values)
+
+        try:
+            self._cache.move_to_end(values)
+            return self._cache[values]
+        except KeyError:
+            candidates = self._cache[values] = self._candidates(values)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return candidates
 
 
 class ChangeFilter(filter.ChangeFilter):
-    """Extended with ability to filter on properties"""
+    """Extended with ability to filter on properties
+
+    The filters are routed by a shared ChangeRouter, see its docstring.
+    """
+
+    router = ChangeRouter()
 
     def __init__(self, fn=None, branch=NotABranch, project=None,
                  repository=None, category=None, codebase=None,
@@ -42,6 +147,53 @@ class ChangeFilter(filter.ChangeFilter):
 
         self.filter_fn = fn
         self.checks = self.createChecks(*check_tuples)
+        self._compile_residual_checks()
+        self.router.register(self)
+
+    def _compile_residual_checks(self):
+        # the exact checks of the keys indexed by the router are evaluated by
+        # the routing, so only the regexes and callables remain
+        self._residual_checks = [
+            (attr, None if attr in self.router.keys else filt_list,
+             filt_re, filt_fn)
+            for attr, (filt_list, filt_re, filt_fn) in self.checks.items()
+            if (filt_list is not None and attr not in self.router.keys) or
+            filt_re is not None or filt_fn is not None
+        ]
+
+    def __setstate__(self, state):
+        # copied filters must be registered as well
+        self.__dict__.update(state)
+        self.router.register(self)
+
+    @staticmethod
+    def _change_value(change, attr):
+        if attr.startswith('prop:'):
+            return change.properties.getProperty(attr.split(':', 1)[1], '')
+        else:
+            return getattr(change, attr, '')
+
+    def filter_change(self, change):
+        # License note:
+        #    copied from the original implementation with modifications to
+        #    consult the router and to evaluate only the residual checks
+        if self not in self.router:
+            self.router.register(self)
+        if id(self) not in self.router.route(change):
+            return False
+
+        if self.filter_fn is not None and not self.filter_fn(change):
+            return False
+        for attr, filt_list, filt_re, filt_fn in self._residual_checks:
+            value = self._change_value(change, attr)
+            if filt_list is not None and value not in filt_list:
+                return False
+            if filt_re is not None and (value is None or
+                                        not filt_re.match(value)):
+                return False
+            if filt_fn is not None and not filt_fn(value):
+                return False
+        return True
 
     def _create_check_tuple(self, name, value, default=None):
         # example: (project, project_re, project_fn, "project"),
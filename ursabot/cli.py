@@ -5,25 +5,28 @@
 # license that can be found in the LICENSE_BSD file.
 
 import io
+import glob
 import logging
 import warnings
 from pathlib import Path
 from contextlib import redirect_stdout, redirect_stderr
 
 import click
+from tabulate import tabulate
 from buildbot.config import ConfigErrors
 from buildbot.plugins import util
 from buildbot.process.results import Results
 from buildbot.process.results import SUCCESS, WARNINGS, FAILURE, EXCEPTION
 from buildbot.util.logger import Logger
 from dockermap.api import DockerClientWrapper
-from twisted.internet import reactor
+from twisted.internet import defer, reactor
 from twisted.python.log import PythonLoggingObserver
 
 from .builders import DockerBuilder
 from .configs import Config, MasterConfig
-from .utils import Matching, Filter, ensure_deferred
-from .docker import ImageCollection
+from .utils import (Matching, Filter, ensure_deferred, startup_timer,
+                    strict_validation)
+from .docker import ImageCollection, ImageBuildError, ImagePushError
 from .master import TestMaster
 
 
@@ -55,8 +58,11 @@ class UrsabotConfigErrors(click.ClickException):
 @click.option('--config-variable', '-cv', default='master',
               help='Variable name in the configuration which must be an '
                    'instance of MasterConfig')
+@click.option('--profile-startup', is_flag=True, default=False,
+              help='Print the time spent in the phases of the configuration '
+                   'loading after the command has finished.')
 @click.pass_context
-def ursabot(ctx, verbose, config_path, config_variable):
+def ursabot(ctx, verbose, config_path, config_variable, profile_startup):
     """CLI for Ursabot continous integration framework based on Buildbot
 
     `ursabot` command tries to locate the master.cfg file and it looks for a
@@ -67,6 +73,10 @@ def ursabot(ctx, verbose, config_path, config_variable):
     if verbose:
         logging.getLogger('ursabot').setLevel(logging.INFO)
 
+    if profile_startup:
+        startup_timer.enabled = True
+        ctx.call_on_close(_echo_startup_profile)
+
     stderr, stdout = io.StringIO(), io.StringIO()
     try:
         with redirect_stderr(stderr), redirect_stdout(stdout):
@@ -98,6 +108,26 @@ def ursabot(ctx, verbose, config_path, config_variable):
     ctx.obj['config_path'] = Path(config_path)
 
 
+_startup_phases = [
+    'config exec',
+    'annotable validation',
+    'builder combination',
+    'as_buildbot conversion'
+]
+
+
+def _echo_startup_profile():
+    rows = []
+    for phase in _startup_phases:
+        if startup_timer.calls[phase]:
+            elapsed = f'{startup_timer.elapsed[phase]:.3f}s'
+            rows.append((phase, startup_timer.calls[phase], elapsed))
+        else:
+            rows.append((phase, 0, '-'))
+    click.echo(tabulate(rows, headers=['phase', 'calls', 'elapsed']),
+               err=True)
+
+
 @ursabot.group()
 @click.option('--project', '-p', default=None,
               help='If the master has multiple projects configured, one must '
@@ -114,7 +144,7 @@ def project(obj, project):
 
     if project is None:
         if len(config.projects) == 1:
-            project = config.projects[0]
+            project = config.project(name=config.projects[0].name)
         else:
             raise click.UsageError(f'Master config has multiple projects, one '
                                    f'must be selected: {project_names}')
@@ -176,13 +206,15 @@ def project_desc(obj):
 def checkconfig(obj):
     """Run sanity checks on the master configuration
 
-    It is a wrapper around `buildbot checkconfig`.
+    It is a wrapper around `buildbot checkconfig`. The lazily loaded projects
+    are validated in strict mode, so every field is checked with typeguard.
     """
     config = obj['config']
     config_path = obj['config_path']
 
     try:
-        config.as_buildbot(source=config_path.name)
+        with strict_validation():
+            config.as_buildbot(source=config_path.name)
     except ConfigErrors as e:
         raise UrsabotConfigErrors(e)
 
@@ -344,17 +376,25 @@ def docker(obj, docker_host, docker_username, docker_password, name, tag,
     if no_variant:
         variant = None
 
-    image_filter = Filter(
-        name=Matching(name),
-        tag=Matching(tag),
-        variant=Matching(variant),
+    def pattern(value):
+        # exact values are looked up from the indexes of the images
+        if value is not None and glob.has_magic(value):
+            return Matching(value)
+        else:
+            return value
+
+    filtered = config.select(
+        'images',
+        name=pattern(name),
+        tag=pattern(tag),
+        variant=pattern(variant),
         platform=Filter(
-            arch=Matching(arch),
-            system=Matching(system),
-            distro=Matching(distro)
+            arch=pattern(arch),
+            system=pattern(system),
+            distro=pattern(distro)
         )
     )
-    filtered = ImageCollection(i for i in config.images if image_filter(i))
+    filtered = ImageCollection(filtered)
 
     obj['client'] = client
     obj['images'] = filtered
@@ -369,21 +409,72 @@ def docker_list_images(obj):
         click.echo(image)
 
 
-# TODO(kszucs): option to push to another organization
+def _echo_summary(results):
+    colors = {'success': 'green', 'unchanged': 'blue', 'failure': 'red',
+              'skipped': 'yellow'}
+    rows = [
+        (r.fqn, click.style(r.state, fg=colors[r.state]), f'{r.elapsed:.1f}s')
+        for r in results
+    ]
+    headers = ['image', 'state', 'elapsed']
+    click.echo(tabulate(rows, headers=headers))
+
+
 @docker.command('build')
 @click.option('--push/--no-push', '-p', default=False,
               help='Push the built images')
+@click.option('--push-to', '-pt', 'targets', multiple=True,
+              help='Registry and/or organization to push the images to, '
+                   'e.g. quay.io/ursalabs. Can be passed multiple times. '
+                   "Defaults to the image's own organization.")
 @click.option('--no-cache/--cache', default=False,
               help='Do not use cache when building the images')
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=1),
+              help='Number of images to build or push in parallel. An image '
+                   'is built as soon as its parent image is ready.')
+@click.option('--fail-fast/--keep-going', default=True,
+              help='Whether to stop starting new builds after the first '
+                   'failure or keep building the images which are not '
+                   'depending on the failed ones')
+@click.option('--force', '-f', is_flag=True, default=False,
+              help='Build the images even if an image with the same digest '
+                   'is already available. Implied by --no-cache.')
+@click.option('--pull/--no-pull', default=False,
+              help='Try to pull the missing or outdated images from the '
+                   'registry and only build them if the digest of the pulled '
+                   'image differs')
+@click.option('--retries', default=3, type=click.IntRange(min=0),
+              help='Number of retries on transient push failures')
 @click.pass_obj
-def docker_image_build(obj, push, no_cache):
-    """Build and optionally push docker images"""
+def docker_image_build(obj, push, targets, no_cache, jobs, fail_fast, force,
+                       pull, retries):
+    """Build and optionally push docker images
+
+    Images are skipped if they have already been built from the same
+    definition, which is tracked by a digest label on the images.
+    """
     client = obj['client']
     images = obj['images']
 
-    images.build(client=client, nocache=no_cache)
-    if push:
-        images.push(client=client)
+    try:
+        results = images.build(client=client, nocache=no_cache, jobs=jobs,
+                               fail_fast=fail_fast, force=force or no_cache,
+                               pull=pull)
+    except ImageBuildError as e:
+        _echo_summary(e.results)
+        raise click.ClickException(str(e))
+    else:
+        _echo_summary(results)
+
+    if push or targets:
+        try:
+            results = images.push(client=client, targets=targets or None,
+                                  jobs=jobs, retries=retries)
+        except ImagePushError as e:
+            _echo_summary(e.results)
+            raise click.ClickException(str(e))
+        else:
+            _echo_summary(results)
 
 
 @docker.command('write-dockerfiles')
@@ -400,19 +491,19 @@ def docker_write_dockerfiles(obj, directory):
         image.save_dockerfile(directory)
 
 
-def _handle_stdio_log(newlines):
+def _handle_stdio_log(newlines, prefix=''):
     # 'o': 'stdout',
     # 'e': 'stderr',
     # 'h': 'header'
     for l in newlines:
         if l.startswith('h'):
-            click.echo(click.style(l[1:], fg='blue'))
+            click.echo(prefix + click.style(l[1:], fg='blue'))
         elif l.startswith('e'):
-            click.echo(click.style(l[1:], fg='red'))
+            click.echo(prefix + click.style(l[1:], fg='red'))
         elif l.startswith('o'):
-            click.echo(l[1:])
+            click.echo(prefix + l[1:])
         else:
-            click.echo(l)
+            click.echo(prefix + l)
 
 
 def _use_local_sources(builder, sources):
@@ -437,7 +528,7 @@ def _use_local_sources(builder, sources):
 
 
 @project.command('build')
-@click.argument('builder_name', nargs=1)
+@click.argument('builder_names', nargs=-1, required=True)
 @click.option('--repo', '-r', default=None,
               help="Repository to clone, defaults to the Project's repo.")
 @click.option('--branch', '-b', default='master', help='Branch to clone')
@@ -461,13 +552,16 @@ def _use_local_sources(builder, sources):
                    'session in the container. Note that it blocks the event '
                    'loop until the shell is running.')
 @click.pass_obj
-def project_build(obj, builder_name, repo, branch, commit, pull_request,
+def project_build(obj, builder_names, repo, branch, commit, pull_request,
                   properties, sources, attach_on_failure):
     """Reproduce the builds locally
 
     It spins up a a short living, lightweight buildmaster with an inmemory
-    sqlite database and triggers the specified builder. The build step logs
-    are redirected to the console.
+    sqlite database and triggers the specified builders. Builder names can
+    be passed multiple times and can contain glob patterns, the selected
+    builders are triggered concurrently. The build step logs are redirected
+    to the console, prefixed with the builder's name if multiple builders
+    are triggered.
     """
     # force twisted logger to use the cli module's python logger
     observer = PythonLoggingObserver(loggerName=logger.name)
@@ -475,35 +569,42 @@ def project_build(obj, builder_name, repo, branch, commit, pull_request,
 
     config, project = obj['config'], obj['project']
 
-    # check that the triggerable builder exists
-    try:
-        builder = project.builder(name=builder_name)
-    except KeyError:
-        available = '\n'.join(f' - {b.name}' for b in project.builders)
-        raise click.ClickException(
-            f"Project {project.name} doesn't have a builder named "
-            f'`{builder_name}`.\n Select one from the following list: \n'
-            f'{available}'
-        )
-    else:
+    # check that the triggerable builders exist
+    builders = []
+    for pattern in builder_names:
+        if glob.has_magic(pattern):
+            matching = project.select('builders', name=Matching(pattern))
+        else:
+            matching = project.select('builders', name=pattern)
+        if not matching:
+            available = '\n'.join(f' - {b.name}' for b in project.builders)
+            raise click.ClickException(
+                f"Project {project.name} doesn't have a builder matching "
+                f'`{pattern}`.\n Select from the following list: \n'
+                f'{available}'
+            )
+        builders.extend(b for b in matching if b not in builders)
+
+    for builder in builders:
         click.echo(f'Triggering builder: {builder}')
 
     # convert the sources and properties to a plain mapping
     sources = dict(p.split(':') for p in sources)
     properties = dict(p.split('=') for p in properties)
 
-    # if local source directories are passed add them as docker volumes
-    if sources:
-        if not isinstance(builder, DockerBuilder):
-            raise click.UsageError(
-                'Mounting source directories is a feature only available for '
-                'docker builders.'
-            )
-        _use_local_sources(builder, sources)
+    for builder in builders:
+        # if local source directories are passed add them as docker volumes
+        if sources:
+            if not isinstance(builder, DockerBuilder):
+                raise click.UsageError(
+                    'Mounting source directories is a feature only available '
+                    'for docker builders.'
+                )
+            _use_local_sources(builder, sources)
 
-    # update the builder's properties
-    if properties:
-        builder.properties.update(properties)
+        # update the builder's properties
+        if properties:
+            builder.properties.update(properties)
 
     # construct the sourcestamp which will trigger the builders
     if pull_request is not None:
@@ -516,37 +617,63 @@ def project_build(obj, builder_name, repo, branch, commit, pull_request,
         'project': project.name
     }
 
+    def log_handler(lines, builder_name):
+        # prefix the lines only if the logs of multiple builders interleave
+        prefix = f'[{builder_name}] ' if len(builders) > 1 else ''
+        _handle_stdio_log(lines, prefix=prefix)
+
     attach_on = {FAILURE, EXCEPTION} if attach_on_failure else set()
-    result = {'complete': False}
+    results = {}
     try:
         # configure a lightweight master with in-memory database
         master = TestMaster(config, attach_on=attach_on,
-                            log_handler=_handle_stdio_log)
+                            log_handler=log_handler)
     except ConfigErrors as e:
         raise UrsabotConfigErrors(e)
 
+    @ensure_deferred
+    async def build(builder):
+        try:
+            results[builder.name] = await master.build(builder.name,
+                                                       sourcestamp)
+        except Exception:
+            # the builder is reported as incomplete
+            logger.exception(f'Failed to build {builder.name}')
+
     @ensure_deferred
     async def run():
         """Start the master and trigger the requested builders"""
-        nonlocal result
         try:
             async with master:
-                result = await master.build(builder.name, sourcestamp)
+                await defer.DeferredList([build(b) for b in builders],
+                                         consumeErrors=True)
         finally:
             reactor.stop()
 
     reactor.callWhenRunning(run)
     reactor.run()
 
-    if not result['complete']:
-        raise click.ClickException('Build has not completed!')
+    # 'results' refers to the final state of the buildsets
+    rows, failed = [], []
+    for builder in builders:
+        result = results.get(builder.name, {'complete': False})
+        if not result['complete']:
+            state = click.style('incomplete', fg='yellow')
+            failed.append(builder.name)
+        elif result['results'] in (SUCCESS, WARNINGS):
+            state = click.style(Results[result['results']], fg='green')
+        else:
+            state = click.style(Results[result['results']], fg='red')
+            failed.append(builder.name)
+        rows.append((builder.name, state))
 
-    # 'results' refers to the final state of the build
-    state = result['results']
-    if state in (SUCCESS, WARNINGS):
-        click.echo(click.style('Build successful!', fg='green'))
-    else:
-        statestring = Results[state]
+    if len(builders) > 1:
+        click.echo(tabulate(rows, headers=['builder', 'state']))
+
+    if failed:
         raise click.ClickException(
-            f'Build has failed with state {statestring}'
+            f'Build has failed or has not completed for builders: '
+            f'{", ".join(failed)}'
         )
+    else:
+        click.echo(click.style('Build successful!', fg='green'))
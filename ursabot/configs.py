@@ -9,12 +9,10 @@
 # is not marked as such.
 
 import sys
-import operator
 import traceback
 from pathlib import Path
-from functools import reduce
 from contextlib import contextmanager
-from typing import List, Callable, Optional
+from typing import List, Callable, Optional, Union
 
 import toolz
 from twisted.python.compat import execfile
@@ -35,11 +33,12 @@ from buildbot.secrets.providers.base import SecretProviderBase
 from .docker import ImageCollection, DockerImage
 from .hooks import GithubHook
 from .builders import Builder
-from .utils import Filter, Annotable
+from .utils import Annotable, Index, startup_timer
 
 __all__ = [
     'Config',
     'ProjectConfig',
+    'LazyProjectConfig',
     'MasterConfig',
     'InMemoryLoader',
     'FileLoader',
@@ -67,6 +66,9 @@ def collect_global_errors(and_raise=False):
 
 class Config(Annotable):
 
+    # attributes of the list fields' items indexed for Config.select
+    _indexed_keys = {}
+
     @classmethod
     def load_from(cls, path, variable, inject_globals=None):
         loader = FileLoader(path, variable=variable,
@@ -75,6 +77,39 @@ class Config(Annotable):
         assert isinstance(config, cls)
         return config
 
+    def _items(self, field):
+        return getattr(self, field)
+
+    def _index(self, field):
+        items = self._items(field)
+        indexes = self.__dict__.setdefault('_indexes', {})
+        source, index = indexes.get(field, (None, None))
+        # rebuild the index if the list has been replaced or resized
+        if source is not items or len(index.items) != len(items):
+            keys = self._indexed_keys.get(field, ('name',))
+            index = Index(items, keys=keys)
+            indexes[field] = (items, index)
+        return index
+
+    def select(self, field, **criteria):
+        """Select the items of a list field matching the criteria
+
+        The criteria have the same semantics as the ones of Filter. The exact
+        matches on the indexed attributes, like name, tags and platform are
+        looked up from an index built on first use, the rest of the criteria
+        (e.g. globs) are evaluated by scanning the candidates.
+
+        Parameters
+        ----------
+        field: str
+            Name of the list field, e.g. builders, workers or images.
+
+        Returns
+        -------
+        items: list
+        """
+        return self._index(field).select(**criteria)
+
 
 class ProjectConfig(Config):
 
@@ -88,6 +123,14 @@ class ProjectConfig(Config):
     schedulers: List[BaseScheduler] = []
     reporters: List[HttpStatusPushBase] = []
 
+    _indexed_keys = {
+        'builders': ('name', 'tags'),
+        'workers': ('name', 'tags', 'platform.arch', 'platform.system',
+                    'platform.distro'),
+        'images': ('name', 'tag', 'variant', 'platform.arch',
+                   'platform.system', 'platform.distro')
+    }
+
     def builder(self, name):
         """Select one of the builders
 
@@ -100,17 +143,74 @@ class ProjectConfig(Config):
         -------
         builder: Builder
         """
-        criteria = Filter(name=name)
-        filtered = filter(criteria, self.builders)
         try:
-            return toolz.first(filtered)
-        except StopIteration:
+            return self._index('builders').first(name=name)
+        except KeyError:
             raise KeyError(name)
 
 
+class LazyProjectConfig:
+    """Placeholder of a ProjectConfig loaded from file on first access
+
+    Executing a project's configuration file instantiates all of its images
+    and builders, so the commands working with a single project should only
+    pay the price of loading the selected one. The name is required upfront
+    to select the project without loading it. Accessing any other attribute
+    loads the configuration file once then delegates to the loaded
+    ProjectConfig.
+
+    Parameters
+    ----------
+    name: str
+        Name of the project, must match the loaded ProjectConfig's name.
+    path: Union[str, Path]
+        Path to the project's configuration file.
+    variable: str
+        Variable name of the ProjectConfig in the configuration file.
+    inject_globals: dict, default None
+        Global variables passed to the configuration file.
+    """
+
+    def __init__(self, name, path, variable, inject_globals=None):
+        self.name = name
+        self.loader = FileLoader(path, variable=variable,
+                                 inject_globals=inject_globals)
+        self._project = None
+
+    def __repr__(self):
+        state = 'loaded' if self.is_loaded else 'not loaded'
+        return f'<LazyProjectConfig name={self.name} {state}>'
+
+    def __getattr__(self, attr):
+        # only called if the attribute is not defined on the placeholder,
+        # private attributes are not delegated to avoid recursion on copying
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return getattr(self.load(), attr)
+
+    @property
+    def is_loaded(self):
+        return self._project is not None
+
+    def load(self):
+        """Loads the project configuration, only once"""
+        if self._project is None:
+            project = self.loader.load()
+            if not isinstance(project, ProjectConfig):
+                error(f'Variable `{self.loader.variable}` loaded from '
+                      f'{self.loader.path} must be an instance of '
+                      f'ProjectConfig', always_raise=True)
+            if project.name != self.name:
+                error(f'Project loaded from {self.loader.path} is named '
+                      f'`{project.name}` instead of `{self.name}`',
+                      always_raise=True)
+            self._project = project
+        return self._project
+
+
 class MasterConfig(Config):
 
-    projects: List[ProjectConfig]
+    projects: List[Union[ProjectConfig, LazyProjectConfig]]
     title: str = 'Ursabot'
     url: str = 'http://localhost:8100'
     webui_port: int = 8100
@@ -121,6 +221,24 @@ class MasterConfig(Config):
     change_hook: Optional[GithubHook] = None
     secret_providers: List[SecretProviderBase] = []
 
+    _indexed_keys = {
+        'projects': ('name',),
+        **ProjectConfig._indexed_keys
+    }
+
+    # fields aggregated over the projects, the values denote whether to
+    # deduplicate the aggregated items, the properties return copies of the
+    # cached aggregates, so the callers can freely modify them
+    _aggregated = {
+        'images': False,
+        'commands': False,
+        'workers': True,
+        'builders': False,
+        'pollers': False,
+        'schedulers': False,
+        'reporters': False
+    }
+
     def project(self, name):
         """Select one of the projects defined in the MasterConfig
 
@@ -133,19 +251,38 @@ class MasterConfig(Config):
         -------
         project: ProjectConfig
         """
-        criteria = Filter(name=name)
-        filtered = filter(criteria, self.projects)
         try:
-            return toolz.first(filtered)
-        except StopIteration:
+            project = self._index('projects').first(name=name)
+        except KeyError:
             raise KeyError(name)
 
-    def _from_projects(self, key, unique=False):
-        values = (getattr(p, key) for p in self.projects)
-        values = reduce(operator.add, values)
-        if unique:
-            values = toolz.unique(values)
-        return list(values)
+        if isinstance(project, LazyProjectConfig):
+            project = project.load()
+        return project
+
+    def _from_projects(self, key):
+        # the aggregated values are computed once and cached as tuples until
+        # the list of projects changes, the cache keeps references to the
+        # projects so their ids cannot be reused
+        cache = self.__dict__.setdefault('_aggregates', {})
+        projects = cache.get(None, ())
+        if list(map(id, projects)) != list(map(id, self.projects)):
+            cache.clear()
+            cache[None] = tuple(self.projects)
+
+        if key not in cache:
+            values = toolz.concat(getattr(p, key) for p in self.projects)
+            if self._aggregated[key]:
+                values = toolz.unique(values)
+            cache[key] = tuple(values)
+
+        return cache[key]
+
+    def _items(self, field):
+        # index the cached aggregates instead of their copies
+        if field in self._aggregated:
+            return self._from_projects(field)
+        return super()._items(field)
 
     @property
     def images(self):
@@ -153,27 +290,27 @@ class MasterConfig(Config):
 
     @property
     def commands(self):
-        return self._from_projects('commands')
+        return list(self._from_projects('commands'))
 
     @property
     def workers(self):
-        return self._from_projects('workers', unique=True)
+        return list(self._from_projects('workers'))
 
     @property
     def builders(self):
-        return self._from_projects('builders')
+        return list(self._from_projects('builders'))
 
     @property
     def pollers(self):
-        return self._from_projects('pollers')
+        return list(self._from_projects('pollers'))
 
     @property
     def schedulers(self):
-        return self._from_projects('schedulers')
+        return list(self._from_projects('schedulers'))
 
     @property
     def reporters(self):
-        return self._from_projects('reporters')
+        return list(self._from_projects('reporters'))
 
     def as_testing(self, source):
         builder_configs = [b.as_config() for b in self.builders]
@@ -188,6 +325,7 @@ class MasterConfig(Config):
         return BuildbotMasterConfig.loadFromDict(buildbot_config_dict,
                                                  filename=source)
 
+    @startup_timer.timed('as_buildbot conversion')
     def as_buildbot(self, source):
         """Returns with the buildbot compatible buildmaster configuration"""
 
@@ -254,6 +392,7 @@ class FileLoader(ComparableMixin):
         self.variable = variable
         self.inject_globals = inject_globals or {}
 
+    @startup_timer.timed('config exec')
     def load(self):
         # License note:
         #     It is a reimplementation based on the original
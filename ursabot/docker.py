@@ -5,6 +5,8 @@
 # license that can be found in the LICENSE_BSD file.
 
 import json
+import time
+import hashlib
 import logging
 import collections
 from pathlib import Path
@@ -12,10 +14,14 @@ from functools import wraps
 from operator import methodcaller
 from textwrap import indent, dedent
 from contextlib import contextmanager
+from concurrent.futures import (ThreadPoolExecutor, FIRST_COMPLETED, wait,
+                                as_completed)
 
-from toposort import toposort
+from docker.errors import APIError, NotFound
+from requests.exceptions import ConnectionError
 from dockermap.api import DockerFile, DockerClientWrapper
 from dockermap.shortcuts import mkdir
+from dockermap.exceptions import DockerStatusError
 from dockermap.build.dockerfile import format_command
 
 from .utils import Platform, Filter
@@ -24,6 +30,8 @@ __all__ = [
     'DockerFile',
     'DockerImage',
     'ImageCollection',
+    'ImageBuildError',
+    'ImagePushError',
     'worker_image_for',
     'ADD',
     'COPY',
@@ -44,6 +52,9 @@ __all__ = [
 
 logger = logging.getLogger(__name__)
 
+# label of the built images storing the digest of the image's definition
+_digest_label = 'org.ursalabs.ursabot.digest'
+
 
 class DockerClientWrapper(DockerClientWrapper):
 
@@ -53,12 +64,37 @@ class DockerClientWrapper(DockerClientWrapper):
     def __exit__(self, exc_type, exc_value, tb):
         self.close()
 
+    def push_progress(self, status, object_id, progress):
+        # called for each status line of the streamed layer uploads, the
+        # progress bars are only interesting for debugging
+        if progress:
+            logger.debug(f'Layer {object_id}: {status} {progress}')
+        else:
+            logger.info(f'Layer {object_id}: {status}')
+
 
 class DockerFile(DockerFile):
 
     def __str__(self):
         return self.fileobj.getvalue().decode('utf-8')
 
+    def context_files(self):
+        """Yields the files added to the build context in a stable order
+
+        Returns pairs of (context path, local path), directories added to the
+        context are expanded to the files they contain.
+        """
+        sources = list(self._files)
+        sources += [(a, Path(a).name) for a in self._archives]
+        for source, context in sources:
+            source = Path(source)
+            if source.is_dir():
+                for path in sorted(source.rglob('*')):
+                    if path.is_file():
+                        yield (f'{context}/{path.relative_to(source)}', path)
+            else:
+                yield (context, source)
+
 
 class DockerImage:
     """Docker image abstraction for image hierarchies with strict naming
@@ -121,7 +157,7 @@ class DockerImage:
     """
 
     __slots__ = ('name', 'title', 'base', 'tag', 'org', 'platform', 'variant',
-                 'steps')
+                 'steps', '_dockerfile', '_digest')
 
     def __init__(self, name, base, title=None, org=None, tag='latest',
                  platform=None, variant=None, steps=tuple()):
@@ -174,6 +210,11 @@ class DockerImage:
         self.variant = variant
         self.steps = tuple(steps)
 
+        # the image definition is immutable, so the dockerfile and the digest
+        # are lazily computed once, see the properties below
+        self._dockerfile = None
+        self._digest = None
+
     def __str__(self):
         return self.fqn
 
@@ -200,17 +241,41 @@ class DockerImage:
 
     @property
     def dockerfile(self):
-        # self.base is either a string or a DockerImage instance
-        df = DockerFile(str(self.base))
-        for callback in self.steps:
-            callback(df)
-        df.finalize()
-        return df
+        # the returned dockerfile is finalized, so it cannot be modified
+        if self._dockerfile is None:
+            # self.base is either a string or a DockerImage instance
+            df = DockerFile(str(self.base))
+            for callback in self.steps:
+                callback(df)
+            df.finalize()
+            self._dockerfile = df
+        return self._dockerfile
 
     @property
     def workdir(self):
         return self.dockerfile.command_workdir
 
+    @property
+    def digest(self):
+        """Content digest of the image's definition
+
+        Covers the rendered Dockerfile, the contents of the files added to the
+        build context and the digest of the parent image. Images built on top
+        of an image pulled from a registry only include its name.
+        The digest is computed once, on the first access.
+        """
+        if self._digest is None:
+            dockerfile = self.dockerfile
+            digest = hashlib.sha256()
+            if isinstance(self.base, DockerImage):
+                digest.update(self.base.digest.encode('utf-8'))
+            digest.update(str(dockerfile).encode('utf-8'))
+            for context, path in dockerfile.context_files():
+                digest.update(context.encode('utf-8'))
+                digest.update(path.read_bytes())
+            self._digest = digest.hexdigest()
+        return self._digest
+
     def save_dockerfile(self, directory):
         path = Path(directory) / f'{self.repo}.{self.tag}.dockerfile'
         self.dockerfile.save(path)
@@ -223,9 +288,46 @@ class DockerImage:
         else:
             yield client
 
+    def _built_digest(self, client):
+        try:
+            info = client.inspect_image(self.fqn)
+        except APIError:
+            return None
+        labels = info['Config'].get('Labels') or {}
+        return labels.get(_digest_label)
+
+    def is_up_to_date(self, client=None, pull=False):
+        """Whether the image has already been built from the same definition
+
+        Compares the digest of the image with the one stored as a label on
+        the local image.
+
+        Parameters
+        ----------
+        client : dockermap.api.DockerClientWrapper, default None
+            Docker client to inspect the images with.
+        pull : bool, default False
+            If the local image is missing or outdated then try to pull it from
+            the registry and compare the digest of the pulled image.
+        """
+        digest = self.digest
+        with self._client(client) as client:
+            if self._built_digest(client) == digest:
+                return True
+            if pull:
+                try:
+                    client.pull(self.fqn)
+                except (APIError, DockerStatusError):
+                    logger.info(f'Failed to pull {self.fqn} from the registry')
+                    return False
+                return self._built_digest(client) == digest
+        return False
+
     def build(self, client=None, **kwargs):
         """Build the docker images
 
+        The image's digest is stored as a label on the built image.
+
         Parameters
         ----------
         client : dockermap.api.DockerClientWrapper, default None
@@ -233,18 +335,71 @@ class DockerImage:
             used to build images on another host.
         """
         logger.info(f'Start building {self.fqn}')
+        labels = {**kwargs.pop('labels', {}), _digest_label: self.digest}
         with self._client(client) as client:
-            client.build_from_file(self.dockerfile, self.fqn, **kwargs)
+            client.build_from_file(self.dockerfile, self.fqn, labels=labels,
+                                   **kwargs)
         logger.info(f'Image has been built successfully: {self.fqn}')
 
         return self
 
-    def push(self, client=None, **kwargs):
+    def _target_fqn(self, target=None):
+        if target is None:
+            return self.fqn
+        else:
+            return f'{target}/{self.repo}:{self.tag}'
+
+    def push(self, client=None, target=None, **kwargs):
+        """Push the docker image
+
+        Parameters
+        ----------
+        client : dockermap.api.DockerClientWrapper, default None
+            Docker client to push the image with.
+        target : str, default None
+            Registry and/or organization to push the image to, for example
+            `quay.io/ursalabs`. The image gets tagged accordingly before
+            pushing. By default the image is pushed under its own name.
+        """
+        fqn = self._target_fqn(target)
+        logger.info(f'Start pushing {fqn}')
         with self._client(client) as client:
-            client.push(self.fqn, **kwargs)
+            if target is not None:
+                repository, tag = fqn.rsplit(':', 1)
+                client.tag(self.fqn, repository, tag=tag)
+            client.push(fqn, stream=True, **kwargs)
+        logger.info(f'Image has been pushed successfully: {fqn}')
+
         return self
 
 
+# outcome of building or pushing a single image
+ImageResult = collections.namedtuple(
+    'ImageResult', ['image', 'fqn', 'state', 'elapsed', 'error']
+)
+
+
+class ImageBuildError(Exception):
+
+    def __init__(self, results):
+        self.results = results
+        failed = ', '.join(r.fqn for r in results if r.error)
+        super().__init__(f'Failed to build the following images: {failed}')
+
+
+class ImagePushError(Exception):
+
+    def __init__(self, results):
+        self.results = results
+        failed = ', '.join(r.fqn for r in results if r.error)
+        super().__init__(f'Failed to push the following images: {failed}')
+
+
+# errors worth retrying the push for, like registry hiccups or dropped
+# connections during the layer uploads
+_transient_errors = (APIError, DockerStatusError, ConnectionError)
+
+
 class ImageCollection(list):
 
     def _image_dependents(self):
@@ -267,17 +422,196 @@ class ImageCollection(list):
                     stack.append(image.base)
         return deps
 
-    def build(self, *args, **kwargs):
+    @staticmethod
+    def _build_image(image, client=None, force=False, pull=False, **kwargs):
+        start = time.monotonic()
+        try:
+            if not force and image.is_up_to_date(client, pull=pull):
+                logger.info(f'Image {image.fqn} is up to date, skipping')
+                return ImageResult(image, image.fqn, 'unchanged',
+                                   time.monotonic() - start, None)
+            image.build(client=client, **kwargs)
+        except Exception as e:
+            logger.error(f'Failed to build image {image.fqn}: {e}')
+            return ImageResult(image, image.fqn, 'failure',
+                               time.monotonic() - start, e)
+        else:
+            return ImageResult(image, image.fqn, 'success',
+                               time.monotonic() - start, None)
+
+    def build(self, client=None, jobs=1, fail_fast=True, force=False,
+              pull=False, **kwargs):
+        """Build the images including their parents
+
+        An image is scheduled for building as soon as its base image is
+        built, so the independent branches of the image hierarchy are built
+        concurrently. Images already built from the same definition are
+        skipped, see DockerImage.digest.
+
+        Parameters
+        ----------
+        client : dockermap.api.DockerClientWrapper, default None
+            Docker client to build the images with.
+        jobs : int, default 1
+            Number of images to build in parallel.
+        fail_fast : bool, default True
+            Don't start new builds after the first failure. Otherwise keep
+            building the images which don't depend on the failed ones.
+        force : bool, default False
+            Build the images even if they are up to date.
+        pull : bool, default False
+            Try to pull the outdated images from the registry before building
+            them, the pulled image is used if its digest matches.
+
+        Returns
+        -------
+        results : List[ImageResult]
+            State and wall-clock time of each image build, in the order of
+            completion. Images depending on failed ones, or not started
+            because of an earlier failure in fail fast mode, are skipped.
+
+        Raises
+        ------
+        ImageBuildError
+            If any of the images has failed to build.
+        """
         deps = self._image_dependents()
-        for image_set in toposort(deps):
-            # TODO(kszucs): this can be easily parallelized with dask
-            for image in image_set:
-                image.build(*args, **kwargs)
-
-    def push(self, *args, **kwargs):
-        # topological sort is not required because the layers are cached
-        for image in self:
-            image.push(*args, **kwargs)
+        children = collections.defaultdict(list)
+        for image, parents in deps.items():
+            for parent in parents:
+                children[parent].append(image)
+
+        results = collections.OrderedDict()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            def submit(image):
+                return executor.submit(self._build_image, image,
+                                       client=client, force=force, pull=pull,
+                                       **kwargs)
+
+            ready = collections.deque(
+                image for image, parents in deps.items() if not parents
+            )
+            pending = set()
+            failed = False
+
+            while ready or pending:
+                # submit only as many builds as the executor runs at once, so
+                # no new build is started after a failure in fail fast mode
+                while ready and len(pending) < jobs:
+                    if failed and fail_fast:
+                        break
+                    pending.add(submit(ready.popleft()))
+                if not pending:
+                    break
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.cancelled():
+                        continue
+                    result = future.result()
+                    results[result.image] = result
+                    if result.error is not None:
+                        failed = True
+                        if fail_fast:
+                            for other in pending:
+                                other.cancel()
+                    elif not (failed and fail_fast):
+                        ready.extend(children[result.image])
+
+        for image in deps:
+            if image not in results:
+                results[image] = ImageResult(image, image.fqn, 'skipped', 0,
+                                             None)
+
+        results = list(results.values())
+        if failed:
+            raise ImageBuildError(results)
+
+        return results
+
+    @staticmethod
+    def _push_image(image, target=None, retries=0, backoff=1, **kwargs):
+        fqn = image._target_fqn(target)
+        start = time.monotonic()
+        for attempt in range(retries + 1):
+            try:
+                image.push(target=target, **kwargs)
+            except NotFound as e:
+                # the image hasn't been built
+                error = e
+                break
+            except _transient_errors as e:
+                error = e
+                if attempt < retries:
+                    delay = backoff * 2 ** attempt
+                    logger.warning(f'Failed to push {fqn}: {e}, retrying in '
+                                   f'{delay} seconds')
+                    time.sleep(delay)
+            except Exception as e:
+                error = e
+                break
+            else:
+                return ImageResult(image, fqn, 'success',
+                                   time.monotonic() - start, None)
+
+        logger.error(f'Failed to push image {fqn}: {error}')
+        return ImageResult(image, fqn, 'failure', time.monotonic() - start,
+                           error)
+
+    def push(self, client=None, targets=None, jobs=1, retries=3, backoff=5,
+             **kwargs):
+        """Push the images concurrently
+
+        Topological sort is not required because the layers are cached, so
+        every image is pushed independently sharing the same docker client.
+
+        Parameters
+        ----------
+        client : dockermap.api.DockerClientWrapper, default None
+            Docker client to push the images with.
+        targets : List[str], default None
+            Registries and/or organizations to push each image to, see
+            DockerImage.push. By default the images are pushed under their
+            own names.
+        jobs : int, default 1
+            Number of images to push in parallel.
+        retries : int, default 3
+            Number of retries on transient failures.
+        backoff : float, default 5
+            Seconds to wait before the first retry, doubled for each
+            subsequent retry.
+
+        Returns
+        -------
+        results : List[ImageResult]
+            State and wall-clock time of each push in the order of
+            completion.
+
+        Raises
+        ------
+        ImagePushError
+            If any of the images has failed to push.
+        """
+        if client is None:
+            with DockerClientWrapper() as client:
+                return self.push(client=client, targets=targets, jobs=jobs,
+                                 retries=retries, backoff=backoff, **kwargs)
+
+        targets = targets or [None]
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(self._push_image, image, target=target,
+                                retries=retries, backoff=backoff,
+                                client=client, **kwargs)
+                for image in self
+                for target in targets
+            ]
+            results = [f.result() for f in as_completed(futures)]
+
+        if any(r.error is not None for r in results):
+            raise ImagePushError(results)
+
+        return results
 
     def filter(self, **kwargs):
         criteria = Filter(**kwargs)
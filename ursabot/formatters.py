@@ -5,18 +5,93 @@
 # license that can be found in the LICENSE_BSD file.
 
 import textwrap
+import collections
 
 import toolz
 from buildbot.util.logger import Logger
 from buildbot.reporters import utils
 from buildbot.process.results import Results, FAILURE, EXCEPTION
 
-__all__ = ['Formatter', 'MarkdownFormatter']
+__all__ = ['Formatter', 'MarkdownFormatter', 'LogExcerpt']
 
 
 log = Logger()
 
 
+class LogExcerpt:
+    """Bounded excerpt of a log consisting of its first and last lines
+
+    The lines are appended one by one, only the first `head` and the last
+    `tail` lines are kept within `max_bytes` of UTF-8 encoded text. The lines
+    in between are replaced with a marker holding the number of omitted lines.
+
+    Parameters
+    ----------
+    head : int, default 10
+        Number of leading lines to keep.
+    tail : int, default 100
+        Number of trailing lines to keep.
+    max_bytes : int, default 16384
+        Size limit of the kept lines, the head can use at most the half of it.
+    """
+
+    def __init__(self, head=10, tail=100, max_bytes=16384):
+        self.head = head
+        self.tail = tail
+        self.max_bytes = max_bytes
+        self.omitted = 0
+        self._head = []
+        self._head_bytes = 0
+        self._head_closed = False
+        self._tail = collections.deque()
+        self._tail_bytes = 0
+
+    @staticmethod
+    def _truncate(line, limit):
+        encoded = line.encode('utf-8')
+        if len(encoded) <= limit:
+            return line, len(encoded)
+        line = encoded[:max(limit - 3, 0)].decode('utf-8', errors='ignore')
+        line += '...'
+        return line, len(line.encode('utf-8'))
+
+    def append(self, line):
+        head_limit = self.max_bytes // 2 if self.tail else self.max_bytes
+        if not self._head_closed:
+            truncated, size = self._truncate(line, head_limit - 1)
+            fits = self._head_bytes + size + 1 <= head_limit
+            if len(self._head) < self.head and fits:
+                self._head.append(truncated)
+                self._head_bytes += size + 1
+                return
+            # keep the head contiguous
+            self._head_closed = True
+
+        tail_limit = self.max_bytes - self._head_bytes
+        line, size = self._truncate(line, tail_limit - 1)
+        self._tail.append((line, size + 1))
+        self._tail_bytes += size + 1
+        while self._tail and (len(self._tail) > self.tail or
+                              self._tail_bytes > tail_limit):
+            _, size = self._tail.popleft()
+            self._tail_bytes -= size
+            self.omitted += 1
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    def lines(self):
+        lines = list(self._head)
+        if self.omitted:
+            lines.append(f'... {self.omitted} lines omitted ...')
+        lines.extend(line for line, _ in self._tail)
+        return lines
+
+    def __str__(self):
+        return '\n'.join(self.lines())
+
+
 class Formatter:
     """Base class to render arbitrary formatted/templated messages
 
@@ -31,6 +106,15 @@ class Formatter:
     layout = '{message}'
     context = {}
 
+    # number of log lines fetched at once from the data API
+    log_chunk_lines = 1000
+
+    # logs needed to render the builds, in the form of
+    # {build state: {log name: results of the steps}}, the reporters query
+    # the steps only for the states listed here, and only the logs of the
+    # steps with the listed results are extracted
+    needed_logs = {}
+
     def __init__(self, layout=None, context=None):
         layout = layout or self.layout  # class' default
         if isinstance(layout, str):
@@ -55,7 +139,40 @@ class Formatter:
         }
         return toolz.merge(context, self.context)
 
-    def extract_logs(self, build, logname):
+    def logs_needed(self, build):
+        """Returns the {log name: step results} needed to render the build"""
+        state = Results[build['results']] if build['complete'] else 'started'
+        return self.needed_logs.get(state, {})
+
+    async def extract_logs(self, build, logname, master=None):
+        """Iterates over the logs named `logname` of the build's steps
+
+        Yields (step, lines) tuples, where lines is an asynchronous iterator
+        of (stream, line) tuples. The log content is streamed in chunks of
+        `log_chunk_lines` from the data API unless it has been already fetched
+        along with the build details, so the whole log is never held in
+        memory. The steps and their logs are also queried lazily if the build
+        details don't contain them. If the log is declared in `needed_logs`
+        then only the steps with the declared results are considered.
+        """
+        if 'steps' not in build:
+            build['steps'] = list(
+                await master.data.get(('builds', build['buildid'], 'steps'))
+            )
+
+        results = self.logs_needed(build).get(logname)
+        for step in build['steps']:
+            if results is not None and step['results'] not in results:
+                continue
+            if 'logs' not in step:
+                step['logs'] = list(
+                    await master.data.get(('steps', step['stepid'], 'logs'))
+                )
+            for l in step['logs']:
+                if l['name'] == logname:
+                    yield (step, self._stream_log(l, master))
+
+    async def _stream_log(self, log, master=None):
         # stream type prefixes each line with the stream's abbreviation:
         _stream_prefixes = {
             'o': 'stdout',
@@ -72,24 +189,30 @@ class Formatter:
         def _text(line):
             return ('text', line)
 
-        for s in build['steps']:
-            for l in s['logs']:
-                if l['name'] == logname:
-                    typ = l['type']
-
-                    if typ == 'h':  # HTML
-                        extractor = _html
-                    elif typ == 't':  # text
-                        extractor = _text
-                    elif typ == 's':  # stream
-                        extractor = _stream
-                    else:
-                        raise ValueError(f'Unknown log type: `{typ}`')
-
-                    content = l['content']['content']
-                    lines = (extractor(l) for l in content.splitlines())
-
-                    yield (s, lines)
+        typ = log['type']
+        if typ == 'h':  # HTML
+            extractor = _html
+        elif typ == 't':  # text
+            extractor = _text
+        elif typ == 's':  # stream
+            extractor = _stream
+        else:
+            raise ValueError(f'Unknown log type: `{typ}`')
+
+        if 'content' in log:
+            # already fetched with the build's details
+            for line in log['content']['content'].splitlines():
+                yield extractor(line)
+            return
+
+        path = ('logs', log['logid'], 'contents')
+        for offset in range(0, log['num_lines'], self.log_chunk_lines):
+            chunk = await master.data.get(path, offset=offset,
+                                          limit=self.log_chunk_lines)
+            if chunk is None:
+                break
+            for line in chunk['content'].splitlines():
+                yield extractor(line)
 
     async def render(self, build, master=None):
         """Dispatches and renders the layout based on the build's results.
@@ -145,6 +268,12 @@ class Formatter:
 
 
 class MarkdownFormatter(Formatter):
+    """Renders markdown messages including the errors of the failing steps
+
+    Only an excerpt of the stderr and the traceback logs is rendered, see
+    `LogExcerpt` for the meaning of the `log_head`, `log_tail` and
+    `log_max_bytes` limits, which are applied to each failing step.
+    """
 
     layout = textwrap.dedent("""
         [{builder_name} (#{build_id})]({build_url}) builder {status}.
@@ -154,6 +283,22 @@ class MarkdownFormatter(Formatter):
         {context}
     """)
 
+    needed_logs = {
+        'failure': {'stdio': {FAILURE}},
+        'exception': {'err.text': {EXCEPTION}}
+    }
+
+    def __init__(self, *args, log_head=10, log_tail=100, log_max_bytes=16384,
+                 **kwargs):
+        self.log_head = log_head
+        self.log_tail = log_tail
+        self.log_max_bytes = log_max_bytes
+        super().__init__(*args, **kwargs)
+
+    def excerpt(self):
+        return LogExcerpt(head=self.log_head, tail=self.log_tail,
+                          max_bytes=self.log_max_bytes)
+
     async def render_failure(self, build, master):
         template = textwrap.dedent("""
             {step_name}: `{state_string}` step's stderr:
@@ -164,14 +309,18 @@ class MarkdownFormatter(Formatter):
 
         # extract stderr from logs named `stdio` from failing steps
         errors = []
-        for step, log_lines in self.extract_logs(build, logname='stdio'):
+        logs = self.extract_logs(build, logname='stdio', master=master)
+        async for step, log_lines in logs:
             if step['results'] == FAILURE:
-                stderr = (l for stream, l in log_lines if stream == 'stderr')
+                stderr = self.excerpt()
+                async for stream, line in log_lines:
+                    if stream == 'stderr':
+                        stderr.append(line)
                 errors.append(
                     template.format(
                         step_name=step['name'],
                         state_string=step['state_string'],
-                        stderr='\n'.join(stderr)
+                        stderr=stderr
                     )
                 )
 
@@ -188,14 +337,17 @@ class MarkdownFormatter(Formatter):
         # steps failed with an exception usually have a log named 'err.text',
         # which contains a HTML formatted stack traceback.
         errors = []
-        for step, log_lines in self.extract_logs(build, logname='err.text'):
+        logs = self.extract_logs(build, logname='err.text', master=master)
+        async for step, log_lines in logs:
             if step['results'] == EXCEPTION:
-                traceback = (l for _, l in log_lines)
+                traceback = self.excerpt()
+                async for _, line in log_lines:
+                    traceback.append(line)
                 errors.append(
                     template.format(
                         step_name=step['name'],
                         state_string=step['state_string'],
-                        traceback='\n'.join(traceback)
+                        traceback=traceback
                     )
                 )
 
@@ -4,20 +4,47 @@
 # Use of this source code is governed by a BSD 2-Clause
 # license that can be found in the LICENSE_BSD file.
 
-from urllib.parse import urlparse
+import re
+import time
+import collections
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
 from dateutil.parser import parse as dateparse
 
+from twisted.internet import defer
+from buildbot.util import bytes2unicode, datetime2epoch, service
 from buildbot.util.logger import Logger
-from buildbot.www.hooks.github import GitHubEventHandler
+from buildbot.www.hooks.github import GitHubEventHandler, _HEADER_EVENT
 from buildbot.process.properties import Properties
 
-from .utils import ensure_deferred, GithubClientService
+from .utils import (ensure_deferred, GithubClientService, IdleWaiters,
+                    SqliteQueue)
 from .commands import CommandError
 
 __all__ = ['GithubHook', 'UrsabotHook']
 
 log = Logger()
 
+_HEADER_DELIVERY = b'X-GitHub-Delivery'
+
+
+class _QueueService(service.AsyncService):
+    """Stops the queue workers of a GithubHook along with the master
+
+    The change hook handlers are not services, so the hook attaches one of
+    these to the master when it starts its queue workers.
+    """
+
+    def __init__(self, hook, queue):
+        self.hook = hook
+        self.queue = queue
+        self.setName(f'{hook.__class__.__name__}-queue-{hook.queue_path}')
+
+    @ensure_deferred
+    async def stopService(self):
+        await self.hook._stop_queue(self.queue)
+        await defer.maybeDeferred(super().stopService)
+
 
 class GithubHook(GitHubEventHandler):
     """Converts github events to changes
@@ -78,6 +105,22 @@ class GithubHook(GitHubEventHandler):
     # otherwise should return a dictionary of properties
     comment_handler = None
 
+    # the pull request files are listed in pages, github's own limit is 3000
+    # files for this endpoint
+    files_per_page = 100
+    max_pull_request_files = 3000
+    # number of pull request heads to remember the affected files for
+    files_cache_size = 128
+
+    # if a path is set then the webhook payloads are stored in a durable queue
+    # and acknowledged immediately, a pool of background workers turns them
+    # into changes; the redeliveries are deduplicated by their delivery id
+    queue_path = None
+    queue_size = 1000
+    queue_workers = 4
+    queue_max_attempts = 3
+    queue_retry_delay = 30
+
     def __init__(self, *args, tokens=None, token=None,
                  github_property_whitelist=None, **kwargs):
         # only `token` argument is passed to the event handler, a plugin is
@@ -105,6 +148,17 @@ class GithubHook(GitHubEventHandler):
         # the http client service is initialized on the first use
         self._http = None
 
+        # the affected files keyed by (repo, number, head sha) and the
+        # callers waiting for an in-flight listing of the same head
+        self._files_cache = collections.OrderedDict()
+        self._files_waiters = {}
+
+        # the queue and its workers are started on the first queued payload
+        # and stopped along with the master
+        self._queue = None
+        self._idle_workers = None
+        self._workers = []
+
         super().__init__(*args, **kwargs)
 
     def _as_hook_dialect_config(self):
@@ -146,21 +200,184 @@ class GithubHook(GitHubEventHandler):
         )
         return self._http
 
-    async def _get(self, url, headers=None):
+    async def _get(self, url, headers=None, params=None):
+        result, _ = await self._get_with_links(url, headers=headers,
+                                               params=params)
+        return result
+
+    async def _get_with_links(self, url, headers=None, params=None):
+        """Returns the result and the parsed Link header of the response"""
         url = urlparse(url)
         client = await self._client()
-        response = await client.get(url.path, headers=headers)
+        start = time.monotonic()
+        response = await client.get(url.path, headers=headers, params=params)
         result = await response.json()
-        return result
+        elapsed = time.monotonic() - start
+        log.info(f'GET {url.path} took {elapsed:.3f}s')
+
+        links = response.headers.getRawHeaders('Link') or []
+        return result, self._parse_links(', '.join(links))
+
+    _link_pattern = re.compile(r'<([^>]+)>;\s*rel="(\w+)"')
+
+    @classmethod
+    def _parse_links(cls, header):
+        # maps the relation types of the link header to page numbers, e.g.
+        # <...?per_page=100&page=2>; rel="next", <...&page=5>; rel="last"
+        links = {}
+        for url, rel in cls._link_pattern.findall(header):
+            query = parse_qs(urlparse(url).query)
+            if 'page' in query:
+                links[rel] = int(query['page'][0])
+        return links
 
     async def _post(self, url, data, headers=None):
         url = urlparse(url)
         client = await self._client()
+        start = time.monotonic()
         response = await client.post(url.path, json=data, headers=headers)
         result = await response.json()
+        elapsed = time.monotonic() - start
+        log.info(f'POST {url.path} took {elapsed:.3f}s')
         log.info(f'POST to {url} with the following result: {result}')
         return result
 
+    def _now(self):
+        return self.master.reactor.seconds()
+
+    @ensure_deferred
+    async def process(self, request):
+        if self.queue_path is None:
+            return await super().process(request)
+
+        # validates the signature before accepting the payload
+        payload = await self._get_payload(request)
+        event = bytes2unicode(request.getHeader(_HEADER_EVENT))
+        if getattr(self, f'handle_{event}', None) is None:
+            raise ValueError(f'Unknown event: {event}')
+
+        delivery = request.getHeader(_HEADER_DELIVERY)
+        if delivery is not None:
+            delivery = bytes2unicode(delivery)
+
+        item = {'event': event, 'payload': payload}
+        if self._get_queue().put(delivery, item, now=self._now()):
+            self._idle_workers.wake()
+        else:
+            log.info(f'Ignoring the redelivered GitHub event {delivery}')
+
+        return [], 'git'
+
+    def _get_queue(self):
+        if self._queue is None:
+            queue = self._queue = SqliteQueue(self.queue_path,
+                                              maxsize=self.queue_size)
+            self._idle_workers = IdleWaiters(self.master.reactor)
+            self._workers = [defer.ensureDeferred(self._work(queue))
+                             for _ in range(self.queue_workers)]
+
+            # the workers of a previous handler of the same queue, e.g.
+            # created before a reconfiguration, are stopped
+            queue_service = _QueueService(self, queue)
+            previous = self.master.namedServices.get(queue_service.name)
+            if previous is not None:
+                d = previous.disownServiceParent()
+                d.addErrback(lambda f: log.failure(
+                    'Failed to stop the previous GitHub event queue',
+                    failure=f
+                ))
+            queue_service.setServiceParent(self.master)
+        return self._queue
+
+    async def _stop_queue(self, queue):
+        """Stops the workers and closes the queue
+
+        The workers finish their current payloads, the pending ones are
+        processed after a restart.
+        """
+        if self._queue is not queue:
+            return
+        self._queue = None
+        self._idle_workers.wake_all()
+        await defer.DeferredList(self._workers)
+        queue.close()
+
+    async def _work(self, queue):
+        while self._queue is queue:
+            try:
+                entry = queue.get(now=self._now())
+                if entry is None:
+                    # wait for a new payload or for the retry delay of the
+                    # failed ones
+                    await self._idle_workers.wait(self.queue_retry_delay)
+                else:
+                    await self._process_entry(queue, *entry)
+            except Exception as e:
+                if self._queue is not queue:
+                    break
+                # keep the worker alive, e.g. if the database is locked
+                log.error(f'Failed to process the queued GitHub events: {e}')
+                await self._idle_workers.wait(self.queue_retry_delay)
+
+    async def _process_entry(self, queue, rowid, item, attempts):
+        event = item['event']
+        try:
+            await self._process_queued(queue, rowid, item)
+        except Exception as e:
+            if attempts + 1 < self.queue_max_attempts:
+                log.error(f'Failed to process the queued {event} event, '
+                          f'retrying: {e}')
+                queue.nack(rowid, delay=self.queue_retry_delay,
+                           now=self._now())
+            else:
+                log.error(f'Failed to process the queued {event} event, '
+                          f'dropping it: {e}')
+                queue.ack(rowid)
+        else:
+            queue.ack(rowid)
+
+    async def _process_queued(self, queue, rowid, item):
+        # License note:
+        #    the change submission is copied from the original buildbot
+        #    implementation of the www change hook resource
+
+        # the handlers may have side effects, e.g. handle_issue_comment
+        # responds to the comment, so once a handler has succeeded its
+        # changes are stored in the queue along with the number of the
+        # already added ones, then a retry adds only the remaining changes
+        if 'changes' not in item:
+            event = item['event']
+            handler = getattr(self, f'handle_{event}')
+            changes, src = await defer.maybeDeferred(handler, item['payload'],
+                                                     event)
+            for change in changes:
+                when_timestamp = change.get('when_timestamp')
+                if isinstance(when_timestamp, datetime):
+                    change['when_timestamp'] = datetime2epoch(when_timestamp)
+            item = dict(item, changes=changes, src=src, added=0)
+            queue.update(rowid, item)
+
+        changes = item['changes']
+        while item['added'] < len(changes):
+            change = changes[item['added']]
+            changeid = await self.master.data.updates.addChange(
+                src=item['src'], **change
+            )
+            log.info(f'Injected change {changeid}')
+            item['added'] += 1
+            queue.update(rowid, item)
+
+    def _concurrently(self, *coros):
+        # issue the independent API calls concurrently, the webhook must
+        # respond within github's delivery timeout
+        deferreds = map(defer.ensureDeferred, coros)
+        return defer.gatherResults(list(deferreds), consumeErrors=True)
+
+    def _discard(self, deferred):
+        # the result of a concurrently issued call is not needed anymore, but
+        # let it finish since others might wait for the same result
+        deferred.addErrback(lambda failure: None)
+
     async def _get_commit_msg(self, repo, sha):
         """Queries the commit message from the API
 
@@ -175,22 +392,81 @@ class GithubHook(GitHubEventHandler):
         commit = result.get('commit', {})
         return commit.get('message', 'No message field')
 
-    async def _get_pull_request_files(self, repo, number):
+    async def _get_pull_request_files(self, repo, number, sha=None):
         """Queries the files affected by a pull request
 
         Returns the affected files, no matter whether the file was added,
-        removed or changed.
+        removed or changed. If the head commit's sha is passed then the
+        result is cached and the concurrent queries of the same head are
+        deduplicated.
         """
+        if sha is None:
+            return await self._list_pull_request_files(repo, number)
+
+        key = (repo, number, sha)
+        if key in self._files_cache:
+            self._files_cache.move_to_end(key)
+            return list(self._files_cache[key])
+        elif key in self._files_waiters:
+            waiter = defer.Deferred()
+            self._files_waiters[key].append(waiter)
+            return await waiter
+
+        waiters = self._files_waiters[key] = []
+        try:
+            files = await self._list_pull_request_files(repo, number)
+        except Exception:
+            del self._files_waiters[key]
+            for waiter in waiters:
+                waiter.errback()
+            raise
+
+        del self._files_waiters[key]
+        self._files_cache[key] = list(files)
+        if len(self._files_cache) > self.files_cache_size:
+            self._files_cache.popitem(last=False)
+        for waiter in waiters:
+            waiter.callback(list(files))
+        return files
+
+    async def _list_pull_request_files(self, repo, number):
+        # the first page tells the number of pages through the link header,
+        # the rest of the pages are requested concurrently
         url = f'/repos/{repo}/pulls/{number}/files'
-        result = await self._get(url) or []
-        return [file['filename'] for file in result]
+        per_page = self.files_per_page
+        max_pages = -(-self.max_pull_request_files // per_page)
+
+        def page(n):
+            return self._get_with_links(
+                url, params={'per_page': per_page, 'page': n}
+            )
+
+        result, links = await page(1)
+        pages = [result or []]
+        if 'last' in links:
+            last = min(links['last'], max_pages)
+            results = await self._concurrently(*map(page, range(2, last + 1)))
+            pages.extend(result or [] for result, _ in results)
+            truncated = links['last'] > max_pages
+        else:
+            # the total is unknown, follow the next links
+            while 'next' in links and len(pages) < max_pages:
+                result, links = await page(links['next'])
+                pages.append(result or [])
+            truncated = 'next' in links
+
+        files = [file['filename'] for page in pages for file in page]
+        if truncated or len(files) > self.max_pull_request_files:
+            log.info(f'Listing only the first {self.max_pull_request_files} '
+                     f'files of pull request {repo}#{number}')
+        return files[:self.max_pull_request_files]
 
     @ensure_deferred
     async def handle_pull_request(self, payload, event, allow_skip=True):
         """Handles the pull request event
 
         Also queries the commit's message and the files affected by the pull
-        request.
+        request concurrently.
 
         License note:
            Copied from the original buildbot implementation with minor
@@ -208,17 +484,27 @@ class GithubHook(GitHubEventHandler):
 
         log.debug(f'Processing GitHub PR #{number}')
 
-        head_msg = await self._get_commit_msg(repo_full_name, head_sha)
-        if allow_skip and self._has_skip(head_msg):
-            log.info(f'GitHub PR #{number}, Ignoring: head commit message '
-                     f'contains skip pattern')
-            return ([], 'git')
-
         action = payload.get('action')
         if action not in ('opened', 'reopened', 'synchronize'):
             log.info(f'GitHub PR #{number} {action}, ignoring')
             return (changes, 'git')
 
+        files = defer.ensureDeferred(
+            self._get_pull_request_files(repo_full_name, number, head_sha)
+        )
+
+        try:
+            head_msg = await self._get_commit_msg(repo_full_name, head_sha)
+        except Exception:
+            self._discard(files)
+            raise
+
+        if allow_skip and self._has_skip(head_msg):
+            log.info(f'GitHub PR #{number}, Ignoring: head commit message '
+                     f'contains skip pattern')
+            self._discard(files)
+            return ([], 'git')
+
         properties = self.extractProperties(payload['pull_request'])
         properties.update({'event': event})
         properties.update({'basename': basename})
@@ -227,7 +513,7 @@ class GithubHook(GitHubEventHandler):
         desc = f'GitHub Pull Request #{number} ({commits} commit{plural})'
         desc = '\n'.join([desc, title, comments])
 
-        files = await self._get_pull_request_files(repo_full_name, number)
+        files = await files
 
         change = {
             'revision': payload['pull_request']['head']['sha'],
@@ -315,6 +601,8 @@ class GithubHook(GitHubEventHandler):
 
         changes = []
         try:
+            # the files are queried by handle_pull_request after the pull
+            # request, so they are cached under the head commit they belong to
             pull_request = await self._get(issue['pull_request']['url'])
             # handle_pull_request contains pull request specific logic
             changes, _ = await self.handle_pull_request(
@@ -65,8 +65,9 @@ class TestMaster:
         reactor: twisted.reactor, default None
         source: str, default `TestMaster`
             Used for highligting the origin or the build properties.
-        log_handler: Callable[[unseen_log_lines], None], default lambda _: None
+        log_handler: Callable[[unseen_log_lines, builder_name], None]
             A callback to handle the logs produced by the builder's buildsteps.
+            Defaults to `lambda lines, builder_name: None`.
         attach_on: List[Results], default []
             If a build finishes with any of the listed states and it is
             executed withing a DockerLatentWorker then start an interactive
@@ -84,12 +85,21 @@ class TestMaster:
 
         self._source = source
         self._master = BuildMaster('.', reactor=reactor, config_loader=loader)
-        self._log_handler = log_handler or (lambda _: None)
-
-        # state variable updated by the event handlers below
-        self._buildset = None
-        self._buildset_id = None
-        self._log_offset = 0
+        self._log_handler = log_handler or (lambda lines, builder_name: None)
+
+        # state variables updated by the event handlers below, the deferreds
+        # of the pending buildsets are keyed by buildset id, the buildsets
+        # completed before their build call could register them are kept
+        # while buildsets are being submitted
+        self._buildsets = {}
+        self._completed = {}
+        self._submitting = 0
+        # number of lines already handled, name of the builder which produced
+        # the log and lock serializing the handling of the consecutive events
+        # per log id
+        self._log_offsets = {}
+        self._log_builders = {}
+        self._log_locks = {}
 
     async def _setup_consumers(self):
         start_consuming = self._master.mq.startConsuming
@@ -127,9 +137,24 @@ class TestMaster:
         await self._stop_consumers()
         await self._master.stopService()
 
+    async def _builder_name_of(self, log):
+        data = self._master.data
+        step = await data.get(('steps', log['stepid']))
+        build = await data.get(('builds', step['buildid']))
+        builder = await data.get(('builders', build['builderid']))
+        return builder['name']
+
     @ensure_deferred
     async def _on_log_creation(self, key, log):
-        self._log_offset = 0
+        logid = log['logid']
+        lock = self._log_locks.setdefault(logid, defer.DeferredLock())
+        # the append events wait until the builder's name is resolved
+        await lock.acquire()
+        try:
+            self._log_offsets[logid] = 0
+            self._log_builders[logid] = await self._builder_name_of(log)
+        finally:
+            lock.release()
 
     @ensure_deferred
     async def _on_log_append(self, key, log):
@@ -137,12 +162,26 @@ class TestMaster:
             # we don't handle html logs on the console
             return
 
-        contents = await self._master.data.get(
-            ('logs', log['logid'], 'contents')
-        )
-        unseen = contents['content'][self._log_offset:]
-        self._log_offset += len(unseen)
-        self._log_handler(unseen.splitlines())
+        logid = log['logid']
+        lock = self._log_locks.setdefault(logid, defer.DeferredLock())
+        await lock.acquire()
+        try:
+            # only query the lines appended since the previous event
+            offset = self._log_offsets.get(logid, 0)
+            if log['num_lines'] <= offset:
+                return
+            contents = await self._master.data.get(
+                ('logs', logid, 'contents'),
+                offset=offset,
+                limit=log['num_lines'] - offset
+            )
+            if contents is None:
+                return
+            unseen = contents['content'].splitlines()
+            self._log_offsets[logid] = offset + len(unseen)
+            self._log_handler(unseen, self._log_builders.get(logid))
+        finally:
+            lock.release()
 
     @ensure_deferred
     async def _on_build_finished(self, key, build):
@@ -160,14 +199,19 @@ class TestMaster:
 
     @ensure_deferred
     async def _on_buildset_complete(self, key, buildset):
-        assert buildset['bsid'] == self._buildset_id
-        self._buildset.callback(buildset)
+        # buildsets not submitted via the build method are not awaited
+        pending = self._buildsets.pop(buildset['bsid'], None)
+        if pending is not None:
+            pending.callback(buildset)
+        elif self._submitting:
+            self._completed[buildset['bsid']] = buildset
 
     async def build(self, builder_name, sourcestamp, properties=None):
-        # the build's outcome is stored in this deferred, set by the
-        # _on_buildset_complete event handler
-        self._buildset = defer.Deferred()
+        """Trigger a builder and wait until its buildset completes
 
+        Multiple builds can run concurrently, each of them submitted as a
+        separate buildset.
+        """
         if properties is None:
             properties = {}
         else:
@@ -175,10 +219,25 @@ class TestMaster:
 
         updates = self._master.data.updates
         builder_id = await updates.findBuilderId(builder_name)
-        self._buildset_id, _ = await updates.addBuildset(
-            waited_for=False,
-            properties=properties,
-            builderids=[builder_id],
-            sourcestamps=[sourcestamp]
-        )
-        return await self._buildset
+        self._submitting += 1
+        try:
+            buildset_id, _ = await updates.addBuildset(
+                waited_for=False,
+                properties=properties,
+                builderids=[builder_id],
+                sourcestamps=[sourcestamp]
+            )
+        finally:
+            self._submitting -= 1
+        completed = self._completed.pop(buildset_id, None)
+        if not self._submitting:
+            # forget the buildsets which weren't submitted by this method
+            self._completed.clear()
+        if completed is not None:
+            # the buildset has completed before its registration
+            return completed
+
+        # the build's outcome is stored in this deferred, set by the
+        # _on_buildset_complete event handler
+        self._buildsets[buildset_id] = buildset = defer.Deferred()
+        return await buildset
@@ -8,19 +8,25 @@
 # derivative works of Buildbot. The above license only applies to code that
 # is not marked as such.
 
+import os
 import re
+import json
+import functools
 import collections
 
+from twisted.internet import defer
 from buildbot import config
 from buildbot.util.logger import Logger
 from buildbot.util.giturlparse import giturlparse
+from buildbot.reporters import utils
 from buildbot.reporters.http import HttpStatusPushBase
 from buildbot.interfaces import IRenderable
 from buildbot.process.properties import Properties, Interpolate, renderer
 from buildbot.process.results import (Results, CANCELLED, EXCEPTION, FAILURE,
                                       RETRY, SKIPPED, SUCCESS, WARNINGS)
 
-from .utils import ensure_deferred, HTTPClientService, GithubClientService
+from .utils import (ensure_deferred, HTTPClientService, GithubClientService,
+                    IdleWaiters, SqliteQueue)
 from .builders import Builder
 from .formatters import Formatter, MarkdownFormatter
 
@@ -41,13 +47,45 @@ _statuses = frozenset(['started'] + Results)
 
 
 class HttpStatusPush(HttpStatusPushBase):
-    """Makes possible to configure whether to send reports on started builds"""
+    """Makes possible to configure whether to send reports on started builds
+
+    The reports can be sent through a durable outbox queue by passing
+    `outbox=True`, which stores the queue in the master's basedir, or the
+    path of the sqlite database. The queued requests are sent in the
+    background with at most `outbox_concurrency` parallel requests per
+    destination, and retried with exponential backoff on transport errors,
+    rate limiting and server errors. A pending request is superseded by a
+    newer one with the same key, e.g. a commit status of the same context,
+    and the requests of the same key are delivered one at a time.
+    See `outbox_stats()` for the queue's metrics.
+    """
+
+    # limits of the outbox queue and its retry policy
+    outbox_size = 1000
+    outbox_max_attempts = 8
+    outbox_backoff = 2
+    outbox_max_backoff = 300
+    outbox_poll_interval = 5
+
+    # semaphores limiting the number of parallel requests per destination,
+    # shared between the reporters
+    _destinations = {}
+
+    # the steps are queried only if the formatter needs their logs
+    formatter = None
 
     def __init__(self, baseURL, headers=None, auth=None, builders=None,
                  verbose=False, report_on=None, dont_report_on=None,
-                 debug=False, verify=None, **kwargs):
+                 debug=False, verify=None, outbox=False, outbox_concurrency=4,
+                 **kwargs):
         headers = headers or {'User-Agent': 'Ursabot'}
 
+        self._outbox = None
+        self._outbox_idle = None
+        self._outbox_dispatcher = None
+        self._outbox_inflight = set()
+        self._outbox_metrics = collections.Counter()
+
         if builders is None:
             builder_names = None
         else:
@@ -64,14 +102,19 @@ class HttpStatusPush(HttpStatusPushBase):
         super().__init__(baseURL=baseURL, headers=headers, auth=auth,
                          report_on=report_on, dont_report_on=dont_report_on,
                          builders=builder_names, verbose=verbose, debug=debug,
-                         verify=verify, **kwargs)
+                         verify=verify, outbox=outbox,
+                         outbox_concurrency=outbox_concurrency, **kwargs)
 
     def checkConfig(self, baseURL, headers, report_on, dont_report_on,
-                    **kwargs):
+                    outbox, outbox_concurrency, **kwargs):
         if not isinstance(baseURL, str):
             config.error('`baseURL` must be an instrance of str')
         if not isinstance(headers, dict):
             config.error('`headers` must be an instrance of dict')
+        if not isinstance(outbox, (bool, str)):
+            config.error('`outbox` must be a boolean or a path')
+        if not isinstance(outbox_concurrency, int) or outbox_concurrency < 1:
+            config.error('`outbox_concurrency` must be a positive integer')
 
         # validating report on events sets
         args = [('report_on', report_on),
@@ -95,12 +138,121 @@ class HttpStatusPush(HttpStatusPushBase):
 
     @ensure_deferred
     async def reconfigService(self, verbose, report_on, dont_report_on,
-                              **kwargs):
+                              outbox, outbox_concurrency, **kwargs):
         await super().reconfigService(**kwargs)
         await self.reconfigClient(**kwargs)
         self.verbose = verbose
         self.report_on = (report_on or _statuses) - (dont_report_on or set())
 
+        if outbox and self._outbox is None:
+            if outbox is True:
+                filename = re.sub(r'[^\w.-]', '_', f'{self.name}.outbox')
+                outbox = os.path.join(self.master.basedir, f'{filename}.db')
+            self._outbox = SqliteQueue(outbox, maxsize=self.outbox_size)
+            self._outbox_idle = IdleWaiters(self.master.reactor)
+            self._outbox_semaphore = self._destinations.setdefault(
+                kwargs['baseURL'], defer.DeferredSemaphore(outbox_concurrency)
+            )
+            self._outbox_dispatcher = defer.ensureDeferred(
+                self._dispatch_outbox()
+            )
+
+    @ensure_deferred
+    async def stopService(self):
+        if self._outbox is not None:
+            outbox, self._outbox = self._outbox, None
+            self._outbox_idle.wake_all()
+            await self._outbox_dispatcher
+            await defer.DeferredList(list(self._outbox_inflight))
+            outbox.close()
+        await defer.maybeDeferred(super().stopService)
+
+    def _now(self):
+        return self.master.reactor.seconds()
+
+    def outbox_stats(self):
+        """Returns the metrics of the outbox queue"""
+        if self._outbox is None:
+            return None
+        oldest = self._outbox.oldest()
+        return {
+            'depth': len(self._outbox),
+            'oldest_age': None if oldest is None else self._now() - oldest,
+            'sent': self._outbox_metrics['sent'],
+            'retries': self._outbox_metrics['retries'],
+            'failures': self._outbox_metrics['failures'],
+            'superseded': self._outbox_metrics['superseded']
+        }
+
+    async def _request(self, method, urlpath, key=None, **kwargs):
+        """Sends the request directly or through the outbox
+
+        Returns None if the request has been queued.
+        """
+        if self._outbox is None:
+            return await getattr(self._http, method)(urlpath, **kwargs)
+
+        item = {'method': method, 'urlpath': urlpath, **kwargs}
+        key = None if key is None else json.dumps(key)
+        if not self._outbox.put(key, item, now=self._now(), replace=True):
+            self._outbox_metrics['superseded'] += 1
+        self._outbox_idle.wake()
+
+    async def _dispatch_outbox(self):
+        outbox = self._outbox
+        while self._outbox is outbox:
+            entry = outbox.get(now=self._now())
+            if entry is None:
+                # wait for a new request or for the backoff of the failed ones
+                await self._outbox_idle.wait(self.outbox_poll_interval)
+                continue
+
+            # the dispatching blocks while the destination is saturated
+            await self._outbox_semaphore.acquire()
+            delivery = defer.ensureDeferred(self._deliver(outbox, *entry))
+            self._outbox_inflight.add(delivery)
+
+            @delivery.addBoth
+            def release(result, delivery=delivery):
+                self._outbox_inflight.discard(delivery)
+                self._outbox_semaphore.release()
+                # the requests of the same key wait for the delivery
+                self._outbox_idle.wake()
+
+    async def _deliver(self, outbox, rowid, item, attempts):
+        cls = self.__class__.__name__
+        method, urlpath = item.pop('method'), item.pop('urlpath')
+        try:
+            response = await getattr(self._http, method)(urlpath, **item)
+        except Exception as e:
+            reason, retry = str(e), True
+        else:
+            if self.isStatus2XX(response.code):
+                self._outbox_metrics['sent'] += 1
+                return outbox.ack(rowid)
+            content = await response.content()
+            reason = (f'error code {response.code} and response '
+                      f'"{content}"')
+            retry = response.code == 429 or response.code >= 500
+
+        if retry and attempts + 1 < self.outbox_max_attempts:
+            delay = min(self.outbox_backoff * 2 ** attempts,
+                        self.outbox_max_backoff)
+            if outbox.nack(rowid, delay=delay, now=self._now()):
+                self._outbox_metrics['retries'] += 1
+                log.info(f'Failed to execute http API call in {cls} for '
+                         f'{urlpath} with {reason}, retrying in {delay}s')
+            else:
+                self._outbox_metrics['superseded'] += 1
+                log.info(f'Failed to execute http API call in {cls} for '
+                         f'{urlpath} with {reason}, superseded by a newer '
+                         'request')
+        else:
+            self._outbox_metrics['failures'] += 1
+            outbox.ack(rowid)
+            log.error(f'Failed to execute http API call in {cls} for '
+                      f'{urlpath} with {reason}, dropping it')
+
     async def reconfigClient(self, baseURL, headers, auth, debug, verify,
                              **kwargs):
         self._http = await HTTPClientService.getService(
@@ -118,6 +270,23 @@ class HttpStatusPush(HttpStatusPushBase):
             return False
         return super().filterBuilds(build)
 
+    def neededDetailsFor(self, build):
+        """Details of the build required by the reporter and its formatter"""
+        details = dict(self.neededDetails)
+        if self.formatter is not None and self.formatter.logs_needed(build):
+            details['wantSteps'] = True
+        return details
+
+    @ensure_deferred
+    async def getMoreInfoAndSend(self, build):
+        # License note:
+        #     It is a reimplementation based on the parent HttpStatusPushBase
+        #     from the original buildbot implementation.
+        details = self.neededDetailsFor(build)
+        await utils.getDetailsForBuild(self.master, build, **details)
+        if self.filterBuilds(build):
+            await self.send(build)
+
     @ensure_deferred
     async def send(self, build):
         # License note:
@@ -183,32 +352,118 @@ class HttpStatusPush(HttpStatusPushBase):
 
 
 class GitHubReporter(HttpStatusPush):
-    """Base class for reporters interacting with GitHub's API"""
+    """Base class for reporters interacting with GitHub's API
+
+    Subclasses can debounce their API calls, the calls registered with the
+    same key within `batch_window` seconds are collapsed into the latest one,
+    then the batch is sent with at most `batch_concurrency` parallel requests.
+    A zero window disables the batching.
+    """
 
     neededDetails = dict(
         wantProperties=True
     )
 
-    def __init__(self, tokens, baseURL=None, formatter=None, **kwargs):
+    def __init__(self, tokens, baseURL=None, formatter=None, batch_window=0,
+                 batch_concurrency=8, **kwargs):
         # support for self-hosted github enterprise
         if baseURL is None:
             baseURL = 'https://api.github.com'
         if baseURL.endswith('/'):
             baseURL = baseURL[:-1]
         formatter = formatter or Formatter()
+
+        self._batch = collections.OrderedDict()
+        self._batch_timer = None
+        self._batch_lock = defer.DeferredLock()
+        self._batch_flushes = set()
+
         super().__init__(tokens=tokens, baseURL=baseURL, formatter=formatter,
-                         **kwargs)
+                         batch_window=batch_window,
+                         batch_concurrency=batch_concurrency, **kwargs)
 
-    def checkConfig(self, formatter=None, **kwargs):
+    def checkConfig(self, formatter=None, batch_window=0, batch_concurrency=8,
+                    **kwargs):
         if not isinstance(formatter, (type(None), Formatter)):
             config.error('`formatter` must be an instance of '
                          'ursabot.formatters.Formatter')
+        if not isinstance(batch_window, (int, float)) or batch_window < 0:
+            config.error('`batch_window` must be a non-negative number')
+        if not isinstance(batch_concurrency, int) or batch_concurrency < 1:
+            config.error('`batch_concurrency` must be a positive integer')
         super().checkConfig(**kwargs)
 
     @ensure_deferred
-    async def reconfigService(self, formatter, **kwargs):
+    async def reconfigService(self, formatter, batch_window, batch_concurrency,
+                              **kwargs):
         await super().reconfigService(**kwargs)
         self.formatter = formatter
+        self.batch_window = batch_window
+        self._batch_semaphore = defer.DeferredSemaphore(batch_concurrency)
+
+    @ensure_deferred
+    async def stopService(self):
+        # don't lose the latest states of the pending batch
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            await self._flush_batch()
+        # nor the batches being sent, e.g. flushed by the timer
+        await defer.DeferredList(list(self._batch_flushes))
+        await defer.maybeDeferred(super().stopService)
+
+    def _debounce(self, key, fn, *args, **kwargs):
+        """Registers an API call to be sent with the next batch
+
+        A call registered earlier with the same key is superseded.
+        """
+        self._batch.pop(key, None)
+        self._batch[key] = functools.partial(fn, *args, **kwargs)
+        if self._batch_timer is None:
+            self._batch_timer = self.master.reactor.callLater(
+                self.batch_window, self._flush_batch
+            )
+
+    @ensure_deferred
+    async def _flush_batch(self):
+        self._batch_timer = None
+        batch, self._batch = self._batch, collections.OrderedDict()
+        # the batches are sent one after the other, so the calls with the
+        # same key are never reordered
+        flush = self._batch_lock.run(self._send_batch, batch)
+        self._batch_flushes.add(flush)
+        try:
+            await flush
+        finally:
+            self._batch_flushes.discard(flush)
+
+    @ensure_deferred
+    async def _send_batch(self, batch):
+        calls = [
+            self._batch_semaphore.run(self._send_batched, key, call)
+            for key, call in batch.items()
+        ]
+        await defer.DeferredList(calls, consumeErrors=True)
+
+    @ensure_deferred
+    async def _send_batched(self, key, call):
+        cls = self.__class__.__name__
+        try:
+            response = await call()
+        except Exception as e:
+            log.error(f'Failed to execute batched http API call in {cls} for '
+                      f'{key}: {e}')
+            return
+
+        if response is None:
+            # queued in the outbox or nothing to send
+            return
+        elif not self.isStatus2XX(response.code):
+            content = await response.content()
+            log.error(f'Failed to execute batched http API call in {cls} for '
+                      f'{key} with error code {response.code} and response '
+                      f'"{content}"')
+        elif self.verbose:
+            log.info(f'Successful batched report {cls} for {key}')
 
     async def reconfigClient(self, baseURL, headers, tokens, auth, debug,
                              verify, **kwargs):
@@ -270,9 +525,12 @@ class GitHubStatusPush(GitHubReporter):
 
     name = 'GitHubStatusPush'
 
-    def __init__(self, *args, context=None, **kwargs):
+    def __init__(self, *args, context=None, batch_window=2, **kwargs):
+        # the states of a status context are usually superseded within a few
+        # seconds, e.g. skipped builds, so collapse them by default
         context = context or Interpolate('ursabot/%(prop:buildername)s')
-        super().__init__(*args, context=context, **kwargs)
+        super().__init__(*args, context=context, batch_window=batch_window,
+                         **kwargs)
 
     @ensure_deferred
     async def reconfigService(self, context=None, **kwargs):
@@ -318,10 +576,17 @@ class GitHubStatusPush(GitHubReporter):
             'statuses',
             params['sha']
         ])
+        # only the latest state of the commit's context is sent
+        key = (urlpath, payload['context'])
+        if self.batch_window:
+            request = functools.partial(self._request, key=key)
+            self._debounce(key, request, 'post', urlpath, json=payload)
+            return None
+
         if self.verbose:
             log.info(f'Invoking {urlpath} with payload: {payload}')
 
-        return await self._http.post(urlpath, json=payload)
+        return await self._request('post', urlpath, json=payload, key=key)
 
 
 class GitHubReviewPush(GitHubReporter):
@@ -377,28 +642,57 @@ class GitHubReviewPush(GitHubReporter):
         if self.verbose:
             log.info(f'Invoking {urlpath} with payload: {payload}')
 
-        return await self._http.post(urlpath, json=payload)
+        return await self._request('post', urlpath, json=payload)
 
 
 class GitHubCommentPush(GitHubReporter):
     """Report as a GitHub comment to the pull-request
 
     Pass a ursabot.formatters.Formatter instance for custom comment formatting.
+
+    By default each report creates a new comment. With `consolidate=True` a
+    single comment is maintained per pull request and buildset: it contains a
+    table of the builders' states followed by the formatted reports, and it
+    is edited in place as the builds progress. The edits are debounced over
+    `batch_window` seconds, so only the latest state is sent.
     """
 
     name = 'GitHubCommentPush'
 
     # the formatter will receive all of the following details
-    # as nested dictionaries under the build variable
+    # as nested dictionaries under the build variable, the steps are
+    # queried only if the formatter needs their logs which are streamed
+    # by the formatter on demand, see Formatter.needed_logs
     neededDetails = dict(
-        wantProperties=True,
-        wantSteps=True,
-        wantLogs=True
+        wantProperties=True
     )
 
-    def __init__(self, formatter=None, **kwargs):
+    # number of consolidated comments to remember
+    consolidated_cache_size = 256
+
+    def __init__(self, formatter=None, consolidate=False, batch_window=None,
+                 **kwargs):
         formatter = formatter or MarkdownFormatter()
-        super().__init__(formatter=formatter, **kwargs)
+        if batch_window is None:
+            batch_window = 5 if consolidate else 0
+
+        # rows of the consolidated comments keyed by (repo_owner, repo_name,
+        # issue, buildset id) and the ids of the already created comments
+        self._consolidated = collections.OrderedDict()
+        self._comment_ids = {}
+
+        super().__init__(formatter=formatter, consolidate=consolidate,
+                         batch_window=batch_window, **kwargs)
+
+    def checkConfig(self, consolidate, **kwargs):
+        if not isinstance(consolidate, bool):
+            config.error('`consolidate` must be a boolean')
+        super().checkConfig(**kwargs)
+
+    @ensure_deferred
+    async def reconfigService(self, consolidate, **kwargs):
+        await super().reconfigService(**kwargs)
+        self.consolidate = consolidate
 
     @ensure_deferred
     async def report(self, build, sourcestamp, properties):
@@ -406,9 +700,12 @@ class GitHubCommentPush(GitHubReporter):
         #     Contains copied parts from the original buildbot implementation.
         params = self._extract_github_params(sourcestamp,
                                              branch=properties['branch'])
-        payload = {
-            'body': await self.formatter.render(build, master=self.master)
-        }
+        body = await self.formatter.render(build, master=self.master)
+        if self.consolidate:
+            self._consolidate(params, build, body)
+            return None
+
+        payload = {'body': body}
         urlpath = '/'.join([
             '/repos',
             params['repo_owner'],
@@ -417,7 +714,71 @@ class GitHubCommentPush(GitHubReporter):
             params['issue'],
             'comments'
         ])
-        return await self._http.post(urlpath, json=payload)
+        return await self._request('post', urlpath, json=payload)
+
+    def _consolidate(self, params, build, body):
+        key = (
+            params['repo_owner'],
+            params['repo_name'],
+            params['issue'],
+            build['buildset']['bsid']
+        )
+        if build['complete']:
+            status = Results[build['results']]
+        else:
+            status = 'started'
+
+        rows = self._consolidated.pop(key, None) or {}
+        rows[build['builder']['name']] = (status, build['url'], body)
+        self._consolidated[key] = rows
+        self._debounce(key, self._update_consolidated, key)
+
+        # evict the least recently reported buildsets, except the ones still
+        # waiting to be sent with the next batch
+        while len(self._consolidated) > self.consolidated_cache_size:
+            evictable = (k for k in self._consolidated if k not in self._batch)
+            evicted = next(evictable, None)
+            if evicted is None:
+                break
+            del self._consolidated[evicted]
+            self._comment_ids.pop(evicted, None)
+
+    def _render_consolidated(self, rows):
+        lines = ['| Builder | Status |', '| --- | --- |']
+        for builder_name, (status, url, _) in rows.items():
+            lines.append(f'| {builder_name} | [{status}]({url}) |')
+        for builder_name, (_, _, body) in rows.items():
+            if body:
+                lines.extend(['', f'#### {builder_name}', '', body])
+        return '\n'.join(lines)
+
+    @ensure_deferred
+    async def _update_consolidated(self, key):
+        repo_owner, repo_name, issue, _ = key
+        # the rows are rendered when the debounced call is sent, so always
+        # the latest state is reported
+        rows = self._consolidated.get(key)
+        if rows is None:
+            return None
+        payload = {'body': self._render_consolidated(rows)}
+
+        comment_id = self._comment_ids.get(key)
+        if comment_id is None:
+            urlpath = '/'.join([
+                '/repos', repo_owner, repo_name, 'issues', issue, 'comments'
+            ])
+            response = await self._http.post(urlpath, json=payload)
+            if self.isStatus2XX(response.code):
+                comment = await response.json()
+                self._comment_ids[key] = comment['id']
+        else:
+            urlpath = '/'.join([
+                '/repos', repo_owner, repo_name, 'issues', 'comments',
+                str(comment_id)
+            ])
+            response = await self._http.patch(urlpath, json=payload)
+
+        return response
 
 
 @renderer
@@ -443,9 +804,7 @@ class ZulipStatusPush(HttpStatusPush):
 
     name = 'ZulipStatusPush'
     neededDetails = dict(
-        wantProperties=True,
-        wantSteps=True,
-        wantLogs=True
+        wantProperties=True
     )
 
     def __init__(self, organization, bot, apikey, stream, topic=None,
@@ -487,4 +846,4 @@ class ZulipStatusPush(HttpStatusPush):
         if self.verbose:
             log.info(f'Invoking {urlpath} with payload: {payload}')
 
-        return await self._http.post(urlpath, data=payload)
+        return await self._request('post', urlpath, data=payload)
@@ -18,10 +18,11 @@
 import json as jsonmodule
 import toolz
 
+from twisted.web.http_headers import Headers
 from buildbot.util import toJson
 from buildbot.util.logger import Logger
 from buildbot.test.fake.httpclientservice import (
-    HTTPClientService, ResponseWrapper)
+    HTTPClientService, ResponseWrapper as OriginalResponseWrapper)
 
 from ursabot.utils import GithubClientService as OriginalGithubClientService
 from ursabot.utils import ensure_deferred
@@ -34,6 +35,13 @@ def pick(whitelist, d):
     return toolz.keyfilter(lambda k: k in whitelist, d)
 
 
+class ResponseWrapper(OriginalResponseWrapper):
+
+    def __init__(self, code, content, headers=None):
+        super().__init__(code, content)
+        self.headers = Headers(headers or {})
+
+
 # XXX: it must be named same as the original one because of some dark magic
 # used for the service identification
 class GithubClientService(HTTPClientService):
@@ -62,7 +70,8 @@ class GithubClientService(HTTPClientService):
         return ret
 
     def expect(self, method, ep, params=None, data=None, json=None, code=200,
-               content=None, content_json=None, headers=None):
+               content=None, content_json=None, headers=None,
+               response_headers=None):
         if content is not None and content_json is not None:
             return ValueError('content and content_json cannot be both '
                               'specified')
@@ -72,9 +81,13 @@ class GithubClientService(HTTPClientService):
 
         self._expected.append(
             dict(method=method, ep=ep, params=params, data=data, json=json,
-                 code=code, content=content, headers=headers)
+                 code=code, content=content, headers=headers,
+                 response_headers=response_headers)
         )
 
+    def patch(self, ep, **kwargs):
+        return self._doRequest('patch', ep, **kwargs)
+
     @ensure_deferred
     async def _doRequest(self, method, ep, params=None, data=None, json=None,
                          headers=None):
@@ -110,4 +123,5 @@ class GithubClientService(HTTPClientService):
                       method=method, ep=ep, code=expect['code'],
                       content=expect['content'])
 
-        return ResponseWrapper(expect['code'], expect['content'])
+        return ResponseWrapper(expect['code'], expect['content'],
+                               headers=expect['response_headers'])
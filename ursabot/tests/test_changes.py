@@ -17,10 +17,11 @@
 
 import re
 
+import pytest
 from buildbot.test.fake.change import Change as FakeChange
 from buildbot.test.unit import test_changes_filter as original
 
-from ursabot.changes import ChangeFilter
+from ursabot.changes import ChangeFilter, ChangeRouter
 from ursabot.utils import Glob, AnyOf, AllOf
 
 
@@ -214,3 +215,109 @@ class TestChangeFilter(original.ChangeFilter):
             'on tag of project a without files'
         )
         self.check()
+
+
+class RoutedChangeFilter(ChangeFilter):
+    router = ChangeRouter()
+
+
+@pytest.fixture
+def filters():
+    RoutedChangeFilter.router = ChangeRouter()
+    return {
+        'arrow-push': RoutedChangeFilter(
+            project='arrow', category=None, repository='arrow'
+        ),
+        'arrow-pull': RoutedChangeFilter(
+            project='arrow', category='pull', files=Glob('cpp/*')
+        ),
+        'arrow-comment': RoutedChangeFilter(
+            project=re.compile('^arr'), category='comment',
+            properties={'command': ['build', 'benchmark']}
+        ),
+        'ursabot-comment': RoutedChangeFilter(
+            project='ursabot', category='comment',
+            properties={'command': 'build'}
+        ),
+        'anything': RoutedChangeFilter()
+    }
+
+
+@pytest.mark.parametrize(('change', 'expected'), [
+    (
+        Change(number=1, project='arrow', repository='arrow', category=None),
+        {'arrow-push', 'anything'}
+    ),
+    (
+        Change(number=2, project='arrow', category='pull',
+               files=['cpp/a.cc']),
+        {'arrow-pull', 'anything'}
+    ),
+    (
+        Change(number=3, project='arrow', category='pull',
+               files=['java/A.java']),
+        {'anything'}
+    ),
+    (
+        Change(number=4, project='arrow', category='comment',
+               properties={'command': 'benchmark'}),
+        {'arrow-comment', 'anything'}
+    ),
+    (
+        Change(number=5, project='ursabot', category='comment',
+               properties={'command': 'build'}),
+        {'ursabot-comment', 'anything'}
+    ),
+    (
+        Change(number=6, project='ursabot', category='comment',
+               properties={'command': ['unhashable']}),
+        {'anything'}
+    ),
+])
+def test_change_routing(filters, change, expected):
+    router = RoutedChangeFilter.router
+    passing = {name for name, filt in filters.items() if filt(change)}
+    assert passing == expected
+
+    # the candidates are a superset of the passing filters
+    candidates = router.route(change)
+    assert {id(filters[name]) for name in expected} <= candidates
+
+    # the routing gives the same results as the original implementation
+    for filt in filters.values():
+        original = super(ChangeFilter, filt).filter_change(change)
+        assert filt(change) == original
+
+    # the candidates are cached per indexed values, unless unhashable
+    assert router.route(change) == candidates
+
+
+def test_change_router_cache(filters):
+    router = RoutedChangeFilter.router
+    arrow = Change(number=1, project='arrow', category='pull')
+    candidates = router.route(arrow)
+    assert router.route(Change(number=2, project='arrow',
+                               category='pull')) is candidates
+
+    # another master of the same process may reuse the change number
+    ursabot = Change(number=1, project='ursabot', category='pull')
+    assert not filters['ursabot-comment'](ursabot)
+    assert router.route(ursabot) != candidates
+    assert id(filters['arrow-pull']) not in router.route(ursabot)
+    assert filters['anything'](ursabot)
+
+
+def test_change_router_registration(filters):
+    router = RoutedChangeFilter.router
+    change = Change(number=7, project='ursabot', category='comment',
+                    properties={'command': 'build'})
+    candidates = router.route(change)
+    assert candidates == {
+        id(filters[name])
+        for name in ('arrow-comment', 'ursabot-comment', 'anything')
+    }
+
+    late = RoutedChangeFilter(project='ursabot')
+    assert late in router
+    assert id(late) in router.route(change)
+    assert late(change)
@@ -0,0 +1,132 @@
+# Copyright 2019 RStudio, Inc.
+# All rights reserved.
+#
+# Use of this source code is governed by a BSD 2-Clause
+# license that can be found in the LICENSE_BSD file.
+
+import pytest
+from buildbot.config import ConfigErrors
+
+from ursabot.utils import Filter, Has, Matching
+from ursabot.configs import ProjectConfig, LazyProjectConfig, MasterConfig
+from ursabot.docker import ImageCollection
+
+
+project_cfg = """
+from ursabot.configs import ProjectConfig
+
+loaded.append(project_name)
+project = ProjectConfig(name=project_name, repo='https://github.com/test')
+"""
+
+
+@pytest.fixture
+def lazy_projects(tmp_path):
+    loaded = []
+    projects = []
+    for name in ['first', 'second']:
+        path = tmp_path / f'{name}.cfg'
+        path.write_text(project_cfg)
+        project = LazyProjectConfig(
+            name=name,
+            path=path,
+            variable='project',
+            inject_globals=dict(loaded=loaded, project_name=name)
+        )
+        projects.append(project)
+    return projects, loaded
+
+
+def test_lazy_project_loading(lazy_projects):
+    projects, loaded = lazy_projects
+    master = MasterConfig(projects=projects)
+    assert loaded == []
+
+    project = master.project(name='second')
+    assert isinstance(project, ProjectConfig)
+    assert project.name == 'second'
+    assert loaded == ['second']
+
+    # the loaded project is cached
+    assert master.project(name='second') is project
+    assert projects[1].repo == 'https://github.com/test'
+    assert loaded == ['second']
+
+    # aggregating over the projects loads the rest of them
+    assert master.builders == []
+    assert loaded == ['second', 'first']
+
+
+def test_lazy_project_name_mismatch(lazy_projects):
+    (project, _), _ = lazy_projects
+    project.name = 'other'
+    with pytest.raises(ConfigErrors):
+        project.load()
+
+
+def test_select():
+    from ursabot.builders import Builder
+    from ursabot.workers import LocalWorker
+
+    workers = [LocalWorker('worker')]
+    builders = [
+        Builder(name='a', workers=workers, tags=['x']),
+        Builder(name='b', workers=workers, tags=['x', 'y']),
+        Builder(name='c', workers=workers)
+    ]
+    project = ProjectConfig(name='test', repo='https://github.com/test',
+                            workers=workers, builders=builders)
+
+    assert project.builder('b') is builders[1]
+    with pytest.raises(KeyError):
+        project.builder('d')
+    assert project.select('builders', tags=Has('x')) == builders[:2]
+    assert project.select('builders', name=Matching('[bc]')) == builders[1:]
+    assert project.select('workers', name='worker') == workers
+    platform = workers[0].platform
+    assert project.select(
+        'workers', platform=Filter(arch=platform.arch, system=platform.system)
+    ) == workers
+    assert project.select('workers', platform=Filter(arch='unknown')) == []
+
+    # the index is rebuilt if the list is changed
+    project.builders.append(Builder(name='d', workers=workers))
+    assert project.builder('d').name == 'd'
+
+
+def test_aggregates_are_cached():
+    from ursabot.builders import Builder
+    from ursabot.workers import LocalWorker
+
+    worker = LocalWorker('worker')
+    projects = [
+        ProjectConfig(
+            name=name,
+            repo='https://github.com/test',
+            workers=[worker],
+            builders=[Builder(name=name, workers=[worker])]
+        )
+        for name in ['a', 'b', 'c']
+    ]
+    master = MasterConfig(projects=projects[:2])
+
+    builders = master.builders
+    assert [b.name for b in builders] == ['a', 'b']
+    assert master.builders == builders
+    assert master.workers == [worker]
+    assert master.images == []
+    assert master._from_projects('images') is master._from_projects('images')
+
+    # modifying the returned lists doesn't affect the cached aggregates
+    builders.pop()
+    master.images.append('image')
+    assert [b.name for b in master.builders] == ['a', 'b']
+    assert master.images == []
+    assert isinstance(master.images, ImageCollection)
+
+    # changing the projects invalidates the cached aggregates
+    master.projects.append(projects[2])
+    assert [b.name for b in master.builders] == ['a', 'b', 'c']
+    master.projects = projects[1:]
+    assert [b.name for b in master.builders] == ['b', 'c']
+    assert master.workers == [worker]
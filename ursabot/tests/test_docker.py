@@ -4,14 +4,19 @@
 # Use of this source code is governed by a BSD 2-Clause
 # license that can be found in the LICENSE_BSD file.
 
+import tarfile
+import threading
+from operator import methodcaller
 from textwrap import dedent
 
 import pytest
+from docker.errors import APIError
 from dockermap.api import DockerClientWrapper
 
 from ursabot.utils import Platform, Filter
-from ursabot.docker import DockerImage, ImageCollection
-from ursabot.docker import RUN, CMD, WORKDIR, apk, apt, pip, conda
+from ursabot.docker import (DockerImage, ImageCollection, ImageBuildError,
+                            ImagePushError)
+from ursabot.docker import ADD, RUN, CMD, WORKDIR, apk, apt, pip, conda
 
 
 @pytest.fixture
@@ -178,6 +183,11 @@ def test_docker_image_hashing(collection):
     assert len(unique_images) == len(collection)
 
 
+def test_docker_image_dockerfile_is_cached(image):
+    assert image.dockerfile is image.dockerfile
+    assert image.workdir == '/buildbot'
+
+
 def test_docker_image_save(tmp_path, image):
     target = tmp_path / f'{image.repo}.{image.tag}.dockerfile'
     image.save_dockerfile(tmp_path)
@@ -211,6 +221,179 @@ def test_image_collection_build(collection):
     collection.build()
 
 
+def test_image_collection_build_order(monkeypatch, collection):
+    lock = threading.Lock()
+    built = []
+
+    def build(self, *args, **kwargs):
+        if isinstance(self.base, DockerImage):
+            assert self.base.name in built
+        with lock:
+            built.append(self.name)
+        return self
+
+    monkeypatch.setattr(DockerImage, 'build', build)
+    results = collection.build(jobs=4, force=True)
+
+    assert sorted(built) == sorted(i.name for i in collection)
+    assert sorted(r.image.name for r in results) == sorted(built)
+    assert all(r.state == 'success' for r in results)
+
+
+@pytest.mark.parametrize('fail_fast', [True, False])
+def test_image_collection_build_failure(monkeypatch, collection, fail_fast):
+    built = set()
+
+    def build(self, *args, **kwargs):
+        if self.name == 'b':
+            raise RuntimeError('failed')
+        built.add(self.name)
+        return self
+
+    monkeypatch.setattr(DockerImage, 'build', build)
+    with pytest.raises(ImageBuildError) as excinfo:
+        collection.build(jobs=1, fail_fast=fail_fast, force=True)
+
+    states = {r.image.name: r.state for r in excinfo.value.results}
+    assert len(states) == len(collection)
+    assert states['b'] == 'failure'
+    for name in ['f', 'g', 'h', 'i']:
+        assert states[name] == 'skipped'
+
+    if fail_fast:
+        # the queued builds are not started after the failure
+        assert built == set()
+        assert states['a'] == 'skipped'
+    else:
+        assert built == {'a', 'c', 'd', 'e', 'j', 'k'}
+
+
+def test_docker_image_digest(tmp_path, image):
+    script = tmp_path / 'install.sh'
+    script.write_text('echo 1')
+
+    def child_of(base):
+        return DockerImage('child', base=base, steps=[
+            ADD(script, '/install.sh'),
+            RUN('/install.sh')
+        ])
+
+    child = child_of(image)
+    digest = child.digest
+    assert len(digest) == 64
+    assert child_of(image).digest == digest
+
+    # the digest is computed once per image instance
+    script.write_text('echo 2')
+    assert child.digest == digest
+
+    # changing the content of an added file
+    child = child_of(image)
+    assert child.digest != digest
+    digest = child.digest
+
+    # changing the parent image
+    other = DockerImage(image.name, base=image.base, platform=image.platform,
+                        steps=image.steps[1:])
+    assert child_of(other).digest != digest
+
+
+def test_docker_image_digest_with_archive(tmp_path, image):
+    script = tmp_path / 'install.sh'
+    archive = tmp_path / 'scripts.tar'
+
+    def child_of(base):
+        with tarfile.open(archive, 'w') as tar:
+            tar.add(script, arcname='install.sh')
+        return DockerImage('child', base=base, steps=[
+            methodcaller('add_archive', str(archive)),
+            RUN('/install.sh')
+        ])
+
+    script.write_text('echo 1')
+    child = child_of(image)
+    assert ('scripts.tar', archive) in child.dockerfile.context_files()
+    digest = child.digest
+    assert child_of(image).digest == digest
+
+    # changing the content of the archive
+    script.write_text('echo 2')
+    assert child_of(image).digest != digest
+
+
+class FakeClient:
+
+    def __init__(self, labels=None, failures=None):
+        self.labels = labels or {}
+        self.failures = failures or {}
+        self.built = []
+        self.tagged = []
+        self.pushed = []
+
+    def inspect_image(self, fqn):
+        return {'Config': {'Labels': self.labels.get(fqn)}}
+
+    def build_from_file(self, dockerfile, fqn, labels, **kwargs):
+        self.labels[fqn] = labels
+        self.built.append(fqn)
+
+    def tag(self, image, repository, tag):
+        self.tagged.append((image, f'{repository}:{tag}'))
+
+    def push(self, fqn, stream, **kwargs):
+        if self.failures.get(fqn, 0):
+            self.failures[fqn] -= 1
+            raise APIError('transient failure')
+        self.pushed.append(fqn)
+
+
+def test_image_collection_build_skips_unchanged(collection):
+    client = FakeClient(labels={})
+    results = collection.build(client=client)
+    assert sorted(client.built) == sorted(i.fqn for i in collection)
+    assert all(r.state == 'success' for r in results)
+
+    client.built.clear()
+    results = collection.build(client=client)
+    assert client.built == []
+    assert all(r.state == 'unchanged' for r in results)
+
+    results = collection.build(client=client, force=True)
+    assert len(client.built) == len(collection)
+
+
+def test_image_collection_push(collection):
+    client = FakeClient()
+    targets = ['quay.io/ursalabs', 'ursalab']
+    results = collection.push(client=client, targets=targets, jobs=4)
+
+    assert len(results) == len(collection) * 2
+    assert all(r.state == 'success' for r in results)
+    assert sorted(client.pushed) == sorted(
+        f'{target}/{image.repo}:{image.tag}'
+        for image in collection for target in targets
+    )
+    assert sorted(client.tagged) == sorted(
+        (image.fqn, f'{target}/{image.repo}:{image.tag}')
+        for image in collection for target in targets
+    )
+
+
+def test_image_collection_push_retries(collection):
+    first, second = collection[0].fqn, collection[1].fqn
+    client = FakeClient(failures={first: 2, second: 3})
+
+    with pytest.raises(ImagePushError) as excinfo:
+        collection.push(client=client, retries=2, backoff=0)
+
+    states = {r.fqn: r.state for r in excinfo.value.results}
+    assert states[first] == 'success'
+    assert states[second] == 'failure'
+    assert first in client.pushed
+    assert second not in client.pushed
+    assert len(client.pushed) == len(collection) - 1
+
+
 def test_readme_example():
     images = ImageCollection()
 
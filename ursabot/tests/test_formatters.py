@@ -18,7 +18,7 @@ from buildbot.reporters import utils
 from buildbot.test.fake import fakedb, fakemaster
 from buildbot.test.util.misc import TestReactorMixin
 
-from ursabot.formatters import Formatter, MarkdownFormatter
+from ursabot.formatters import Formatter, MarkdownFormatter, LogExcerpt
 from ursabot.utils import ensure_deferred
 
 
@@ -74,6 +74,7 @@ class TestFormatterBase(TestReactorMixin, unittest.TestCase):
             ])
 
     async def render(self, previous, current, buildsetid=99, complete=True,
+                     want_steps=True, want_logs=False, formatter=None,
                      **kwargs):
         self.setupDb(current, previous, **kwargs)
 
@@ -81,13 +82,13 @@ class TestFormatterBase(TestReactorMixin, unittest.TestCase):
             self.master,
             buildsetid,
             wantProperties=True,
-            wantSteps=True,
-            wantLogs=True
+            wantSteps=want_steps,
+            wantLogs=want_logs
         )
         build = buildset['builds'][0]
         build['complete'] = complete
 
-        formatter = self.setupFormatter()
+        formatter = formatter or self.setupFormatter()
 
         return await formatter.render(build, master=self.master)
 
@@ -234,6 +235,74 @@ class TestMarkdownFormatter(TestFormatterBase):
                                     current=FAILURE, log1=log1, log2=log2)
         assert content == textwrap.dedent(expected).strip()
 
+    @ensure_deferred
+    async def test_failure_with_prefetched_logs(self):
+        log1 = ('hline1', 'eline2', 'oline3')
+        log2 = ('hline1', 'eline2')
+        expected = f"""
+        [Builder1 (#{self.BUILD_ID})]({self.BUILD_URL}) builder failed.
+
+        Revision: {self.REVISION}
+
+        Benchmark: `/bin/run-benchmark` step's stderr:
+        ```
+        line2
+        ```
+        """
+        content = await self.render(previous=SUCCESS, current=FAILURE,
+                                    log1=log1, log2=log2, want_logs=True)
+        assert content == textwrap.dedent(expected).strip()
+
+    @ensure_deferred
+    async def test_failure_with_lazily_queried_steps(self):
+        log1 = ('hline1', 'eline2', 'oline3')
+        log2 = ('hline1', 'eline2')
+        expected = f"""
+        [Builder1 (#{self.BUILD_ID})]({self.BUILD_URL}) builder failed.
+
+        Revision: {self.REVISION}
+
+        Benchmark: `/bin/run-benchmark` step's stderr:
+        ```
+        line2
+        ```
+        """
+        content = await self.render(previous=SUCCESS, current=FAILURE,
+                                    log1=log1, log2=log2, want_steps=False)
+        assert content == textwrap.dedent(expected).strip()
+
+    def test_logs_needed(self):
+        formatter = MarkdownFormatter()
+        build = {'complete': False, 'results': None}
+        assert formatter.logs_needed(build) == {}
+        build = {'complete': True, 'results': SUCCESS}
+        assert formatter.logs_needed(build) == {}
+        build = {'complete': True, 'results': FAILURE}
+        assert formatter.logs_needed(build) == {'stdio': {FAILURE}}
+
+    @ensure_deferred
+    async def test_failure_with_long_stderr(self):
+        log1 = ('hline1', 'eline2', 'eline3', 'eline4', 'eline5')
+        log2 = ('hline1',)
+
+        expected = f"""
+        [Builder1 (#{self.BUILD_ID})]({self.BUILD_URL}) builder failed.
+
+        Revision: {self.REVISION}
+
+        Benchmark: `/bin/run-benchmark` step's stderr:
+        ```
+        line2
+        ... 2 lines omitted ...
+        line5
+        ```
+        """
+        formatter = MarkdownFormatter(log_head=1, log_tail=1)
+        formatter.log_chunk_lines = 2
+        content = await self.render(previous=SUCCESS, current=FAILURE,
+                                    log1=log1, log2=log2, formatter=formatter)
+        assert content == textwrap.dedent(expected).strip()
+
     @ensure_deferred
     async def test_exception(self):
         try:
@@ -260,3 +329,25 @@ class TestMarkdownFormatter(TestFormatterBase):
                                     current=EXCEPTION, log1=log1.splitlines(),
                                     log2=log2.splitlines())
         assert content == textwrap.dedent(expected).strip().format(log1=log1)
+
+
+def test_log_excerpt():
+    excerpt = LogExcerpt(head=2, tail=3, max_bytes=1024)
+    excerpt.extend(['a', 'b'])
+    assert excerpt.lines() == ['a', 'b']
+
+    excerpt.extend(str(i) for i in range(10))
+    assert excerpt.omitted == 7
+    assert excerpt.lines() == ['a', 'b', '... 7 lines omitted ...',
+                               '7', '8', '9']
+
+    # the byte budget is split between the head and the tail
+    excerpt = LogExcerpt(head=10, tail=10, max_bytes=8)
+    excerpt.extend(['aa', 'bb', 'cc', 'dd', 'ee'])
+    assert str(excerpt) == 'aa\n... 3 lines omitted ...\nee'
+    assert LogExcerpt(head=0, tail=1, max_bytes=8).lines() == []
+
+    # the lines exceeding the budget are truncated
+    excerpt = LogExcerpt(head=1, tail=1, max_bytes=16)
+    excerpt.extend(['x' * 100, 'y' * 100])
+    assert excerpt.lines() == ['xxxx...', 'yyyy...']
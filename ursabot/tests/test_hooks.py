@@ -8,8 +8,11 @@
 # derivative works of Buildbot. The above license only applies to code that
 # is not marked as such.
 
+import copy
 import json
+import sqlite3
 from pathlib import Path
+from unittest import mock
 
 from twisted.trial import unittest
 
@@ -20,6 +23,7 @@ from buildbot.www.change_hook import ChangeHookResource
 from buildbot.test.unit.test_www_hooks_github import _prepare_request
 
 from ursabot.utils import ensure_deferred
+from ursabot import hooks
 from ursabot.hooks import GithubHook, UrsabotHook
 from ursabot.commands import CommandError, group
 from ursabot.tests.mocks import GithubClientService
@@ -72,7 +76,8 @@ class ChangeHookTestCase(unittest.TestCase, TestReactorMixin):
 
     @ensure_deferred
     async def tearDown(self):
-        await self.master.stopService()
+        if self.master.running:
+            await self.master.stopService()
 
     async def trigger(self, event, payload, headers=None, _secret=None):
         payload = json.dumps(payload).encode()
@@ -102,19 +107,19 @@ class TestGithubHook(ChangeHookTestCase):
     async def test_pull_request(self):
         payload = self.load_fixture('event-pull-request-opened')
 
-        # handle_pull_request fetches the commit message
+        # handle_pull_request fetches the affected files and the commit
+        # message concurrently
+        request_json = self.load_fixture('pull-request-26-files')
+        self.http.expect('get', '/repos/ursa-labs/ursabot/pulls/26/files',
+                         params={'per_page': 100, 'page': 1},
+                         content_json=request_json)
+        expected_files = [f['filename'] for f in request_json]
+
         request_json = self.load_fixture('pull-request-26-commit')
         commit = '2705da2b616b98fa6010a25813c5a7a27456f71d'
         self.http.expect('get', f'/repos/ursa-labs/ursabot/commits/{commit}',
                          content_json=request_json)
 
-        # handle_pull_request fetches the affected files
-        request_json = self.load_fixture('pull-request-26-files')
-        self.http.expect('get', f'/repos/ursa-labs/ursabot/pulls/26/files',
-                         content_json=request_json)
-
-        expected_files = [f['filename'] for f in request_json]
-
         # trigger the event
         await self.trigger('pull_request', payload=payload)
 
@@ -130,12 +135,278 @@ class TestGithubHook(ChangeHookTestCase):
         assert change['properties']['basename'] == 'master'
         assert change['files'] == expected_files
 
+    @ensure_deferred
+    async def test_pull_request_with_paginated_files(self):
+        payload = self.load_fixture('event-pull-request-opened')
+
+        # the first page's link header contains the number of pages, the rest
+        # of the pages are requested concurrently
+        url = '/repos/ursa-labs/ursabot/pulls/26/files'
+        link = (
+            f'<https://api.github.com{url}?per_page=100&page=2>; rel="next", '
+            f'<https://api.github.com{url}?per_page=100&page=3>; rel="last"'
+        )
+        pages = [
+            [{'filename': f'file-{page}-{i}.py'} for i in range(100)]
+            for page in range(1, 4)
+        ]
+        self.http.expect('get', url, params={'per_page': 100, 'page': 1},
+                         content_json=pages[0],
+                         response_headers={'Link': [link]})
+        self.http.expect('get', url, params={'per_page': 100, 'page': 2},
+                         content_json=pages[1])
+        self.http.expect('get', url, params={'per_page': 100, 'page': 3},
+                         content_json=pages[2])
+
+        request_json = self.load_fixture('pull-request-26-commit')
+        commit = '2705da2b616b98fa6010a25813c5a7a27456f71d'
+        self.http.expect('get', f'/repos/ursa-labs/ursabot/commits/{commit}',
+                         content_json=request_json)
+
+        await self.trigger('pull_request', payload=payload)
+        assert len(self.changes_added) == 1
+        files = self.changes_added[0]['files']
+        assert files == [f['filename'] for page in pages for f in page]
+
+        # the files are not listed again for the same head commit
+        self.http.expect('get', f'/repos/ursa-labs/ursabot/commits/{commit}',
+                         content_json=request_json)
+        await self.trigger('pull_request', payload=payload)
+        assert len(self.changes_added) == 2
+        assert self.changes_added[1]['files'] == files
+
+    @ensure_deferred
+    async def test_pull_request_files_are_capped(self):
+        payload = self.load_fixture('event-pull-request-opened')
+        self.patch(GithubHook, 'max_pull_request_files', 150)
+
+        url = '/repos/ursa-labs/ursabot/pulls/26/files'
+        link = (
+            f'<https://api.github.com{url}?per_page=100&page=2>; rel="next", '
+            f'<https://api.github.com{url}?per_page=100&page=30>; rel="last"'
+        )
+        pages = [
+            [{'filename': f'file-{page}-{i}.py'} for i in range(100)]
+            for page in range(1, 3)
+        ]
+        self.http.expect('get', url, params={'per_page': 100, 'page': 1},
+                         content_json=pages[0],
+                         response_headers={'Link': [link]})
+        self.http.expect('get', url, params={'per_page': 100, 'page': 2},
+                         content_json=pages[1])
+
+        request_json = self.load_fixture('pull-request-26-commit')
+        commit = '2705da2b616b98fa6010a25813c5a7a27456f71d'
+        self.http.expect('get', f'/repos/ursa-labs/ursabot/commits/{commit}',
+                         content_json=request_json)
+
+        with mock.patch.object(hooks, 'log') as log:
+            await self.trigger('pull_request', payload=payload)
+        assert len(self.changes_added) == 1
+        assert len(self.changes_added[0]['files']) == 150
+        messages = [args[0] for args, _ in log.info.call_args_list]
+        assert ('Listing only the first 150 files of pull request '
+                'ursa-labs/ursabot#26') in messages
+
+    @ensure_deferred
+    async def test_pull_request_files_at_the_cap(self):
+        payload = self.load_fixture('event-pull-request-opened')
+        self.patch(GithubHook, 'max_pull_request_files', 200)
+
+        url = '/repos/ursa-labs/ursabot/pulls/26/files'
+        link = (
+            f'<https://api.github.com{url}?per_page=100&page=2>; rel="next", '
+            f'<https://api.github.com{url}?per_page=100&page=2>; rel="last"'
+        )
+        pages = [
+            [{'filename': f'file-{page}-{i}.py'} for i in range(100)]
+            for page in range(1, 3)
+        ]
+        self.http.expect('get', url, params={'per_page': 100, 'page': 1},
+                         content_json=pages[0],
+                         response_headers={'Link': [link]})
+        self.http.expect('get', url, params={'per_page': 100, 'page': 2},
+                         content_json=pages[1])
+
+        request_json = self.load_fixture('pull-request-26-commit')
+        commit = '2705da2b616b98fa6010a25813c5a7a27456f71d'
+        self.http.expect('get', f'/repos/ursa-labs/ursabot/commits/{commit}',
+                         content_json=request_json)
+
+        # nothing is dropped, so the truncation is not reported
+        with mock.patch.object(hooks, 'log') as log:
+            await self.trigger('pull_request', payload=payload)
+        assert len(self.changes_added[0]['files']) == 200
+        messages = [args[0] for args, _ in log.info.call_args_list]
+        assert not any(m.startswith('Listing only') for m in messages)
+
+    @ensure_deferred
+    async def test_pull_request_with_queue(self):
+        self.patch(GithubHook, 'queue_path', ':memory:')
+        payload = self.load_fixture('event-pull-request-opened')
+        headers = {b'X-GitHub-Delivery': b'72d3162e-cc78-11e3-81ab'}
+
+        request_json = self.load_fixture('pull-request-26-files')
+        self.http.expect('get', '/repos/ursa-labs/ursabot/pulls/26/files',
+                         params={'per_page': 100, 'page': 1},
+                         content_json=request_json)
+        request_json = self.load_fixture('pull-request-26-commit')
+        commit = '2705da2b616b98fa6010a25813c5a7a27456f71d'
+        self.http.expect('get', f'/repos/ursa-labs/ursabot/commits/{commit}',
+                         content_json=request_json)
+
+        # the payload is queued and processed by a background worker
+        await self.trigger('pull_request', payload=payload, headers=headers)
+        assert len(self.changes_added) == 1
+        assert self.changes_added[0]['branch'] == 'refs/pull/26/merge'
+
+        # the redelivery of the same event is ignored
+        await self.trigger('pull_request', payload=payload, headers=headers)
+        assert len(self.changes_added) == 1
+
+    @ensure_deferred
+    async def test_queued_payload_is_retried(self):
+        self.patch(GithubHook, 'queue_path', ':memory:')
+        payload = self.load_fixture('event-pull-request-opened')
+
+        # the first attempt fails, the commit request is not even issued
+        self.http.expect('get', '/repos/ursa-labs/ursabot/pulls/26/files',
+                         params={'per_page': 100, 'page': 1}, code=500,
+                         content='not json')
+        request_json = self.load_fixture('pull-request-26-commit')
+        commit = '2705da2b616b98fa6010a25813c5a7a27456f71d'
+        self.http.expect('get', f'/repos/ursa-labs/ursabot/commits/{commit}',
+                         content_json=request_json)
+        await self.trigger('pull_request', payload=payload)
+        assert len(self.changes_added) == 0
+
+        # the next attempt succeeds after the retry delay
+        request_json = self.load_fixture('pull-request-26-files')
+        self.http.expect('get', '/repos/ursa-labs/ursabot/pulls/26/files',
+                         params={'per_page': 100, 'page': 1},
+                         content_json=request_json)
+        request_json = self.load_fixture('pull-request-26-commit')
+        self.http.expect('get', f'/repos/ursa-labs/ursabot/commits/{commit}',
+                         content_json=request_json)
+        self.reactor.advance(GithubHook.queue_retry_delay)
+        assert len(self.changes_added) == 1
+
+    @ensure_deferred
+    async def test_queued_changes_are_not_added_twice(self):
+        self.patch(GithubHook, 'queue_path', ':memory:')
+        payload = self.load_fixture('event-pull-request-opened')
+
+        updates = self.master.data.updates
+        add_change, failures = updates.addChange, [RuntimeError('locked')]
+
+        def flaky_add_change(**kwargs):
+            if failures:
+                raise failures.pop()
+            return add_change(**kwargs)
+
+        self.patch(updates, 'addChange', flaky_add_change)
+
+        # the handler is called only once, the retry adds the stored change
+        request_json = self.load_fixture('pull-request-26-files')
+        self.http.expect('get', '/repos/ursa-labs/ursabot/pulls/26/files',
+                         params={'per_page': 100, 'page': 1},
+                         content_json=request_json)
+        request_json = self.load_fixture('pull-request-26-commit')
+        commit = '2705da2b616b98fa6010a25813c5a7a27456f71d'
+        self.http.expect('get', f'/repos/ursa-labs/ursabot/commits/{commit}',
+                         content_json=request_json)
+        await self.trigger('pull_request', payload=payload)
+        assert len(self.changes_added) == 0
+
+        self.reactor.advance(GithubHook.queue_retry_delay)
+        assert len(self.changes_added) == 1
+        assert self.changes_added[0]['branch'] == 'refs/pull/26/merge'
+
+    @ensure_deferred
+    async def test_queue_worker_survives_database_errors(self):
+        self.patch(GithubHook, 'queue_path', ':memory:')
+        self.patch(GithubHook, 'queue_workers', 1)
+        payload = self.load_fixture('event-pull-request-opened')
+        hook = self.hook.makeHandler('github').handler
+        queue = hook._get_queue()
+
+        get, failures = queue.get, [RuntimeError('database is locked')]
+
+        def flaky_get(now=None):
+            if failures:
+                raise failures.pop()
+            return get(now=now)
+
+        self.patch(queue, 'get', flaky_get)
+        await self.trigger('pull_request', payload=payload)
+        assert len(self.changes_added) == 0
+
+        request_json = self.load_fixture('pull-request-26-files')
+        self.http.expect('get', '/repos/ursa-labs/ursabot/pulls/26/files',
+                         params={'per_page': 100, 'page': 1},
+                         content_json=request_json)
+        request_json = self.load_fixture('pull-request-26-commit')
+        commit = '2705da2b616b98fa6010a25813c5a7a27456f71d'
+        self.http.expect('get', f'/repos/ursa-labs/ursabot/commits/{commit}',
+                         content_json=request_json)
+        self.reactor.advance(GithubHook.queue_retry_delay)
+        assert len(self.changes_added) == 1
+
+    @ensure_deferred
+    async def test_queue_is_closed_on_shutdown(self):
+        self.patch(GithubHook, 'queue_path', ':memory:')
+        payload = self.load_fixture('event-pull-request-opened')
+        hook = self.hook.makeHandler('github').handler
+
+        # the first attempt fails, so the payload stays in the queue
+        self.http.expect('get', '/repos/ursa-labs/ursabot/pulls/26/files',
+                         params={'per_page': 100, 'page': 1}, code=500,
+                         content='not json')
+        request_json = self.load_fixture('pull-request-26-commit')
+        commit = '2705da2b616b98fa6010a25813c5a7a27456f71d'
+        self.http.expect('get', f'/repos/ursa-labs/ursabot/commits/{commit}',
+                         content_json=request_json)
+        await self.trigger('pull_request', payload=payload)
+        queue = hook._queue
+        assert len(queue) == 1
+
+        # the workers are stopped and the queue is closed
+        await self.master.stopService()
+        assert hook._queue is None
+        assert all(worker.called for worker in hook._workers)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            len(queue)
+
+        # the payload is not retried after the shutdown
+        self.reactor.advance(GithubHook.queue_retry_delay)
+        self.http.assertNoOutstanding()
+        assert len(self.changes_added) == 0
+
+    @ensure_deferred
+    async def test_queue_of_the_previous_handler_is_stopped(self):
+        self.patch(GithubHook, 'queue_path', ':memory:')
+        hook = self.hook.makeHandler('github').handler
+        queue = hook._get_queue()
+
+        # e.g. the change hook resource is recreated by a reconfiguration
+        other = copy.copy(hook)
+        other._queue, other._workers = None, []
+        assert other._get_queue() is not queue
+        assert hook._queue is None
+        assert all(worker.called for worker in hook._workers)
+        assert other._queue is not None
+
     @ensure_deferred
     async def test_pull_request_with_skip_message(self):
         payload = self.load_fixture('event-pull-request-opened')
 
-        # handle_pull_request fetches the commit message, it won't fetch the
-        # affected files if the commit contains a skip pattern
+        # handle_pull_request fetches the commit message and the affected
+        # files concurrently, the files are discarded if the commit message
+        # contains a skip pattern
+        request_json = self.load_fixture('pull-request-26-files')
+        self.http.expect('get', '/repos/ursa-labs/ursabot/pulls/26/files',
+                         params={'per_page': 100, 'page': 1},
+                         content_json=request_json)
         request_json = self.load_fixture('pull-request-26-commit')
         request_json['commit']['message'] = 'commit message [skip ci]'
         commit = '2705da2b616b98fa6010a25813c5a7a27456f71d'
@@ -238,10 +509,15 @@ class TestUrsabotHook(ChangeHookTestCase):
     async def check_issue_comment_with_command(
         self, command, expected_props=None, commit_message=None
     ):
-        # handle_issue_comment queries the pull request
+        # handle_issue_comment queries the pull request and the affected files
+        # concurrently
         request_json = self.load_fixture('pull-request-26')
         self.http.expect('get', '/repos/ursa-labs/ursabot/pulls/26',
                          content_json=request_json)
+        request_json = self.load_fixture('pull-request-26-files')
+        self.http.expect('get', '/repos/ursa-labs/ursabot/pulls/26/files',
+                         params={'per_page': 100, 'page': 1},
+                         content_json=request_json)
         # trigger handle_pull_request which fetches the commit
         request_json = self.load_fixture('pull-request-26-commit')
         if commit_message is not None:
@@ -249,10 +525,6 @@ class TestUrsabotHook(ChangeHookTestCase):
         commit = '2705da2b616b98fa6010a25813c5a7a27456f71d'
         self.http.expect('get', f'/repos/ursa-labs/ursabot/commits/{commit}',
                          content_json=request_json)
-        # trigger handle_pull_request which fetches the affected files
-        request_json = self.load_fixture('pull-request-26-files')
-        self.http.expect('get', f'/repos/ursa-labs/ursabot/pulls/26/files',
-                         content_json=request_json)
 
         # then responds to the comment
         request_url = '/repos/ursa-labs/ursabot/issues/26/comments'
@@ -1,7 +1,9 @@
 import os
+from types import SimpleNamespace
 from unittest.mock import patch
 
 import pytest
+from twisted.internet import defer
 from twisted.trial import unittest
 from buildbot.test.util.misc import TestReactorMixin
 from buildbot.process.results import FAILURE, EXCEPTION
@@ -100,6 +102,19 @@ class TestMasterTestcase(TestReactorMixin, unittest.TestCase):
         assert result['results'] == 0
         assert result['bsid'] == 1
 
+    @pytest.mark.docker
+    @pytest.mark.integration
+    @ensure_deferred
+    async def test_concurrent_builds(self):
+        async with _TestMaster(master, reactor=self.reactor) as m:
+            results = await defer.gatherResults([
+                defer.ensureDeferred(m.build(echoer.name, sourcestamp)),
+                defer.ensureDeferred(m.build(failer.name, sourcestamp))
+            ])
+
+        assert [r['complete'] for r in results] == [True, True]
+        assert [r['results'] for r in results] == [0, FAILURE]
+
     @pytest.mark.docker
     @pytest.mark.integration
     @ensure_deferred
@@ -112,3 +127,76 @@ class TestMasterTestcase(TestReactorMixin, unittest.TestCase):
                                    attach_on=attach_on) as m:
                 await m.build(failer.name, sourcestamp)
             method.assert_called_once()
+
+
+class TestMasterLogStreaming(TestReactorMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpTestReactor()
+
+    @ensure_deferred
+    async def test_fetch_only_the_appended_lines(self):
+        logs = {1: ['a', 'b', 'c', 'd'], 2: ['x', 'y']}
+        queries, handled = [], []
+
+        async def get(path, offset=None, limit=None):
+            kind, id = path[:2]
+            if kind == 'steps':
+                return {'buildid': id}
+            elif kind == 'builds':
+                return {'builderid': id}
+            elif kind == 'builders':
+                return {'name': f'builder-{id}'}
+            queries.append((id, offset, limit))
+            lines = logs[id][offset:offset + limit]
+            return {'content': '\n'.join(lines) + '\n'}
+
+        def handler(lines, builder_name):
+            handled.extend(f'{builder_name}: {line}' for line in lines)
+
+        m = _TestMaster(master, reactor=self.reactor, log_handler=handler)
+        m._master.data.get = get
+
+        await m._on_log_creation(None, {'logid': 1, 'stepid': 1})
+        await m._on_log_creation(None, {'logid': 2, 'stepid': 2})
+        await m._on_log_append(None, {'logid': 1, 'type': 's', 'num_lines': 2})
+        await m._on_log_append(None, {'logid': 2, 'type': 't', 'num_lines': 1})
+        await m._on_log_append(None, {'logid': 1, 'type': 's', 'num_lines': 4})
+        await m._on_log_append(None, {'logid': 2, 'type': 't', 'num_lines': 2})
+        await m._on_log_append(None, {'logid': 3, 'type': 'h', 'num_lines': 1})
+
+        assert queries == [(1, 0, 2), (2, 0, 1), (1, 2, 2), (2, 1, 1)]
+        assert handled == [
+            'builder-1: a',
+            'builder-1: b',
+            'builder-2: x',
+            'builder-1: c',
+            'builder-1: d',
+            'builder-2: y'
+        ]
+
+
+class TestMasterBuildsets(TestReactorMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpTestReactor()
+
+    @ensure_deferred
+    async def test_buildset_completed_before_registration(self):
+        m = _TestMaster(master, reactor=self.reactor)
+
+        async def find_builder_id(name):
+            return 1
+
+        async def add_buildset(**kwargs):
+            # the buildset completes before the build method registers it
+            await m._on_buildset_complete(None, {'bsid': 7, 'results': 0})
+            return 7, {1: 1}
+
+        m._master.data.updates = SimpleNamespace(
+            findBuilderId=find_builder_id,
+            addBuildset=add_buildset
+        )
+        result = await m.build(echoer.name, sourcestamp)
+        assert result == {'bsid': 7, 'results': 0}
+        assert m._completed == {}
@@ -8,7 +8,11 @@
 # derivative works of Buildbot. The above license only applies to code that
 # is not marked as such.
 
+from types import SimpleNamespace
+from unittest import mock
+
 import pytest
+from twisted.internet import defer
 from twisted.trial import unittest
 from buildbot.config import ConfigErrors
 from buildbot.process.properties import Property, Interpolate, renderer
@@ -21,7 +25,7 @@ from buildbot.test.util.reporter import ReporterTestMixin
 from ursabot.reporters import (HttpStatusPush, ZulipStatusPush,
                                GitHubStatusPush, GitHubReviewPush,
                                GitHubCommentPush)
-from ursabot.formatters import Formatter
+from ursabot.formatters import Formatter, MarkdownFormatter
 from ursabot.builders import Builder
 from ursabot.utils import ensure_deferred
 from ursabot.tests.mocks import GithubClientService
@@ -244,8 +248,9 @@ class GithubReporterTestCase(HttpReporterTestCase):
             verify=None
         )
 
-    async def setupReporter(self):
-        reporter = self.Reporter(tokens=self.TOKENS, formatter=DumbFormatter())
+    async def setupReporter(self, **kwargs):
+        reporter = self.Reporter(tokens=self.TOKENS, formatter=DumbFormatter(),
+                                 **kwargs)
         await reporter.setServiceParent(self.master)
         return reporter
 
@@ -290,7 +295,7 @@ class TestGitHubStatusPush(GithubReporterTestCase):
             }
         )
 
-        reporter = await self.setupReporter()
+        reporter = await self.setupReporter(batch_window=0)
         build = await self.setupBuildResults(SUCCESS, complete=False)
 
         reporter.buildStarted(('build', 20, 'started'), build)
@@ -299,6 +304,167 @@ class TestGitHubStatusPush(GithubReporterTestCase):
         build['results'] = FAILURE
         reporter.buildFinished(('build', 20, 'finished'), build)
 
+    @ensure_deferred
+    async def test_batching(self):
+        reporter = await self.setupReporter(batch_window=2)
+        build = await self.setupBuildResults(SUCCESS, complete=False)
+
+        # the started state is superseded within the window
+        reporter.buildStarted(('build', 20, 'started'), build)
+        build['complete'] = True
+        reporter.buildFinished(('build', 20, 'finished'), build)
+        self._http.expect(
+            'post',
+            '/repos/buildbot/buildbot/statuses/d34db33fd43db33f',
+            json={
+                'state': 'success',
+                'target_url': 'http://localhost:8080/#builders/79/builds/0',
+                'description': 'success',
+                'context': 'ursabot/Builder0'
+            }
+        )
+        self.reactor.advance(2)
+        self._http.assertNoOutstanding()
+
+        # the pending batch is flushed on shutdown
+        build['results'] = FAILURE
+        reporter.buildFinished(('build', 20, 'finished'), build)
+        self._http.expect(
+            'post',
+            '/repos/buildbot/buildbot/statuses/d34db33fd43db33f',
+            json={
+                'state': 'failure',
+                'target_url': 'http://localhost:8080/#builders/79/builds/0',
+                'description': 'failure',
+                'context': 'ursabot/Builder0'
+            }
+        )
+        await self.master.stopService()
+
+    @ensure_deferred
+    async def test_running_batch_is_awaited_on_shutdown(self):
+        reporter = await self.setupReporter(batch_window=2)
+        build = await self.setupBuildResults(SUCCESS, complete=False)
+
+        response = defer.Deferred()
+        posted = []
+
+        def post(urlpath, json):
+            posted.append(json['state'])
+            return response
+
+        with mock.patch.object(reporter._http, 'post', side_effect=post):
+            reporter.buildStarted(('build', 20, 'started'), build)
+            self.reactor.advance(2)
+            assert posted == ['pending']
+
+            # the shutdown waits for the batch flushed by the timer
+            stopped = self.master.stopService()
+            assert not stopped.called
+            response.callback(SimpleNamespace(code=201))
+            assert stopped.called
+            await stopped
+
+    @ensure_deferred
+    async def test_outbox(self):
+        reporter = await self.setupReporter(batch_window=0,
+                                            outbox=':memory:')
+        build = await self.setupBuildResults(SUCCESS, complete=False)
+
+        # the server error is retried with backoff
+        self._http.expect(
+            'post',
+            '/repos/buildbot/buildbot/statuses/d34db33fd43db33f',
+            json={
+                'state': 'pending',
+                'target_url': 'http://localhost:8080/#builders/79/builds/0',
+                'description': 'started',
+                'context': 'ursabot/Builder0'
+            },
+            code=502
+        )
+        reporter.buildStarted(('build', 20, 'started'), build)
+        self._http.assertNoOutstanding()
+
+        # the pending state is superseded before the retry
+        self.reactor.advance(1)
+        build['complete'] = True
+        reporter.buildFinished(('build', 20, 'finished'), build)
+        assert reporter.outbox_stats() == {
+            'depth': 1,
+            'oldest_age': 1,
+            'sent': 0,
+            'retries': 1,
+            'failures': 0,
+            'superseded': 1
+        }
+
+        self._http.expect(
+            'post',
+            '/repos/buildbot/buildbot/statuses/d34db33fd43db33f',
+            json={
+                'state': 'success',
+                'target_url': 'http://localhost:8080/#builders/79/builds/0',
+                'description': 'success',
+                'context': 'ursabot/Builder0'
+            },
+            code=201
+        )
+        self.reactor.advance(reporter.outbox_poll_interval)
+        self._http.assertNoOutstanding()
+        assert reporter.outbox_stats() == {
+            'depth': 0,
+            'oldest_age': None,
+            'sent': 1,
+            'retries': 1,
+            'failures': 0,
+            'superseded': 1
+        }
+        await self.master.stopService()
+
+    @ensure_deferred
+    async def test_outbox_in_flight(self):
+        reporter = await self.setupReporter(batch_window=0,
+                                            outbox=':memory:')
+        build = await self.setupBuildResults(SUCCESS, complete=False)
+
+        requests = []
+
+        def post(urlpath, json):
+            requests.append((json['state'], defer.Deferred()))
+            return requests[-1][1]
+
+        def respond(code):
+            response = SimpleNamespace(code=code,
+                                       content=lambda: defer.succeed(b''))
+            requests[-1][1].callback(response)
+
+        with mock.patch.object(reporter._http, 'post', side_effect=post):
+            reporter.buildStarted(('build', 20, 'started'), build)
+            assert [state for state, _ in requests] == ['pending']
+
+            # the newer status waits for the one in flight
+            build['complete'] = True
+            reporter.buildFinished(('build', 20, 'finished'), build)
+            assert [state for state, _ in requests] == ['pending']
+
+            # the failed stale status is not retried after the newer one
+            respond(502)
+            assert [state for state, _ in requests] == ['pending', 'success']
+            respond(201)
+            self.reactor.advance(reporter.outbox_max_backoff)
+            assert [state for state, _ in requests] == ['pending', 'success']
+
+        assert reporter.outbox_stats() == {
+            'depth': 0,
+            'oldest_age': None,
+            'sent': 1,
+            'retries': 0,
+            'failures': 0,
+            'superseded': 1
+        }
+        await self.master.stopService()
+
     @ensure_deferred
     async def test_empty(self):
         reporter = await self.setupReporter()
@@ -346,6 +512,22 @@ class TestGitHubCommentPush(GithubReporterTestCase):
         build['results'] = FAILURE
         reporter.buildFinished(('build', 20, 'finished'), build)
 
+    @ensure_deferred
+    async def test_steps_are_queried_only_if_logs_are_needed(self):
+        reporter = self.Reporter(tokens=self.TOKENS,
+                                 formatter=MarkdownFormatter())
+        await reporter.setServiceParent(self.master)
+
+        build = await self.setupBuildResults(SUCCESS, complete=False)
+        assert reporter.neededDetailsFor(build) == {'wantProperties': True}
+        build['complete'] = True
+        assert reporter.neededDetailsFor(build) == {'wantProperties': True}
+        build['results'] = FAILURE
+        assert reporter.neededDetailsFor(build) == {
+            'wantProperties': True,
+            'wantSteps': True
+        }
+
     @ensure_deferred
     async def test_empty(self):
         reporter = await self.setupReporter()
@@ -359,6 +541,101 @@ class TestGitHubCommentPush(GithubReporterTestCase):
         reporter.buildFinished(('build', 20, 'finished'), build)
 
 
+class TestConsolidatedGitHubCommentPush(GithubReporterTestCase):
+
+    Reporter = GitHubCommentPush
+
+    def expected_body(self, status):
+        url = 'http://localhost:8080/#builders/79/builds/0'
+        return '\n'.join([
+            '| Builder | Status |',
+            '| --- | --- |',
+            f'| Builder0 | [{status}]({url}) |',
+            '',
+            '#### Builder0',
+            '',
+            status
+        ])
+
+    @ensure_deferred
+    async def test_basic(self):
+        reporter = await self.setupReporter(consolidate=True, batch_window=5)
+        build = await self.setupBuildResults(SUCCESS, complete=False)
+
+        # the comment is created with the latest state of the window
+        reporter.buildStarted(('build', 20, 'started'), build)
+        build['complete'] = True
+        reporter.buildFinished(('build', 20, 'finished'), build)
+        self._http.expect(
+            'post',
+            '/repos/buildbot/buildbot/issues/34/comments',
+            json={'body': self.expected_body('success')},
+            content_json={'id': 123}
+        )
+        self.reactor.advance(5)
+        self._http.assertNoOutstanding()
+
+        # then edited in place using the cached comment id
+        build['results'] = FAILURE
+        reporter.buildFinished(('build', 20, 'finished'), build)
+        self._http.expect(
+            'patch',
+            '/repos/buildbot/buildbot/issues/comments/123',
+            json={'body': self.expected_body('failure')},
+            content_json={'id': 123}
+        )
+        self.reactor.advance(5)
+
+    @ensure_deferred
+    async def test_pending_comments_are_not_evicted(self):
+        reporter = await self.setupReporter(consolidate=True, batch_window=5)
+        self.patch(reporter, 'consolidated_cache_size', 1)
+        params = dict(repo_owner='buildbot', repo_name='buildbot', issue='34')
+        url = 'http://localhost:8080/#builders/79/builds/0'
+
+        def report(bsid):
+            build = {
+                'buildset': {'bsid': bsid},
+                'builder': {'name': 'Builder0'},
+                'complete': True,
+                'results': SUCCESS,
+                'url': url
+            }
+            reporter._consolidate(params, build, 'success')
+
+        # both buildsets are kept until their comments are created
+        report(1)
+        report(2)
+        self._http.expect(
+            'post',
+            '/repos/buildbot/buildbot/issues/34/comments',
+            json={'body': self.expected_body('success')},
+            content_json={'id': 123}
+        )
+        self._http.expect(
+            'post',
+            '/repos/buildbot/buildbot/issues/34/comments',
+            json={'body': self.expected_body('success')},
+            content_json={'id': 456}
+        )
+        self.reactor.advance(5)
+        self._http.assertNoOutstanding()
+
+        # the least recently reported buildset is evicted, the comment of
+        # the reported one is still edited in place
+        report(1)
+        assert list(reporter._consolidated) == [
+            ('buildbot', 'buildbot', '34', 1)
+        ]
+        self._http.expect(
+            'patch',
+            '/repos/buildbot/buildbot/issues/comments/123',
+            json={'body': self.expected_body('success')},
+            content_json={'id': 123}
+        )
+        self.reactor.advance(5)
+
+
 class TestGitHubReviewPush(GithubReporterTestCase):
 
     Reporter = GitHubReviewPush
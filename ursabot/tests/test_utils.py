@@ -10,15 +10,24 @@
 
 import json
 import mock
+from pathlib import Path
 from collections import namedtuple
 from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Union
 
-from twisted.internet import reactor
+import pytest
+
+from twisted.internet import defer, reactor
 from twisted.trial import unittest
+from twisted.web.http_headers import Headers
 from buildbot.util import httpclientservice
 from buildbot.util import service
 
-from ursabot.utils import GithubClientService, Filter, Glob, ensure_deferred
+from ursabot.utils import (CachedResponse, GithubClientService, Filter, Glob,
+                           Has, Index, Matching, PhaseTimer, Platform,
+                           Annotable, QueueFull, SqliteQueue, TokenScheduler,
+                           compile_validator,
+                           strict_validation, ensure_deferred)
 
 
 def test_filter():
@@ -53,6 +62,201 @@ def test_filter():
     ]
 
 
+def test_index():
+    Item = namedtuple('Item', ('name', 'tags', 'id'))
+    items = [
+        Item(name='a', tags=['x', 'y'], id=1),
+        Item(name='b', tags=['y'], id=2),
+        Item(name='a', tags=[], id=3),
+        Item(name=['unhashable'], tags=['x'], id=4),
+        Item(name={'unhashable': 1}, tags=['z'], id=5),
+        Item(name=[{'unhashable': 2}], tags=['z'], id=6),
+    ]
+    index = Index(items, keys=('name', 'tags'))
+
+    assert index.select(name='a') == [items[0], items[2]]
+    assert index.select(name='a', id=3) == [items[2]]
+    assert index.select(name='c') == []
+    assert index.select(tags=Has('y')) == [items[0], items[1]]
+    assert index.select(tags=Has('x', 'y')) == [items[0]]
+    assert index.select(name='a', tags=Has('y')) == [items[0]]
+    # globs and other callables fall back to scanning the items
+    assert index.select(name=Matching('[ab]')) == items[:3]
+    assert index.select(id=4) == [items[3]]
+    assert index.select(name=['unhashable']) == [items[3]]
+    # the unhashable values are not indexed, but still matched
+    assert index.select(name={'unhashable': 1}) == [items[4]]
+    assert index.select(name=[{'unhashable': 2}]) == [items[5]]
+    assert index.select(name='a', tags=Has('z')) == []
+
+    assert index.first(name='b') is items[1]
+    with pytest.raises(KeyError):
+        index.first(name='c')
+
+    # the index gives the same results as the filter
+    for criteria in [dict(name='a'), dict(tags=Has('x')), dict(id=2),
+                     dict(tags=Has('z'))]:
+        assert index.select(**criteria) == list(
+            filter(Filter(**criteria), items)
+        )
+
+
+def test_index_nested_keys():
+    Item = namedtuple('Item', ('name', 'platform'))
+    items = [
+        Item(name='a', platform=Platform(arch='amd64', distro='ubuntu',
+                                         version='18.04')),
+        Item(name='b', platform=Platform(arch='arm64v8', distro='ubuntu',
+                                         version='18.04')),
+        Item(name='c', platform=Platform(arch='amd64', distro='debian',
+                                         version='9')),
+    ]
+    index = Index(items, keys=('name', 'platform.arch', 'platform.distro'))
+
+    ubuntu = Filter(distro='ubuntu')
+    assert index._candidates({'platform': ubuntu}) == {0, 1}
+    assert index.select(platform=ubuntu) == items[:2]
+    assert index.select(platform=Filter(arch='amd64', distro='ubuntu'),
+                        name='a') == items[:1]
+    # the non-indexed nested criteria are checked by the filter
+    criteria = dict(platform=Filter(arch='amd64', version=Matching('9*')))
+    assert index._candidates(criteria) == {0, 2}
+    assert index.select(**criteria) == items[2:]
+
+
+@pytest.mark.parametrize(('annotation', 'valid', 'invalid'), [
+    (Any, [None, 1, 'a'], []),
+    (int, [1, True], ['1', None]),
+    (Optional[str], ['a', None], [1]),
+    (Union[Path, str], [Path('a'), 'a'], [1, None]),
+    (Union[List[int], str], [[1], 'a'], [['a'], 1]),
+    (List, [[], [1, 'a']], [(), {}]),
+    (List[int], [[], [1, 2]], [[1, 'a'], (1,), None]),
+    (Dict[str, List[int]], [{}, {'a': [1]}], [{1: [1]}, {'a': ['b']}, []]),
+    (Callable, [len, lambda: 1], [1]),
+    (Callable[[int], int], [lambda x: x], [lambda: 1, 1]),
+])
+def test_compile_validator(annotation, valid, invalid):
+    validate = compile_validator(annotation)
+    assert compile_validator(annotation) is validate
+
+    for value in valid:
+        validate('value', value)
+    for value in invalid:
+        with pytest.raises(TypeError):
+            validate('value', value)
+
+
+def test_annotable_validation():
+    class Config(Annotable):
+        name: str
+        tags: List[str] = []
+
+    assert Config(name='a').tags == []
+    with pytest.raises(TypeError):
+        Config(name=1)
+    with pytest.raises(TypeError):
+        Config(name='a', tags=[1])
+
+    # a default invalidated after the class definition is only caught by the
+    # strict validation
+    Config.__fields__['tags'].default.append(1)
+    assert Config(name='a').tags == [1]
+    with strict_validation():
+        with pytest.raises(TypeError):
+            Config(name='a')
+
+
+def test_phase_timer():
+    timer = PhaseTimer()
+
+    @timer.timed('outer')
+    def outer(depth):
+        with timer.measure('inner'):
+            if depth:
+                outer(depth - 1)
+
+    outer(2)
+    assert not timer.calls
+
+    timer.enabled = True
+    outer(2)
+    # nested measurements of the same phase are counted once
+    assert timer.calls == {'outer': 1, 'inner': 1}
+    assert timer.elapsed['outer'] >= timer.elapsed['inner'] > 0
+
+
+def test_sqlite_queue(tmp_path):
+    path = tmp_path / 'queue.sqlite'
+    queue = SqliteQueue(path, maxsize=2, history=1)
+    assert queue.put('a', {'value': 1})
+    assert not queue.put('a', {'value': 1})
+    assert queue.put(None, [2])
+    assert len(queue) == 2
+    with pytest.raises(QueueFull):
+        queue.put('c', 3)
+
+    rowid, item, attempts = queue.get(now=0)
+    assert (item, attempts) == ({'value': 1}, 0)
+    queue.nack(rowid, delay=10, now=0)
+    # the released item is not available until the delay expires
+    assert queue.get(now=5)[1:] == ([2], 0)
+    assert queue.get(now=5) is None
+    assert queue.get(now=10) == (rowid, {'value': 1}, 1)
+    queue.ack(rowid)
+    assert len(queue) == 1
+    # the acknowledged keys are remembered
+    assert not queue.put('a', {'value': 1})
+
+    # the claimed but not acknowledged items are delivered after a restart
+    queue.close()
+    queue = SqliteQueue(path, maxsize=2, history=1)
+    assert queue.get(now=0)[1:] == ([2], 0)
+    queue.close()
+
+
+def test_sqlite_queue_replace(tmp_path):
+    queue = SqliteQueue(tmp_path / 'queue.sqlite')
+    assert queue.oldest() is None
+    assert queue.put('a', 'first', now=1, replace=True)
+    # the pending item is superseded
+    assert not queue.put('a', 'second', now=2, replace=True)
+    assert len(queue) == 1
+    assert queue.oldest() == 1
+
+    rowid, item, _ = queue.get(now=3)
+    assert item == 'second'
+    # the claimed item is not replaced, but a new one is enqueued
+    assert queue.put('a', 'third', now=4, replace=True)
+    queue.ack(rowid)
+    assert queue.oldest() == 4
+    assert queue.get(now=5)[1] == 'third'
+    queue.close()
+
+
+def test_sqlite_queue_replace_in_flight():
+    queue = SqliteQueue(':memory:')
+    assert queue.put('a', 'first', now=1, replace=True)
+    assert queue.put('b', 'other', now=1, replace=True)
+    rowid, item, _ = queue.get(now=2)
+    assert item == 'first'
+
+    # the newer item waits until the claimed one of the same key is released
+    assert queue.put('a', 'second', now=3, replace=True)
+    other, item, _ = queue.get(now=4)
+    assert item == 'other'
+    assert queue.get(now=4) is None
+
+    # the superseded item is dropped instead of being retried
+    assert not queue.nack(rowid, now=5)
+    rowid, item, attempts = queue.get(now=5)
+    assert (item, attempts) == ('second', 0)
+    assert queue.nack(rowid, delay=1, now=6)
+    assert queue.nack(other, now=6)
+    assert len(queue) == 2
+    queue.close()
+
+
 Request = namedtuple('Request', ['method', 'url', 'params', 'headers', 'data'])
 Response = namedtuple('Response', ['code', 'headers', 'body'])
 
@@ -162,141 +366,236 @@ class GithubClientServiceTest(unittest.TestCase):
         with self.responses(responses):
             await self.http.get('/repos/ursa-labs/ursabot')
 
-    @ensure_deferred
-    async def test_rotation_because_of_reaching_limit(self):
+    def exchange(self, token, code=200, headers=None, body=None):
         from treq.testing import HasHeaders
+        return (
+            Request(
+                method=b'get',
+                url='https://api.github.com/repos/ursa-labs/ursabot',
+                params=mock.ANY,
+                headers=HasHeaders({'Authorization': [f'token {token}']}),
+                data=mock.ANY
+            ),
+            Response(code=code, headers=headers or {}, body=as_json(body))
+        )
 
-        self.http.rotate_at = 1000  # this id the default
+    @ensure_deferred
+    async def test_dispatching_on_the_token_with_most_headroom(self):
+        # the tokens without observed rate limits are considered fresh
+        responses = [
+            self.exchange('A', headers={'X-RateLimit-Remaining': '4000'}),
+            self.exchange('B', headers={'X-RateLimit-Remaining': '4500'}),
+            self.exchange('C', headers={'X-RateLimit-Remaining': '100'}),
+            self.exchange('B', headers={'X-RateLimit-Remaining': '4499'}),
+            self.exchange('B', headers={'X-RateLimit-Remaining': '3999'}),
+            self.exchange('A', headers={'X-RateLimit-Remaining': '3999'}),
+        ]
+        with self.responses(responses):
+            for _ in range(6):
+                await self.http.get('/repos/ursa-labs/ursabot')
+
+    @ensure_deferred
+    async def test_retrying_because_of_exhausted_rate_limit(self):
+        reset = str(int(reactor.seconds()) + 3600)
+        responses = [
+            self.exchange('A', code=403, headers={
+                'X-RateLimit-Remaining': '0',
+                'X-RateLimit-Reset': reset
+            }),
+            self.exchange('B', headers={'X-RateLimit-Remaining': '10'}),
+            self.exchange('C', headers={'X-RateLimit-Remaining': '9'}),
+            self.exchange('B', headers={'X-RateLimit-Remaining': '8'}),
+        ]
+        with self.responses(responses):
+            for _ in range(3):
+                await self.http.get('/repos/ursa-labs/ursabot')
+
+    @ensure_deferred
+    async def test_retrying_because_of_secondary_rate_limit(self):
+        responses = [
+            self.exchange('A', code=403, headers={
+                'X-RateLimit-Remaining': '4000',
+                'Retry-After': '60'
+            }),
+            self.exchange('B', headers={'X-RateLimit-Remaining': '3000'}),
+            self.exchange('C', headers={'X-RateLimit-Remaining': '2000'}),
+            self.exchange('B', headers={'X-RateLimit-Remaining': '2999'}),
+        ]
+        with self.responses(responses):
+            for _ in range(3):
+                await self.http.get('/repos/ursa-labs/ursabot')
+
+    @ensure_deferred
+    async def test_retrying_because_of_forbidden_access(self):
+        # each token is tried once then the last response is returned
+        responses = [
+            self.exchange('A', code=404),
+            self.exchange('B', code=403),
+            self.exchange('C', code=401),
+        ]
+        with self.responses(responses):
+            response = await self.http.get('/repos/ursa-labs/ursabot')
+            assert response.code == 401
+
+    @ensure_deferred
+    async def test_immutable_responses_are_cached(self):
+        commit = '2705da2b616b98fa6010a25813c5a7a27456f71d'
+        endpoint = f'/repos/ursa-labs/ursabot/commits/{commit}'
         responses = [
             (
                 Request(
                     method=b'get',
-                    url='https://api.github.com/repos/ursa-labs/ursabot',
-                    params=mock.ANY,
-                    headers=HasHeaders({'Authorization': ['token A']}),
-                    data=mock.ANY
-                ),
-                Response(
-                    code=200,
-                    headers={'X-RateLimit-Remaining': f'{i}'},
-                    body=as_json({})
-                )
-            )
-            for i in (1002, 1001, 1000)
-        ] + [
-            (
-                Request(
-                    method=b'get',
-                    url='https://api.github.com/rate_limit',
+                    url=f'https://api.github.com{endpoint}',
                     params=mock.ANY,
-                    headers=HasHeaders({'Authorization': ['token B']}),
+                    headers=mock.ANY,
                     data=mock.ANY
                 ),
                 Response(
                     code=200,
                     headers={'X-RateLimit-Remaining': '5000'},
-                    body=as_json({'rate': {'remaining': 5000}})
-                )
-            ),
-            (
-                Request(
-                    method=b'get',
-                    url='https://api.github.com/repos/ursa-labs/ursabot',
-                    params=mock.ANY,
-                    headers=HasHeaders({'Authorization': ['token B']}),
-                    data=mock.ANY
-                ),
-                Response(
-                    code=200,
-                    headers={'X-RateLimit-Remaining': '4999'},
-                    body=as_json({})
+                    body=as_json({'sha': commit})
                 )
             )
         ]
-
         with self.responses(responses):
-            for _ in range(4):
-                await self.http.get('/repos/ursa-labs/ursabot')
+            for _ in range(3):
+                response = await self.http.get(endpoint)
+                assert await response.json() == {'sha': commit}
+
+        assert self.http.cache.stats() == {
+            'hits': 2, 'misses': 1, 'revalidations': 0, 'size': 1
+        }
 
     @ensure_deferred
-    async def test_rotation_becasue_of_forbidden_access(self):
+    async def test_mutable_responses_are_revalidated(self):
         from treq.testing import HasHeaders
 
-        self.http.rotate_at = 1000  # this id the default
+        url = 'https://api.github.com/repos/ursa-labs/ursabot/pulls/26'
         responses = [
             (
                 Request(
                     method=b'get',
-                    url='https://api.github.com/repos/ursa-labs/ursabot',
-                    params=mock.ANY,
-                    headers=HasHeaders({'Authorization': ['token A']}),
-                    data=mock.ANY
-                ),
-                Response(
-                    code=403,
-                    headers={'X-RateLimit-Remaining': '0'},
-                    body=as_json({})
-                )
-            ),
-            (
-                Request(
-                    method=b'get',
-                    url='https://api.github.com/rate_limit',
-                    params=mock.ANY,
-                    headers=HasHeaders({'Authorization': ['token B']}),
-                    data=mock.ANY
-                ),
-                Response(
-                    code=200,
-                    headers={'X-RateLimit-Remaining': '900'},
-                    body=as_json({'rate': {'remaining': 900}})
-                )
-            ),
-            (
-                Request(
-                    method=b'get',
-                    url='https://api.github.com/rate_limit',
+                    url=url,
                     params=mock.ANY,
-                    headers=HasHeaders({'Authorization': ['token C']}),
+                    headers=mock.ANY,
                     data=mock.ANY
                 ),
                 Response(
                     code=200,
-                    headers={'X-RateLimit-Remaining': '5000'},
-                    body=as_json({'rate': {'remaining': 5000}})
+                    headers={'X-RateLimit-Remaining': '5000', 'ETag': '"a"'},
+                    body=as_json({'number': 26})
                 )
             ),
             (
                 Request(
                     method=b'get',
-                    url='https://api.github.com/repos/ursa-labs/ursabot',
+                    url=url,
                     params=mock.ANY,
-                    headers=HasHeaders({'Authorization': ['token C']}),
+                    headers=HasHeaders({'If-None-Match': ['"a"']}),
                     data=mock.ANY
                 ),
                 Response(
-                    code=200,
-                    headers={'X-RateLimit-Remaining': '4999'},
-                    body=as_json({})
+                    code=304,
+                    headers={'X-RateLimit-Remaining': '5000', 'ETag': '"a"'},
+                    body=b''
                 )
             ),
             (
                 Request(
                     method=b'get',
-                    url='https://api.github.com/repos/ursa-labs/ursabot',
+                    url=url,
                     params=mock.ANY,
-                    headers=HasHeaders({'Authorization': ['token C']}),
+                    headers=HasHeaders({'If-None-Match': ['"a"']}),
                     data=mock.ANY
                 ),
                 Response(
                     code=200,
-                    headers={'X-RateLimit-Remaining': '4998'},
-                    body=as_json({})
+                    headers={'X-RateLimit-Remaining': '4999', 'ETag': '"b"'},
+                    body=as_json({'number': 26, 'title': 'changed'})
                 )
             )
-
         ]
-
         with self.responses(responses):
-            await self.http.get('/repos/ursa-labs/ursabot')
-            await self.http.get('/repos/ursa-labs/ursabot')
+            response = await self.http.get('/repos/ursa-labs/ursabot/pulls/26')
+            assert await response.json() == {'number': 26}
+            response = await self.http.get('/repos/ursa-labs/ursabot/pulls/26')
+            assert await response.json() == {'number': 26}
+            response = await self.http.get('/repos/ursa-labs/ursabot/pulls/26')
+            assert await response.json() == {'number': 26, 'title': 'changed'}
+
+        assert self.http.cache.stats() == {
+            'hits': 1, 'misses': 2, 'revalidations': 1, 'size': 1
+        }
+
+    @ensure_deferred
+    async def test_concurrent_identical_requests_are_coalesced(self):
+        requests = []
+
+        def do_request(method, endpoint, **kwargs):
+            requests.append((method, endpoint, kwargs))
+            deferred = defer.Deferred()
+            pending.append(deferred)
+            return deferred
+
+        pending = []
+        self.patch(self.http, '_do_request', do_request)
+
+        first = self.http.get('/repos/ursa-labs/ursabot/pulls/26')
+        second = self.http.get('/repos/ursa-labs/ursabot/pulls/26')
+        other = self.http.get('/repos/ursa-labs/ursabot/pulls/27')
+        assert len(requests) == 2
+        assert self.http.coalesced == 1
+
+        for deferred, number in zip(pending, [26, 27]):
+            body = as_json({'number': number})
+            deferred.callback(CachedResponse(200, Headers(), body))
+
+        first, second, other = await defer.gatherResults(
+            [first, second, other]
+        )
+        assert first is second
+        assert await first.json() is await second.json()
+        assert await other.json() == {'number': 27}
+
+        # the subsequent requests are not coalesced with the finished ones
+        self.http.get('/repos/ursa-labs/ursabot/pulls/26')
+        assert len(requests) == 3
+
+
+def test_token_scheduler():
+    scheduler = TokenScheduler(['A', 'B'])
+    assert scheduler.pick(now=0) == ('A', 0)
+
+    def headers(**kwargs):
+        return Headers({k.replace('_', '-'): [v] for k, v in kwargs.items()})
+
+    limited = scheduler.update('A', 200, headers(
+        X_RateLimit_Remaining='10', X_RateLimit_Reset='100'
+    ), now=0)
+    assert not limited
+    assert scheduler.pick(now=0) == ('B', 0)
+
+    limited = scheduler.update('B', 403, headers(
+        X_RateLimit_Remaining='0', X_RateLimit_Reset='50'
+    ), now=0)
+    assert limited
+    assert scheduler.pick(now=0) == ('A', 0)
+    # the reset restores the quota
+    assert scheduler.pick(now=60) == ('B', 0)
+
+    limited = scheduler.update('A', 403, headers(
+        X_RateLimit_Remaining='0', X_RateLimit_Reset='100'
+    ), now=10)
+    assert limited
+    # every token is exhausted, wait until the earliest reset
+    assert scheduler.pick(now=10) == ('B', 40)
+
+    # forbidden access is not related to the rate limit
+    limited = scheduler.update('A', 403, headers(), now=200)
+    assert not limited
+
+    limited = scheduler.update('A', 429, headers(Retry_After='30'), now=200)
+    assert limited
+    assert scheduler.remaining('A', now=210) == 0
+    assert scheduler.pick(now=210, exclude={'B'}) == ('A', 20)
+    assert scheduler.pick(now=210, exclude={'A', 'B'}) == (None, 0)
@@ -15,7 +15,14 @@
 #
 # Copyright Buildbot Team Members
 
+import copy
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
 import pytest
+from docker.errors import NotFound
+from twisted.trial import unittest
 from buildbot.config import ConfigErrors
 from buildbot.plugins import util
 from buildbot.test.fake import docker
@@ -24,7 +31,36 @@ from buildbot.worker import docker as dockerworker
 from buildbot.test.unit.test_worker_docker import TestDockerLatentWorker
 
 from ursabot.utils import Platform
-from ursabot.workers import DockerLatentWorker
+from ursabot.workers import (DockerLatentWorker, DockerClientPool,
+                             DockerImageCache)
+
+
+class CachingClient(docker.Client):
+
+    def __init__(self, base_url):
+        super().__init__(base_url)
+        self._ids = itertools.count()
+        self._image_id = 'sha256:1'
+
+    def create_container(self, image, *args, **kwargs):
+        self.call_args_create_container.append(kwargs)
+        id = '{:064x}'.format(next(self._ids))
+        self._containers[id] = {
+            'Id': id,
+            'Image': self._image_id,
+            'name': kwargs['name'],
+            'Names': ['/' + kwargs['name']]
+        }
+        return {'Id': id, 'Warnings': None}
+
+    def inspect_image(self, image):
+        return {'Id': self._image_id}
+
+    def inspect_container(self, id):
+        try:
+            return self._containers[id]
+        except KeyError:
+            raise NotFound(id)
 
 
 class TestDockerLatentWorker(TestDockerLatentWorker):
@@ -32,6 +68,8 @@ class TestDockerLatentWorker(TestDockerLatentWorker):
     def setupWorker(self, *args, **kwargs):
         docker.Client.close = lambda self: None
         self.patch(dockerworker, 'docker', docker)
+        self.patch(DockerLatentWorker, 'client_pool', DockerClientPool())
+        self.patch(DockerLatentWorker, 'image_cache', DockerImageCache())
 
         platform = Platform(
             arch='amd64',
@@ -109,3 +147,192 @@ class TestDockerLatentWorker(TestDockerLatentWorker):
         self.assertEqual(name, 'tester:latest')
         client = docker.Client.latest
         self.assertEqual(client._pullCount, 0)
+
+    def test_container_cache(self):
+        self.patch(dockerworker, 'client',
+                   SimpleNamespace(Client=CachingClient))
+        bs = self.setupWorker(
+            'bot', 'pass', 'tcp://1234:2375', 'tester:latest',
+            container_cache_size=2
+        )
+
+        # the cache is filled after the first container is torn down
+        self.successResultOf(bs.start_instance(self.build))
+        self.successResultOf(bs.stop_instance())
+        client = CachingClient.latest
+        cached = {c['Id'] for c in client._containers.values()}
+        assert len(cached) == 2
+
+        # the next build claims a cached container instead of creating one
+        id, name = self.successResultOf(bs.start_instance(self.build))
+        assert name == 'tester:latest'
+        assert id in cached
+        assert len(client.call_args_create_container) == 3
+        self.successResultOf(bs.stop_instance())
+        assert len(client._containers) == 2
+
+        # cached containers created from an outdated image are discarded
+        client._image_id = 'sha256:2'
+        id, name = self.successResultOf(bs.start_instance(self.build))
+        assert list(client._containers) == [id]
+        assert client._containers[id]['Image'] == 'sha256:2'
+
+    def test_container_cache_with_always_pull(self):
+        self.patch(dockerworker, 'client',
+                   SimpleNamespace(Client=CachingClient))
+        bs = self.setupWorker(
+            'bot', 'pass', 'tcp://1234:2375', 'tester:latest', auto_pull=True,
+            always_pull=True, container_cache_size=1
+        )
+        synced = []
+        self.patch(bs.image_cache, 'sync',
+                   lambda host, client, image, exists: synced.append(image))
+
+        self.successResultOf(bs.start_instance(self.build))
+        self.successResultOf(bs.stop_instance())
+        client = CachingClient.latest
+        cached = set(client._containers)
+        count = len(synced)
+
+        # the image is synchronized even if a cached container is claimed
+        id, name = self.successResultOf(bs.start_instance(self.build))
+        assert id in cached
+        assert len(synced) == count + 1
+
+    def test_container_cache_is_not_copied(self):
+        # configurations containing the workers are deep-copied
+        bs = DockerLatentWorker(
+            'bot', 'pass', 'tcp://1234:2375', 'tester:latest',
+            platform=Platform.detect(), container_cache_size=2
+        )
+        bs._container_cache['key'].append({'Id': '1'})
+        copied = copy.deepcopy(bs)
+        assert not copied._container_cache
+        assert copied._cache_lock is not bs._cache_lock
+
+    def test_container_cache_size_validation(self):
+        with pytest.raises(ConfigErrors):
+            self.setupWorker('bot', 'pass', 'unix:///var/run/docker.sock',
+                             container_cache_size=-1)
+
+
+class FakeClient:
+
+    def __init__(self, healthy=True):
+        self.healthy = healthy
+        self.closed = False
+
+    def ping(self):
+        if not self.healthy:
+            raise ConnectionError()
+
+    def close(self):
+        self.closed = True
+
+
+class DockerClientPoolTest(unittest.TestCase):
+
+    def test_reuse_per_docker_host(self):
+        pool = DockerClientPool()
+        a = pool.key({'base_url': 'tcp://a:2375'})
+        b = pool.key({'base_url': 'tcp://b:2375'})
+
+        client = pool.acquire(a, FakeClient)
+        pool.release(a, client)
+        assert pool.acquire(a, FakeClient) is client
+        assert pool.acquire(b, FakeClient) is not client
+        # the client is checked out, so a new one is created
+        assert pool.acquire(a, FakeClient) is not client
+
+    def test_idle_eviction(self):
+        pool = DockerClientPool(max_idle_time=-1)
+        key = pool.key({'base_url': 'tcp://a:2375'})
+
+        client = pool.acquire(key, FakeClient)
+        pool.release(key, client)
+        assert pool.acquire(key, FakeClient) is not client
+        assert client.closed
+
+    def test_health_check(self):
+        pool = DockerClientPool(check_interval=-1)
+        key = pool.key({'base_url': 'tcp://a:2375'})
+
+        client = pool.acquire(key, FakeClient)
+        pool.release(key, client)
+        assert pool.acquire(key, FakeClient) is client
+
+        client.healthy = False
+        pool.release(key, client)
+        assert pool.acquire(key, FakeClient) is not client
+        assert client.closed
+
+
+class FakeRegistryClient:
+
+    def __init__(self, local='sha256:a', remote='sha256:a'):
+        self.local = local
+        self.remote = remote
+        self.pulls = 0
+
+    def inspect_image(self, image):
+        return {'RepoDigests': [f'{image}@{self.local}']}
+
+    def inspect_distribution(self, image):
+        return {'Descriptor': {'digest': self.remote}}
+
+    def pull(self, image):
+        self.pulls += 1
+        self.local = self.remote
+
+
+class DockerImageCacheTest(unittest.TestCase):
+
+    def test_skip_pull_if_digest_is_unchanged(self):
+        cache = DockerImageCache(ttl=-1)
+        client = FakeRegistryClient()
+        assert cache.sync('tcp://a:2375', client, 'ursalab/img') is False
+        assert client.pulls == 0
+
+        client.remote = 'sha256:b'
+        assert cache.sync('tcp://a:2375', client, 'ursalab/img') is True
+        assert client.pulls == 1
+
+    def test_pull_missing_image(self):
+        cache = DockerImageCache(ttl=-1)
+        client = FakeRegistryClient()
+        cache.sync('tcp://a:2375', client, 'ursalab/img', exists=False)
+        assert client.pulls == 1
+
+    def test_ttl(self):
+        cache = DockerImageCache(ttl=300)
+        client = FakeRegistryClient(local='sha256:a', remote='sha256:b')
+        assert cache.sync('tcp://a:2375', client, 'ursalab/img') is True
+        client.remote = 'sha256:c'
+        # the registry is not queried again within the interval
+        assert cache.sync('tcp://a:2375', client, 'ursalab/img') is False
+        assert cache.sync('tcp://b:2375', client, 'ursalab/img') is True
+        assert client.pulls == 2
+
+    def test_pull_missing_image_within_ttl(self):
+        cache = DockerImageCache(ttl=300)
+        client = FakeRegistryClient(local='sha256:a', remote='sha256:a')
+        assert cache.sync('tcp://a:2375', client, 'ursalab/img') is False
+
+        # the image is removed from the host, e.g. by pruning
+        assert cache.sync('tcp://a:2375', client, 'ursalab/img',
+                          exists=False) is True
+        assert client.pulls == 1
+        assert cache.sync('tcp://a:2375', client, 'ursalab/img') is False
+        assert client.pulls == 1
+
+    def test_coalesce_concurrent_pulls(self):
+        cache = DockerImageCache(ttl=300)
+        client = FakeRegistryClient(local='sha256:a', remote='sha256:b')
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [
+                executor.submit(cache.sync, 'tcp://a:2375', client,
+                                'ursalab/img')
+                for _ in range(8)
+            ]
+        assert sum(f.result() for f in futures) == 1
+        assert client.pulls == 1
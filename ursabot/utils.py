@@ -4,19 +4,28 @@
 # Use of this source code is governed by a BSD 2-Clause
 # license that can be found in the LICENSE_BSD file.
 
+import re
 import copy
+import json
+import time
 import platform
 import pathlib
+import sqlite3
 import fnmatch
-import itertools
+import typing
+import operator
+import functools
+import collections
+import collections.abc
 from functools import wraps
-from typing import ClassVar
+from contextlib import contextmanager
+from typing import ClassVar, Union
 
 import distro
 import toolz
 import typeguard
 from twisted.internet import defer
-from buildbot.util import httpclientservice
+from buildbot.util import httpclientservice, asyncSleep
 from buildbot.util.logger import Logger
 
 __all__ = [
@@ -27,10 +36,21 @@ __all__ = [
     'Matching',
     'Glob',
     'Filter',
+    'Index',
     'Annotable',
+    'compile_validator',
+    'strict_validation',
     'Merge',
     'Extend',
+    'PhaseTimer',
+    'startup_timer',
+    'QueueFull',
+    'SqliteQueue',
+    'IdleWaiters',
     'HTTPClientService',
+    'CachedResponse',
+    'ResponseCache',
+    'TokenScheduler',
     'GithubClientService',
 ]
 
@@ -46,6 +66,58 @@ def ensure_deferred(fn):
     return wrapper
 
 
+class PhaseTimer:
+    """Accumulates the wall-clock time spent in named phases
+
+    Used for profiling the configuration loading, it is disabled by default
+    so the measurements are no-ops. Nested measurements of the same phase are
+    counted only once, but the phases may overlap with each other, e.g. the
+    builders are instantiated during the execution of the config files.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.elapsed = collections.defaultdict(float)
+        self.calls = collections.Counter()
+        self._depth = collections.Counter()
+
+    def measure(self, phase):
+        if self.enabled:
+            return self._measure(phase)
+        else:
+            return self._skip()
+
+    @contextmanager
+    def _skip(self):
+        yield
+
+    @contextmanager
+    def _measure(self, phase):
+        self._depth[phase] += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._depth[phase] -= 1
+            if not self._depth[phase]:
+                self.elapsed[phase] += time.perf_counter() - start
+                self.calls[phase] += 1
+
+    def timed(self, phase):
+        """Decorator measuring each call of the function as phase"""
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.measure(phase):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+# shared by the configuration loading machinery and the CLI
+startup_timer = PhaseTimer()
+
+
 def read_dependency_list(path):
     """Parse plaintext files with comments as list of dependencies"""
     path = pathlib.Path(path)
@@ -84,14 +156,115 @@ class MISSING:
     pass
 
 
+def _type_error(name, expected, value):
+    if isinstance(expected, type):
+        expected = typeguard.qualified_name(expected)
+    return TypeError(f'type of {name} must be {expected}; got '
+                     f'{typeguard.qualified_name(value)} instead')
+
+
+def _typing_origin(annotation):
+    origin = getattr(annotation, '__origin__', None)
+    # on python 3.6 the origin of the parametrized generics is the generic
+    # itself, e.g. List[int].__origin__ is List and List.__extra__ is list
+    return getattr(origin, '__extra__', origin)
+
+
+def _typing_args(annotation):
+    args = getattr(annotation, '__args__', None) or ()
+    # the unparametrized generics are parametrized with type variables
+    # since python 3.7, e.g. List.__args__ == (T,)
+    if any(isinstance(arg, typing.TypeVar) for arg in args):
+        return ()
+    return tuple(args)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_validator(annotation):
+    """Generate a validator function for a type annotation
+
+    The validators are generated once per annotation and raise TypeError like
+    typeguard.check_type does. Plain classes, unions of them, lists, dicts
+    and bare callables are checked directly, the rest of the annotations are
+    delegated to typeguard.
+
+    Returns
+    -------
+    validator: Callable[[str, Any], None]
+        Accepts the name and the value to validate.
+    """
+    origin = _typing_origin(annotation)
+    args = _typing_args(annotation)
+
+    if annotation is typing.Any:
+        def validate(name, value):
+            pass
+    elif isinstance(annotation, type) and origin is None:
+        def validate(name, value):
+            if not isinstance(value, annotation):
+                raise _type_error(name, annotation, value)
+    elif origin is Union and all(isinstance(a, type) for a in args):
+        def validate(name, value):
+            if not isinstance(value, args):
+                raise _type_error(name, annotation, value)
+    elif origin is Union:
+        validators = [compile_validator(a) for a in args]
+
+        def validate(name, value):
+            for validator in validators:
+                try:
+                    return validator(name, value)
+                except TypeError:
+                    pass
+            raise _type_error(name, annotation, value)
+    elif origin is list and args:
+        validate_item = compile_validator(args[0])
+
+        def validate(name, value):
+            if not isinstance(value, list):
+                raise _type_error(name, list, value)
+            for i, item in enumerate(value):
+                validate_item(f'{name}[{i}]', item)
+    elif origin is dict and args:
+        validate_key = compile_validator(args[0])
+        validate_value = compile_validator(args[1])
+
+        def validate(name, value):
+            if not isinstance(value, dict):
+                raise _type_error(name, dict, value)
+            for k, v in value.items():
+                validate_key(f'keys of {name}', k)
+                validate_value(f'{name}[{k!r}]', v)
+    elif origin in (list, dict):
+        def validate(name, value):
+            if not isinstance(value, origin):
+                raise _type_error(name, origin, value)
+    elif origin is collections.abc.Callable and not args:
+        def validate(name, value):
+            if not callable(value):
+                raise _type_error(name, 'a callable', value)
+    else:
+        # e.g. the signature of the parametrized callables is checked by
+        # typeguard
+        def validate(name, value):
+            typeguard.check_type(name, value, annotation)
+
+    return validate
+
+
 class Field:
 
-    __slots__ = ('name', 'type', 'default')
+    __slots__ = ('name', 'type', 'default', '_validator')
+
+    # check every value with typeguard, including the defaults, see the
+    # strict_validation context manager
+    strict = False
 
     def __init__(self, name, type, default):
         self.name = name
         self.type = type
         self.default = default
+        self._validator = compile_validator(type)
         if default is not MISSING:
             self.validate(default)
 
@@ -99,7 +272,25 @@ class Field:
         return Field(name=self.name, type=self.type, default=new_default)
 
     def validate(self, value):
-        typeguard.check_type(self.name, value, self.type)
+        if Field.strict:
+            typeguard.check_type(self.name, value, self.type)
+        else:
+            self._validator(self.name, value)
+
+
+@contextmanager
+def strict_validation(enabled=True):
+    """Validate the Annotable objects' fields exhaustively with typeguard
+
+    By default the fields are checked with the cached validators generated by
+    compile_validator and the default values are only validated once, when
+    the class is defined.
+    """
+    previous, Field.strict = Field.strict, enabled
+    try:
+        yield
+    finally:
+        Field.strict = previous
 
 
 class AnnotableMeta(type):
@@ -148,6 +339,7 @@ class AnnotableMeta(type):
 
 class Annotable(metaclass=AnnotableMeta):
 
+    @startup_timer.timed('annotable validation')
     def __init__(self, **kwargs):
         # TODO(kszucs): collect errors
         for name, field in self.__fields__.items():
@@ -162,8 +354,14 @@ class Annotable(metaclass=AnnotableMeta):
                     )
                 else:
                     value = copy.copy(field.default)
+                    is_default = True
+            else:
+                is_default = value is field.default
 
-            field.validate(value)
+            # the defaults are already validated when the class is defined
+            # and the shallow copies share the validated items
+            if Field.strict or not is_default:
+                field.validate(value)
             setattr(self, name, value)
 
     def __repr__(self):
@@ -189,8 +387,15 @@ class Annotable(metaclass=AnnotableMeta):
 # Utilities for filtering
 
 
-def Has(*needles):
-    return lambda haystack: set(needles).issubset(set(haystack))
+class Has:
+
+    __slots__ = ('needles',)
+
+    def __init__(self, *needles):
+        self.needles = needles
+
+    def __call__(self, haystack):
+        return set(self.needles).issubset(set(haystack))
 
 
 def InstanceOf(cls):
@@ -234,9 +439,15 @@ def AllOf(*validators):
     return check
 
 
-def Filter(**kwargs):
-    def check(obj):
-        for attr, validator in kwargs.items():
+class Filter:
+
+    __slots__ = ('criteria',)
+
+    def __init__(self, **criteria):
+        self.criteria = criteria
+
+    def __call__(self, obj):
+        for attr, validator in self.criteria.items():
             value = getattr(obj, attr)
             if callable(validator):
                 if not validator(value):
@@ -245,7 +456,102 @@ def Filter(**kwargs):
                 if value != validator:
                     return False
         return True
-    return check
+
+
+class Index:
+    """Lookup tables of objects keyed by the values of their attributes
+
+    The exact-match criteria of a Filter and the needles of Has criteria are
+    answered from the lookup tables, including the criteria of nested Filters
+    on the dotted keys, then the candidates are checked against the whole
+    filter. Without indexable criteria (e.g. for globs) it falls
+    back to scanning all of the items. The items are always returned in their
+    original order.
+
+    Parameters
+    ----------
+    items: Iterable
+    keys: Iterable[str], default ('name',)
+        Attribute names to index, dotted names like `platform.arch` refer to
+        nested attributes. Items without the attribute are omitted
+        from the lookup table, the elements of list, tuple and set values are
+        indexed one by one. Items with unhashable values are always returned
+        as candidates, thus checked by the filter.
+    """
+
+    def __init__(self, items, keys=('name',)):
+        self.items = list(items)
+        self._tables = {}
+        self._unindexed = {}
+        for key in keys:
+            getter = operator.attrgetter(key)
+            table = collections.defaultdict(set)
+            unindexed = set()
+            for position, item in enumerate(self.items):
+                try:
+                    value = getter(item)
+                except AttributeError:
+                    continue
+                if isinstance(value, (list, tuple, set)):
+                    elements = value
+                else:
+                    elements = [value]
+                for element in elements:
+                    try:
+                        table[element].add(position)
+                    except TypeError:
+                        unindexed.add(position)
+            self._tables[key] = dict(table)
+            self._unindexed[key] = unindexed
+
+    def _lookup(self, key, value):
+        try:
+            positions = self._tables[key].get(value, set())
+        except TypeError:
+            # unhashable value
+            return None
+        return positions | self._unindexed[key]
+
+    def _candidates(self, criteria, prefix=''):
+        candidates = None
+        for key, validator in criteria.items():
+            key = prefix + key
+            if isinstance(validator, Filter):
+                # e.g. platform=Filter(arch='amd64') is looked up from the
+                # table of platform.arch
+                positions = [self._candidates(validator.criteria, f'{key}.')]
+            elif key not in self._tables:
+                continue
+            elif isinstance(validator, Has):
+                positions = [self._lookup(key, n) for n in validator.needles]
+            elif not callable(validator):
+                positions = [self._lookup(key, validator)]
+            else:
+                continue
+            for p in positions:
+                if p is not None:
+                    candidates = p if candidates is None else candidates & p
+        return candidates
+
+    def _matching(self, criteria):
+        check = Filter(**criteria)
+        positions = self._candidates(criteria)
+        if positions is None:
+            items = self.items
+        else:
+            items = (self.items[p] for p in sorted(positions))
+        return (item for item in items if check(item))
+
+    def select(self, **criteria):
+        """Returns the items matching the Filter criteria"""
+        return list(self._matching(criteria))
+
+    def first(self, **criteria):
+        """Returns the first matching item or raises KeyError"""
+        try:
+            return next(self._matching(criteria))
+        except StopIteration:
+            raise KeyError(criteria)
 
 
 # Platform definition
@@ -375,6 +681,217 @@ class Platform:
         )
 
 
+class QueueFull(Exception):
+    pass
+
+
+class SqliteQueue:
+    """Bounded, durable FIFO queue backed by sqlite
+
+    The items must be JSON serializable. An item is claimed by `get` and
+    stays in the queue until it is acknowledged, so the items claimed but not
+    acknowledged before a restart are delivered again. The keys of the
+    acknowledged items are remembered for deduplication, unless the items are
+    put with `replace=True` which supersedes the pending item of the same key.
+    The items put with `replace=True` are delivered one at a time per key, and
+    a claimed item released by `nack` is dropped if it has been superseded in
+    the meantime, so a stale item is never delivered after a newer one.
+
+    The operations are executed synchronously, they are short statements
+    touching a single row of a local database in write-ahead logging mode,
+    so they can be called from the reactor thread without the overhead and
+    the locking of dispatching them to a thread pool.
+
+    Parameters
+    ----------
+    path: str
+        Path of the sqlite database, `:memory:` creates a transient queue.
+    maxsize: int, default 1000
+        Maximum number of unacknowledged items.
+    history: int, default 10000
+        Number of acknowledged item keys to remember.
+    """
+
+    def __init__(self, path, maxsize=1000, history=10000):
+        self.path = path
+        self.maxsize = maxsize
+        self.history = history
+        self._db = sqlite3.connect(str(path), isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS queue ('
+            '  id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            '  key TEXT UNIQUE,'
+            '  topic TEXT,'
+            '  item TEXT NOT NULL,'
+            '  state TEXT NOT NULL,'
+            '  attempts INTEGER NOT NULL DEFAULT 0,'
+            '  available_at REAL NOT NULL DEFAULT 0,'
+            '  created_at REAL NOT NULL DEFAULT 0'
+            ')'
+        )
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS queue_topic ON queue (topic, state)'
+        )
+        # release the items claimed before a restart
+        self._db.execute(
+            "UPDATE queue SET state = 'pending' WHERE state = 'processing'"
+        )
+
+    def __len__(self):
+        (count,) = self._db.execute(
+            "SELECT COUNT(*) FROM queue WHERE state != 'done'"
+        ).fetchone()
+        return count
+
+    def put(self, key, item, now=0, replace=False):
+        """Enqueues the item
+
+        Returns False if no new item has been added, because the key has been
+        seen or because the pending item with the same key has been replaced.
+        """
+        item = json.dumps(item)
+        topic = None
+        if replace and key is not None:
+            cursor = self._db.execute(
+                'UPDATE queue SET item = ? '
+                "WHERE topic = ? AND state = 'pending'",
+                (item, key)
+            )
+            if cursor.rowcount:
+                return False
+            # the replaceable items are not deduplicated, only the pending
+            # and the claimed items of the same topic are related
+            key, topic = None, key
+
+        if len(self) >= self.maxsize:
+            raise QueueFull(f'Queue {self.path} is full')
+        cursor = self._db.execute(
+            'INSERT OR IGNORE INTO queue '
+            '(key, topic, item, state, available_at, created_at) '
+            "VALUES (?, ?, ?, 'pending', ?, ?)",
+            (key, topic, item, now, now)
+        )
+        return cursor.rowcount == 1
+
+    def oldest(self):
+        """Creation time of the oldest unacknowledged item or None"""
+        (created_at,) = self._db.execute(
+            "SELECT MIN(created_at) FROM queue WHERE state != 'done'"
+        ).fetchone()
+        return created_at
+
+    def get(self, now=None):
+        """Claims the oldest available item
+
+        Returns a tuple of (id, item, attempts) or None if no items are
+        available at `now`. An item is not available while another item of
+        the same topic is claimed.
+        """
+        now = time.time() if now is None else now
+        row = self._db.execute(
+            'SELECT id, item, attempts FROM queue AS q '
+            "WHERE state = 'pending' AND available_at <= ? AND ("
+            '  topic IS NULL OR NOT EXISTS ('
+            '    SELECT 1 FROM queue WHERE topic = q.topic '
+            "    AND state = 'processing'"
+            '  )'
+            ') ORDER BY id LIMIT 1',
+            (now,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        rowid, item, attempts = row
+        self._db.execute(
+            "UPDATE queue SET state = 'processing' WHERE id = ?", (rowid,)
+        )
+        return rowid, json.loads(item), attempts
+
+    def update(self, rowid, item):
+        """Replaces the claimed item, e.g. to record its processing progress"""
+        self._db.execute('UPDATE queue SET item = ? WHERE id = ?',
+                         (json.dumps(item), rowid))
+
+    def ack(self, rowid):
+        """Marks the item as done and forgets the oldest acknowledged keys"""
+        self._db.execute("UPDATE queue SET state = 'done' WHERE id = ?",
+                         (rowid,))
+        self._db.execute(
+            "DELETE FROM queue WHERE state = 'done' AND id NOT IN ("
+            "  SELECT id FROM queue WHERE state = 'done' "
+            '  ORDER BY id DESC LIMIT ?'
+            ')',
+            (self.history,)
+        )
+
+    def nack(self, rowid, delay=0, now=None):
+        """Releases the item to be claimed again after the delay
+
+        Returns False if the item has been dropped instead, because a newer
+        item of the same topic has been put since it was claimed.
+        """
+        now = time.time() if now is None else now
+        cursor = self._db.execute(
+            "UPDATE queue SET state = 'done' WHERE id = ? AND EXISTS ("
+            '  SELECT 1 FROM queue AS newer '
+            '  WHERE newer.topic = queue.topic AND newer.id > queue.id'
+            ')',
+            (rowid,)
+        )
+        if cursor.rowcount:
+            return False
+        self._db.execute(
+            "UPDATE queue SET state = 'pending', attempts = attempts + 1, "
+            'available_at = ? WHERE id = ?',
+            (now + delay, rowid)
+        )
+        return True
+
+    def close(self):
+        self._db.close()
+
+
+class IdleWaiters:
+    """Parks the consumers of a queue until there is work for them
+
+    Parameters
+    ----------
+    reactor: twisted reactor
+        Used for scheduling the wakeup after the timeout.
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self._waiters = {}
+
+    def __len__(self):
+        return len(self._waiters)
+
+    def wait(self, timeout):
+        """Returns a Deferred fired by `wake` or after the timeout"""
+        waiter = defer.Deferred()
+        self._waiters[waiter] = self.reactor.callLater(timeout, self._fire,
+                                                       waiter)
+        return waiter
+
+    def _fire(self, waiter):
+        timer = self._waiters.pop(waiter)
+        if timer.active():
+            timer.cancel()
+        waiter.callback(None)
+
+    def wake(self):
+        """Wakes up one of the waiting consumers"""
+        if self._waiters:
+            self._fire(next(iter(self._waiters)))
+
+    def wake_all(self):
+        for waiter in list(self._waiters):
+            self._fire(waiter)
+
+
 # Buildbot utilities
 
 
@@ -394,31 +911,227 @@ class HTTPClientService(httpclientservice.HTTPClientService):
         return url, kwargs
 
 
+class CachedResponse:
+    """HTTP response with its content already read into memory
+
+    Unlike the responses of treq, it can be consumed multiple times, so it can
+    be returned from a cache or shared between concurrent requests. The JSON
+    content is parsed only once, so the result must be treated as read-only.
+    """
+
+    def __init__(self, code, headers, body):
+        self.code = code
+        self.headers = headers
+        self._body = body
+        self._json = None
+
+    def content(self):
+        return defer.succeed(self._body)
+
+    def json(self):
+        if self._json is None:
+            self._json = json.loads(self._body)
+        return defer.succeed(self._json)
+
+
+class ResponseCache:
+    """LRU cache for the responses of GET requests
+
+    The responses of immutable resources, like commits addressed by their
+    sha, are kept for the lifetime of the process. The mutable resources are
+    stored along with their ETag in a bounded LRU cache, so they can be
+    revalidated with conditional requests.
+
+    Parameters
+    ----------
+    maxsize: int, default 1024
+        Maximum number of mutable resources to store.
+    """
+
+    immutable_patterns = [
+        re.compile(r'^/repos/[^/]+/[^/]+/(git/)?commits/[0-9a-f]{40}$'),
+        re.compile(r'^/repos/[^/]+/[^/]+/git/(trees|blobs)/[0-9a-f]{40}$')
+    ]
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._immutable = {}
+        self._mutable = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._immutable) + len(self._mutable)
+
+    def is_immutable(self, endpoint):
+        return any(p.match(endpoint) for p in self.immutable_patterns)
+
+    @staticmethod
+    def key(endpoint, params=None, headers=None):
+        params = tuple(sorted((params or {}).items()))
+        headers = tuple(sorted((headers or {}).items()))
+        return (endpoint, params, headers)
+
+    def get(self, key):
+        """Returns the cached response or None"""
+        if key in self._immutable:
+            return self._immutable[key]
+        elif key in self._mutable:
+            self._mutable.move_to_end(key)
+            return self._mutable[key]
+        else:
+            return None
+
+    def put(self, key, response):
+        """Stores the response if it is immutable or revalidatable"""
+        endpoint, _, _ = key
+        if self.is_immutable(endpoint):
+            self._immutable[key] = response
+        elif response.headers.hasHeader('ETag'):
+            self._mutable[key] = response
+            self._mutable.move_to_end(key)
+            if len(self._mutable) > self.maxsize:
+                self._mutable.popitem(last=False)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidations': self.revalidations,
+            'size': len(self)
+        }
+
+
+class TokenScheduler:
+    """Tracks the rate limits of the GitHub API tokens
+
+    The remaining quota and the reset time of each token are updated from the
+    X-RateLimit-* headers of the responses, so choosing the token with the
+    most headroom doesn't require additional requests. Tokens which are
+    throttled by a Retry-After header are not used until it expires.
+
+    Parameters
+    ----------
+    tokens: List[str]
+        GitHub API tokens.
+    """
+
+    # the tokens without observed rate limit are assumed to be fresh
+    default_limit = 5000
+    # github recommends to wait at least a minute after hitting the
+    # secondary rate limit if the response doesn't contain Retry-After
+    secondary_backoff = 60
+
+    def __init__(self, tokens):
+        self.tokens = list(tokens)
+        self._remaining = dict.fromkeys(self.tokens)
+        self._reset = dict.fromkeys(self.tokens)
+        self._blocked_until = dict.fromkeys(self.tokens, 0)
+
+    def remaining(self, token, now):
+        """Estimated number of requests the token can issue at `now`"""
+        remaining, reset = self._remaining[token], self._reset[token]
+        if self._blocked_until[token] > now:
+            return 0
+        elif remaining is None or (reset is not None and reset <= now):
+            return self.default_limit
+        else:
+            return remaining
+
+    def available_at(self, token, now):
+        """The time when the token can issue requests again"""
+        if self.remaining(token, now) > 0:
+            return now
+        candidates = [self._blocked_until[token]]
+        if self._remaining[token] == 0 and self._reset[token] is not None:
+            candidates.append(self._reset[token])
+        return max(candidates)
+
+    def pick(self, now, exclude=()):
+        """Returns the token with the most headroom and the delay to wait
+
+        If every token is exhausted then the token available the earliest is
+        returned along with the delay until its reset. Returns None if no
+        tokens are left after the exclusion.
+        """
+        tokens = [t for t in self.tokens if t not in exclude]
+        if not tokens:
+            return None, 0
+
+        token = max(tokens, key=lambda t: self.remaining(t, now))
+        if self.remaining(token, now) > 0:
+            return token, 0
+
+        token = min(tokens, key=lambda t: self.available_at(t, now))
+        return token, max(self.available_at(token, now) - now, 0)
+
+    def update(self, token, code, headers, now):
+        """Updates the token's quota from the response
+
+        Returns True if the request has been rejected because of rate
+        limiting, so it is worth to retry it later.
+        """
+        def header(name, convert):
+            values = headers.getRawHeaders(name)
+            return None if values is None else convert(toolz.first(values))
+
+        remaining = header('X-RateLimit-Remaining', int)
+        reset = header('X-RateLimit-Reset', float)
+        retry_after = header('Retry-After', float)
+
+        if remaining is not None:
+            self._remaining[token] = remaining
+            self._reset[token] = reset
+
+        if code not in {403, 429}:
+            return False
+        elif retry_after is not None:
+            self._blocked_until[token] = now + retry_after
+        elif remaining == 0:
+            # the primary rate limit is exhausted until the reset
+            if reset is None:
+                self._blocked_until[token] = now + self.secondary_backoff
+        elif code == 429:
+            self._blocked_until[token] = now + self.secondary_backoff
+        else:
+            # forbidden access, not related to the rate limiting
+            return False
+
+        return True
+
+
 class GithubClientService(HTTPClientService):
+    """HTTP client for the GitHub API
+
+    Dispatches each request with the token having the most headroom, see
+    TokenScheduler, and caches the responses of the GET requests, see
+    ResponseCache. The cache statistics are available through
+    `cache.stats()`. Concurrent identical GET requests share a single
+    request and response, their number is counted by `coalesced`.
+    """
+
+    # the rate limit probes must not be served from the cache
+    uncached_endpoints = {'/rate_limit'}
 
-    def __init__(self, *args, tokens, rotate_at=1000, max_retries=5,
-                 headers=None, **kwargs):
-        assert rotate_at < 5000
-        tokens = list(tokens)
-        self._tokens = itertools.cycle(tokens)
-        self._n_tokens = len(tokens)
-        self._rotate_at = rotate_at
+    def __init__(self, *args, tokens, max_retries=5, headers=None,
+                 cache_size=1024, **kwargs):
+        self._scheduler = TokenScheduler(tokens)
         self._max_retries = max_retries
+        self.cache = ResponseCache(maxsize=cache_size)
+        self.coalesced = 0
+        self._inflight = {}
         headers = headers or {}
         headers.setdefault('User-Agent', 'Buildbot')
         super().__init__(*args, headers=headers, **kwargs)
 
-    def startService(self):
-        self._set_token(next(self._tokens))
-        return super().startService()
-
-    def _set_token(self, token):
-        if self._headers is None:
-            self._headers = {}
-        self._headers['Authorization'] = f'token {token}'
+    def _now(self):
+        return self.master.reactor.seconds()
 
     @ensure_deferred
     async def rate_limit(self, token=None):
+        if token is None:
+            token, _ = self._scheduler.pick(self._now())
         headers = {}
         if token is not None:
             headers['Authorization'] = f'token {token}'
@@ -429,59 +1142,133 @@ class GithubClientService(HTTPClientService):
         return data['rate']['remaining']
 
     @ensure_deferred
-    async def rotate_tokens(self):
-        # try each token, query its rate limit
-        # if none of them works log and sleep
-        for token in toolz.take(self._n_tokens, self._tokens):
-            remaining = await self.rate_limit(token)
+    async def _do_request(self, method, endpoint, headers=None, **kwargs):
+        headers = headers or {}
+        if not self._scheduler.tokens:
+            return await self._doRequest(method, endpoint, headers=headers,
+                                         **kwargs)
+
+        # tokens rejected for other reasons than rate limiting, e.g. bad
+        # credentials or missing access to a private repository
+        rejected = set()
+        response = None
+        for attempt in range(self._max_retries):
+            token, delay = self._scheduler.pick(self._now(), exclude=rejected)
+            if token is None:
+                break
+            elif delay > 0:
+                log.info(f'Every token has exhausted its rate limit, '
+                         f'waiting {delay:.0f}s before requesting {endpoint}')
+                await asyncSleep(delay, reactor=self.master.reactor)
+
+            response = await self._doRequest(
+                method,
+                endpoint,
+                headers={**headers, 'Authorization': f'token {token}'},
+                **kwargs
+            )
+            code = response.code
+            limited = self._scheduler.update(token, code, response.headers,
+                                             now=self._now())
+            if code // 100 != 4:
+                break
+
+            if limited:
+                reason = f'rate limit ({code})'
+            elif code == 401:
+                # Unauthorized: bad credentials
+                reason = 'bad credentials (401)'
+            elif code == 403:
+                # Forbidden: forbidden access
+                reason = 'forbidden access (403)'
+            elif code == 404:
+                # Requests that require authentication will return 404 Not
+                # Found, instead of 403 Forbidden, in some places. This is
+                # to prevent the accidental leakage of private repositories
+                # to unauthorized users.
+                reason = 'resource not found (404)'
+            else:
+                reason = f'status code {code}'
 
-            if remaining > self._rotate_at:
-                return self._set_token(token)
+            if not limited:
+                rejected.add(token)
+            log.info(f'Failed to fetch endpoint {endpoint} because of '
+                     f'{reason}. Retrying with the next token.')
+
+        return response
 
     @ensure_deferred
-    async def _do_request(self, method, endpoint, **kwargs):
-        for attempt in range(self._max_retries):
-            response = await self._doRequest(method, endpoint, **kwargs)
-            headers, code = response.headers, response.code
-
-            if code // 100 == 4:
-                if code == 401:
-                    # Unauthorized: bad credentials
-                    reason = 'bad credentials (401)'
-                elif code == 403:
-                    # Forbidden: exceeded rate limit or forbidden access
-                    reason = 'exceeded rate limit or forbidden access (403)'
-                elif code == 404:
-                    # Requests that require authentication will return 404 Not
-                    # Found, instead of 403 Forbidden, in some places. This is
-                    # to prevent the accidental leakage of private repositories
-                    # to unauthorized users.
-                    reason = 'resource not found (404)'
-                else:
-                    reason = f'status code {code}'
+    async def _cached_get(self, endpoint, params=None, headers=None,
+                          **kwargs):
+        key = self.cache.key(endpoint, params=params, headers=headers)
+        cached = self.cache.get(key)
+
+        if cached is not None:
+            if self.cache.is_immutable(endpoint):
+                self.cache.hits += 1
+                return cached
+            # revalidate the mutable resource, github doesn't count the not
+            # modified responses against the rate limit
+            etag = toolz.first(cached.headers.getRawHeaders('ETag'))
+            headers = {**(headers or {}), 'If-None-Match': etag}
+
+        response = await self._do_request('get', endpoint, params=params,
+                                          headers=headers, **kwargs)
+        if response.code == 304 and cached is not None:
+            self.cache.hits += 1
+            self.cache.revalidations += 1
+            return cached
+
+        self.cache.misses += 1
+        body = await response.content()
+        response = CachedResponse(response.code, response.headers, body)
+        if response.code == 200:
+            self.cache.put(key, response)
 
-                log.info(f'Failed to fetch endpoint {endpoint} because of '
-                         f' {reason}. Retrying with the next token.')
-                await self.rotate_tokens()
-            else:
-                if headers.hasHeader('X-RateLimit-Remaining'):
-                    values = headers.getRawHeaders('X-RateLimit-Remaining')
-                    remaining = int(toolz.first(values))
-                    if remaining <= self._rotate_at:
-                        log.info('Remaining rate limit has reached the '
-                                 'rotation limit, switching to the next '
-                                 'token.')
-                        await self.rotate_tokens()
-                break
+        return response
 
+    @ensure_deferred
+    async def _coalesced_get(self, endpoint, params=None, headers=None):
+        # the tokens are chosen by the client, so an explicitly passed
+        # authorization header is the only per-request credential
+        key = ('get', *self.cache.key(endpoint, params, headers))
+        if key in self._inflight:
+            self.coalesced += 1
+            waiter = defer.Deferred()
+            self._inflight[key].append(waiter)
+            return await waiter
+
+        # the waiters are notified after the request is unregistered, so they
+        # are free to issue the same request again
+        waiters = self._inflight[key] = []
+        try:
+            response = await self._cached_get(endpoint, params=params,
+                                              headers=headers)
+        except Exception:
+            del self._inflight[key]
+            for waiter in waiters:
+                waiter.errback()
+            raise
+
+        del self._inflight[key]
+        for waiter in waiters:
+            waiter.callback(response)
         return response
 
     def get(self, endpoint, **kwargs):
-        return self._do_request('get', endpoint, **kwargs)
+        if endpoint in self.uncached_endpoints:
+            return self._do_request('get', endpoint, **kwargs)
+        elif set(kwargs) <= {'params', 'headers'}:
+            return self._coalesced_get(endpoint, **kwargs)
+        else:
+            return self._cached_get(endpoint, **kwargs)
 
     def put(self, endpoint, **kwargs):
         return self._do_request('put', endpoint, **kwargs)
 
+    def patch(self, endpoint, **kwargs):
+        return self._do_request('patch', endpoint, **kwargs)
+
     def delete(self, endpoint, **kwargs):
         return self._do_request('delete', endpoint, **kwargs)
 
@@ -9,8 +9,13 @@
 # is not marked as such.
 
 import os
+import json
+import time
+import uuid
 import itertools
 import warnings
+import threading
+import collections
 from io import BytesIO
 from contextlib import contextmanager
 
@@ -33,12 +38,165 @@ from .utils import Platform, ensure_deferred
 __all__ = [
     'LocalWorker',
     'DockerLatentWorker',
+    'DockerClientPool',
+    'DockerImageCache',
     'load_workers_from',
 ]
 
 log = Logger()
 
 
+class DockerClientPool:
+    """Thread-safe pool of docker API clients shared between the workers
+
+    The clients are keyed by their connection arguments, so the workers
+    using the same docker daemon reuse each other's connections instead of
+    establishing a new one for each container start and stop.
+
+    Parameters
+    ----------
+    max_idle_time: int, default 300
+        Idle clients unused for longer than this many seconds are closed.
+    check_interval: int, default 30
+        Idle clients unused for longer than this many seconds are pinged
+        before reusing them, unhealthy clients are discarded.
+    """
+
+    def __init__(self, max_idle_time=300, check_interval=30):
+        self.max_idle_time = max_idle_time
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._idle = collections.defaultdict(list)
+
+    @staticmethod
+    def key(client_args):
+        return tuple(sorted(client_args.items()))
+
+    def _is_healthy(self, client):
+        try:
+            client.ping()
+        except Exception:
+            return False
+        else:
+            return True
+
+    def _evict(self, now):
+        # must be called with the lock held, returns the expired clients
+        expired = []
+        for key, entries in self._idle.items():
+            fresh = []
+            for client, last_used in entries:
+                if now - last_used > self.max_idle_time:
+                    expired.append(client)
+                else:
+                    fresh.append((client, last_used))
+            entries[:] = fresh
+        return expired
+
+    def acquire(self, key, factory):
+        """Checks out an idle client or creates a new one with factory"""
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                expired = self._evict(now)
+                entries = self._idle[key]
+                entry = entries.pop() if entries else None
+
+            for client in expired:
+                self.discard(client)
+
+            if entry is None:
+                return factory()
+
+            client, last_used = entry
+            if now - last_used < self.check_interval:
+                return client
+            elif self._is_healthy(client):
+                return client
+            else:
+                self.discard(client)
+
+    def release(self, key, client):
+        """Returns a client to the pool for later reuse"""
+        with self._lock:
+            self._idle[key].append((client, time.monotonic()))
+
+    def discard(self, client):
+        """Closes a client instead of returning it to the pool"""
+        try:
+            client.close()
+        except Exception as e:
+            log.info(f'Failed to close docker client: {e}')
+
+
+class DockerImageCache:
+    """Thread-safe bookkeeping of the images synchronized on the docker hosts
+
+    The registry is queried for the image's manifest digest at most once per
+    `ttl` seconds for each image and docker host. The image is only pulled if
+    it is missing or its local digests don't match the registry's. A missing
+    image is always pulled, even if it has been synchronized recently, since
+    it might have been removed from the host in the meantime. Concurrent
+    synchronizations of the same image on the same host are serialized, so
+    the builds waiting for an in-flight pull reuse its result instead of
+    pulling again.
+
+    Parameters
+    ----------
+    ttl: int, default 300
+        Seconds while a synchronized image is considered up to date.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._image_locks = {}
+        self._synced = {}
+
+    def _image_lock(self, key):
+        with self._lock:
+            return self._image_locks.setdefault(key, threading.Lock())
+
+    def _is_up_to_date(self, client, image):
+        try:
+            local = client.inspect_image(image).get('RepoDigests') or []
+            remote = client.inspect_distribution(image)['Descriptor']
+        except Exception as e:
+            log.info(f'Failed to compare the digests of image {image}: {e}')
+            return False
+        else:
+            digests = {d.split('@', 1)[-1] for d in local}
+            return remote['digest'] in digests
+
+    def sync(self, host, client, image, exists=True):
+        """Pulls the image unless it exists and has been synchronized recently
+
+        Returns True if the image has been pulled.
+        """
+        key = (host, image)
+        requested = time.monotonic()
+        with self._image_lock(key):
+            synced = self._synced.get(key)
+            if not exists and synced is not None and synced < requested:
+                # the image has been removed since the last sync, e.g. pruned,
+                # unless it has been pulled while waiting for the lock
+                del self._synced[key]
+                synced = None
+
+            now = time.monotonic()
+            if synced is not None and now - synced < self.ttl:
+                return False
+            elif exists and self._is_up_to_date(client, image):
+                log.info(f'Image {image} is up to date, skipping the pull')
+                pulled = False
+            else:
+                log.info(f'Pulling image {image}')
+                client.pull(image)
+                pulled = True
+            self._synced[key] = time.monotonic()
+            return pulled
+
+
 class BaseWorker:
 
     def __init__(self, *args, **kwargs):
@@ -94,8 +252,46 @@ class DockerLatentWorker(BaseWorker, DockerLatentWorker):
     missing_timeout: int, default 120
         Timeout for the worker preparation. In case of docker builders it is
         the time required to pull the docker image and spin up the container.
+    container_cache_size: int, default 0
+        Number of containers to keep pre-created, but not started, for each
+        image the worker has already run. A build claims a cached container
+        instead of checking the image and creating a new container, then the
+        cache is refilled in the background after the container is torn
+        down. The claimed container still has to be started and the worker
+        running in it has to connect back to the master, because buildbot
+        rejects the connections of a latent worker which is not substantiating.
+        Zero disables the cache.
     """
 
+    # docker clients and the image digests are shared between the workers of
+    # the same docker host
+    client_pool = DockerClientPool()
+    image_cache = DockerImageCache()
+
+    def __init__(self, *args, **kwargs):
+        self._reset_container_cache()
+        super().__init__(*args, **kwargs)
+
+    def __getstate__(self):
+        # the cached containers belong to the running worker, so don't copy
+        # them
+        state = self.__dict__.copy()
+        for key in ['_cache_lock', '_container_cache', '_cache_spec',
+                    '_cache_refill']:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_container_cache()
+
+    def _reset_container_cache(self):
+        # cached containers keyed by their creation arguments, see _cache_key
+        self._cache_lock = threading.Lock()
+        self._container_cache = collections.defaultdict(list)
+        self._cache_spec = None
+        self._cache_refill = None
+
     def supports(self, platform):
         if self.platform.system == 'darwin':
             # Docker on Mac can run multiple architectures of linux containers
@@ -117,11 +313,15 @@ class DockerLatentWorker(BaseWorker, DockerLatentWorker):
                     command=None, volumes=None, hostconfig=None,
                     auto_pull=False, always_pull=False,
                     follow_startup_logs=False, max_builds=None,
-                    **kwargs):
+                    container_cache_size=0, **kwargs):
         # Bypass the validation implemented in the parent class.
         if image is None:
             image = util.Property('docker_image', default=image)
 
+        if container_cache_size < 0:
+            raise config.error('`container_cache_size` must be a '
+                               'non-negative integer')
+
         if IRenderable.providedBy(image):
             if max_builds is None:
                 max_builds = 1
@@ -144,7 +344,7 @@ class DockerLatentWorker(BaseWorker, DockerLatentWorker):
                               command=None, volumes=None, hostconfig=None,
                               auto_pull=False, always_pull=False,
                               follow_startup_logs=False, max_builds=None,
-                              **kwargs):
+                              container_cache_size=0, **kwargs):
         # Set the default password to None so random one is generated.
         # Let the DockerBuilder instances to lazily extend the docker volumes
         # and hostconfig via the reserved docker_volumes and docker_hostconfig
@@ -163,6 +363,7 @@ class DockerLatentWorker(BaseWorker, DockerLatentWorker):
         )
         if max_builds is None:
             max_builds = 1
+        self.container_cache_size = container_cache_size
 
         result = await super().reconfigService(
             name, password, docker_host, image=image, command=command,
@@ -196,6 +397,14 @@ class DockerLatentWorker(BaseWorker, DockerLatentWorker):
             await self._soft_disconnect(stopping_service=True)
         self._clearBuildWaitTimer()
 
+        if self._cache_refill is not None:
+            await self._cache_refill
+        if any(self._container_cache.values()):
+            try:
+                await threads.deferToThread(self._thd_drain_container_cache)
+            except Exception as e:
+                log.info(f'Failed to remove the cached containers: {e}')
+
         return await super(AbstractLatentWorker, self).stopService()
 
     def renderWorkerProps(self, build):
@@ -209,8 +418,9 @@ class DockerLatentWorker(BaseWorker, DockerLatentWorker):
     @contextmanager
     def docker_client(self):
         # Note that this is a blocking function, use it from threads
+        key = self.client_pool.key(self.client_args)
         try:
-            client = self._getDockerClient()
+            client = self.client_pool.acquire(key, self._getDockerClient)
         except Exception as e:
             url = self.client_args['base_url']
             exc = RuntimeError(f'Worker {self} cannot connect to the docker '
@@ -219,8 +429,12 @@ class DockerLatentWorker(BaseWorker, DockerLatentWorker):
 
         try:
             yield client
-        finally:
-            client.close()
+        except Exception:
+            # the client's connection might be in a broken state
+            self.client_pool.discard(client)
+            raise
+        else:
+            self.client_pool.release(key, client)
 
     def attach_interactive_shell(self, shell='/bin/bash'):
         # Note that this is blocking the event loop, but it's fine because it
@@ -254,75 +468,38 @@ class DockerLatentWorker(BaseWorker, DockerLatentWorker):
         #    copied from the original implementation with minor modification
         #    to pass runtime configuration to the containers
         with self.docker_client() as docker_client:
-            container_name = self.getContainerName()
-            # cleanup the old instances
-            instances = docker_client.containers(
-                all=1,
-                filters=dict(name=container_name))
-            container_name = '/{0}'.format(container_name)
-            for instance in instances:
-                if container_name not in instance['Names']:
-                    continue
-                try:
-                    docker_client.remove_container(instance['Id'], v=True,
-                                                   force=True)
-                except docker_module.errors.NotFound:
-                    pass  # that's a race condition
-
-            found = False
-            if image is not None:
-                found = self._image_exists(docker_client, image)
-            else:
-                worker_id = id(self)
-                worker_name = self.workername
-                image = f'{worker_name}_{worker_id}_image'
-            if (not found) and (dockerfile is not None):
-                log.info(f'Image {image} not found, building it from scratch')
-                for line in docker_client.build(
-                    fileobj=BytesIO(dockerfile.encode('utf-8')),
-                    tag=image
-                ):
-                    for streamline in _handle_stream_line(line):
-                        log.info(streamline)
-
-            imageExists = self._image_exists(docker_client, image)
-            if ((not imageExists) or self.alwaysPull) and self.autopull:
-                if (not imageExists):
-                    log.info(f'Image {image} not found, pulling from registry')
-                docker_client.pull(image)
-
-            if (not self._image_exists(docker_client, image)):
-                log.info(f'Image {image} not found')
-                raise LatentWorkerCannotSubstantiate(
-                    f'Image {image} not found on docker host.'
-                )
-
             volumes, binds = self._thd_parse_volumes(volumes)
 
             hostconfig['binds'] = binds
             if docker_py_version >= 2.2:
                 hostconfig['init'] = True
 
-            instance = docker_client.create_container(
-                image,
-                self.command,
-                name=self.getContainerName(),
-                volumes=volumes,
-                environment=self.createEnvironment(),
-                host_config=docker_client.create_host_config(
-                    **hostconfig
+            instance, prepared = None, False
+            if self.container_cache_size and image is not None:
+                if self.alwaysPull:
+                    # pull the image before claiming a cached container, so
+                    # the containers created from the outdated image are
+                    # discarded
+                    image = self._thd_prepare_image(docker_client, image,
+                                                    dockerfile)
+                    prepared = True
+                key = self._cache_key(image, volumes, hostconfig)
+                self._cache_spec = (key, image, dockerfile, volumes,
+                                    hostconfig)
+                instance = self._thd_claim_cached_container(docker_client,
+                                                            key, image)
+
+            if instance is None:
+                self._thd_remove_old_containers(docker_client)
+                if not prepared:
+                    image = self._thd_prepare_image(docker_client, image,
+                                                    dockerfile)
+                instance = self._thd_create_container(
+                    docker_client, image, volumes, hostconfig,
+                    name=self.getContainerName()
                 )
-            )
 
-            if instance.get('Id') is None:
-                log.info('Failed to create the container')
-                raise LatentWorkerFailedToSubstantiate(
-                    'Failed to start container'
-                )
             shortid = instance['Id'][:6]
-            log.info(f'Container created, Id: {shortid}...')
-
-            instance['image'] = image
             self.instance = instance
             docker_client.start(instance)
             log.info('Container started')
@@ -338,6 +515,176 @@ class DockerLatentWorker(BaseWorker, DockerLatentWorker):
 
         return [instance['Id'], image]
 
+    def _thd_remove_old_containers(self, docker_client):
+        container_name = self.getContainerName()
+        with self._cache_lock:
+            cached = toolz.concat(self._container_cache.values())
+            cached_ids = {instance['Id'] for instance in cached}
+        # cleanup the old instances, including the cached containers left
+        # behind by a previous master process
+        instances = docker_client.containers(
+            all=1,
+            filters=dict(name=container_name))
+        container_name = '/{0}'.format(container_name)
+        for instance in instances:
+            names = instance['Names']
+            is_cached = any(n.startswith(f'{container_name}-cached-')
+                            for n in names)
+            if container_name not in names and not is_cached:
+                continue
+            if instance['Id'] in cached_ids:
+                continue
+            try:
+                docker_client.remove_container(instance['Id'], v=True,
+                                               force=True)
+            except docker_module.errors.NotFound:
+                pass  # that's a race condition
+
+    def _thd_prepare_image(self, docker_client, image, dockerfile):
+        found = False
+        if image is not None:
+            found = self._image_exists(docker_client, image)
+        else:
+            worker_id = id(self)
+            worker_name = self.workername
+            image = f'{worker_name}_{worker_id}_image'
+        if (not found) and (dockerfile is not None):
+            log.info(f'Image {image} not found, building it from scratch')
+            for line in docker_client.build(
+                fileobj=BytesIO(dockerfile.encode('utf-8')),
+                tag=image
+            ):
+                for streamline in _handle_stream_line(line):
+                    log.info(streamline)
+            found = self._image_exists(docker_client, image)
+
+        if ((not found) or self.alwaysPull) and self.autopull:
+            if (not found):
+                log.info(f'Image {image} not found, pulling from registry')
+            host = self.client_args['base_url']
+            self.image_cache.sync(host, docker_client, image, exists=found)
+            if not found:
+                found = self._image_exists(docker_client, image)
+
+        if not found:
+            log.info(f'Image {image} not found')
+            raise LatentWorkerCannotSubstantiate(
+                f'Image {image} not found on docker host.'
+            )
+
+        return image
+
+    def _thd_create_container(self, docker_client, image, volumes, hostconfig,
+                              name):
+        instance = docker_client.create_container(
+            image,
+            self.command,
+            name=name,
+            volumes=volumes,
+            environment=self.createEnvironment(),
+            host_config=docker_client.create_host_config(
+                **hostconfig
+            )
+        )
+
+        if instance.get('Id') is None:
+            log.info('Failed to create the container')
+            raise LatentWorkerFailedToSubstantiate(
+                'Failed to start container'
+            )
+        shortid = instance['Id'][:6]
+        log.info(f'Container created, Id: {shortid}...')
+
+        instance['image'] = image
+        return instance
+
+    def _cache_key(self, image, volumes, hostconfig):
+        # cached containers are interchangeable if they were created with the
+        # same arguments, note that the environment contains the credentials
+        # of the worker
+        spec = dict(
+            image=image,
+            command=self.command,
+            volumes=volumes,
+            hostconfig=hostconfig,
+            environment=self.createEnvironment()
+        )
+        return json.dumps(spec, sort_keys=True, default=str)
+
+    def _thd_claim_cached_container(self, docker_client, key, image):
+        while True:
+            with self._cache_lock:
+                containers = self._container_cache.get(key)
+                if not containers:
+                    return None
+                instance = containers.pop()
+
+            shortid = instance['Id'][:6]
+            try:
+                # the image might have been updated since the container was
+                # created, e.g. by pulling a newer version
+                current = docker_client.inspect_image(image)['Id']
+                created = docker_client.inspect_container(instance['Id'])
+                outdated = created['Image'] != current
+            except docker_module.errors.NotFound:
+                outdated = True
+
+            if not outdated:
+                log.info(f'Claimed cached container, Id: {shortid}...')
+                return instance
+            else:
+                log.info(f'Discarding outdated cached container, '
+                         f'Id: {shortid}')
+                self._thd_remove_container(docker_client, instance)
+
+    def _thd_remove_container(self, docker_client, instance):
+        try:
+            docker_client.remove_container(instance['Id'], v=True, force=True)
+        except docker_module.errors.NotFound:
+            pass
+
+    def _thd_fill_container_cache(self, key, image, dockerfile, volumes,
+                                  hostconfig):
+        with self._cache_lock:
+            cached = len(self._container_cache[key])
+            missing = self.container_cache_size - cached
+        if missing <= 0:
+            return
+
+        with self.docker_client() as docker_client:
+            image = self._thd_prepare_image(docker_client, image, dockerfile)
+            for _ in range(missing):
+                suffix = uuid.uuid4().hex[:8]
+                name = f'{self.getContainerName()}-cached-{suffix}'
+                instance = self._thd_create_container(
+                    docker_client, image, volumes, hostconfig, name=name
+                )
+                with self._cache_lock:
+                    self._container_cache[key].append(instance)
+
+    def _thd_drain_container_cache(self):
+        with self._cache_lock:
+            containers = list(toolz.concat(self._container_cache.values()))
+            self._container_cache.clear()
+
+        with self.docker_client() as docker_client:
+            for instance in containers:
+                self._thd_remove_container(docker_client, instance)
+
+    @ensure_deferred
+    async def stop_instance(self, fast=False):
+        result = await super().stop_instance(fast)
+        # refill the container cache in the background, so the insubstantiation
+        # doesn't have to wait for the new containers
+        if self.container_cache_size and self._cache_spec is not None:
+            d = threads.deferToThread(self._thd_fill_container_cache,
+                                      *self._cache_spec)
+            d.addErrback(lambda f: log.failure(
+                'Failed to refill the container cache', failure=f
+            ))
+            self._cache_refill = d
+        return result
+
     def _thd_stop_instance(self, instance, fast):
         with self.docker_client() as docker_client:
             log.info('Stopping container %s...' % instance['Id'][:6])
@@ -378,7 +725,8 @@ def load_workers_from(config_path, **kwargs):
                 hostconfig=w['docker'].get('hostconfig', {}),
                 volumes=w['docker'].get('volumes', []),
                 auto_pull=w['docker'].get('auto_pull', True),
-                always_pull=w['docker'].get('always_pull', True)
+                always_pull=w['docker'].get('always_pull', True),
+                container_cache_size=w['docker'].get('container_cache_size', 0)
             )
             workers.append(worker)
         else: